@@ -0,0 +1,139 @@
+import asyncio
+import os
+import signal
+
+import telebot
+import telebot.asyncio_helper
+import logging
+
+from telebot.async_telebot import AsyncTeleBot
+
+from async_question import AsyncAkentevQuestionStorage, AsyncCompositeQuestionStorage, SyncToAsyncQuestionStorage
+from async_user_data import AsyncRedisUserDataStorage, SyncToAsyncUserDataStorage
+from handlers import GameHandlers, run_async
+from main import token, get_question_ttl
+from metrics import start_metrics_server, start_metrics_log
+from question import InMemoryQuestionStorage, DEFAULT_QUESTIONS
+from user_data import JournaledFileUserDataStorage, InMemoryUserDataStorage, RedisUserDataStorage, \
+    start_question_expiry
+
+# Асинхронная версия бота: все пользователи обслуживаются в одном event loop, а обращения к API вопросов
+# и к Redis не блокируют обработку сообщений других пользователей. Логика обработчиков общая с main.py,
+# токен бота и адрес Bot API задаются теми же переменными окружения BOT_TOKEN и TELEGRAM_API_URL.
+
+# асинхронный бот обращается к API через свой модуль, поэтому адрес API подменяется и в нём
+telegram_api_url = os.environ.get('TELEGRAM_API_URL')
+if telegram_api_url is not None:
+    telebot.asyncio_helper.API_URL = telegram_api_url.rstrip('/') + '/bot{0}/{1}'
+
+# добавляем логирование уровня DEBUG от telebot
+telebot.logger.setLevel(logging.DEBUG)
+
+
+def create_question_storage():
+    """
+    Создаёт хранилище вопросов для игры: сначала пытаемся получить вопрос через API (ждём не дольше трёх секунд),
+    если это не получилось, то берём вопрос из памяти.
+
+    :return: хранилище вопросов (AsyncQuestionStorage)
+    """
+    return AsyncCompositeQuestionStorage(
+        [
+            AsyncAkentevQuestionStorage(),
+            SyncToAsyncQuestionStorage(InMemoryQuestionStorage(DEFAULT_QUESTIONS))
+        ],
+        timeout=3.0
+    )
+
+
+def create_user_data_storage():
+    """
+    Создаёт хранилище состояния пользователей: если задана переменная окружения REDIS_URL, то состояние каждого
+    пользователя хранится в отдельном хэше Redis (состояние, сохранённое раньше одним json-документом, при первом
+    запуске переносится в новый формат, как в main.py), иначе - в файле storage.json в текущей директории,
+    а изменения дописываются в журнал рядом с ним. Если задан QUESTION_TTL, то запускается фоновое удаление
+    вопросов, на которые пользователи не ответили вовремя.
+
+    :return: хранилище состояния (AsyncUserDataStorage), которое нужно закрыть при остановке бота
+    """
+    question_ttl = get_question_ttl()
+
+    redis_url = os.environ.get('REDIS_URL')
+    if redis_url is not None:
+        # миграция и удаление истёкших вопросов выполняются синхронным хранилищем: первая - до запуска бота,
+        # второе - в фоновом потоке
+        expiring_storage = RedisUserDataStorage(redis_url, question_ttl=question_ttl)
+        expiring_storage.migrate_from_json_blob()
+        user_data_storage = AsyncRedisUserDataStorage(redis_url, question_ttl=question_ttl)
+    else:
+        expiring_storage = JournaledFileUserDataStorage(
+            'storage.json', in_memory_storage=InMemoryUserDataStorage(question_ttl=question_ttl))
+        user_data_storage = SyncToAsyncUserDataStorage(expiring_storage)
+    if question_ttl is not None:
+        start_question_expiry(expiring_storage, interval=min(60.0, question_ttl))
+    return user_data_storage
+
+
+def create_bot(question_storage, user_data_storage):
+    """
+    Создаёт асинхронного бота и регистрирует обработчики сообщений.
+
+    :param question_storage: хранилище вопросов (AsyncQuestionStorage)
+    :param user_data_storage: хранилище состояния пользователей (AsyncUserDataStorage)
+    :return: бот (AsyncTeleBot)
+    """
+    bot = AsyncTeleBot(token)
+    handlers = GameHandlers(bot, question_storage, user_data_storage)
+
+    @bot.message_handler(commands=['start'])
+    async def start(message):
+        await run_async(handlers.start(message))
+
+    @bot.callback_query_handler(func=lambda call: True)
+    async def answer_callback(callback):
+        await run_async(handlers.answer_callback(callback))
+
+    # все текстовые сообщения, кроме команды /start, разбираются одним диспетчером
+    @bot.message_handler(func=lambda message: True)
+    async def text_message_handler(message):
+        await run_async(handlers.dispatch(message))
+
+    return bot
+
+
+async def run(bot, question_storage, user_data_storage):
+    """
+    Опрашивает Telegram, пока бота не остановят, а затем закрывает сессию aiohttp бота и хранилища.
+    SIGTERM (так бота останавливает Heroku) отменяет опрос, и бот завершается так же, как при Ctrl+C.
+    """
+    polling = asyncio.ensure_future(bot.polling())
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, polling.cancel)
+    try:
+        await polling
+    except asyncio.CancelledError:
+        logging.info('Опрос Telegram остановлен: бот останавливается')
+    finally:
+        if telebot.asyncio_helper.session_manager.session is not None:
+            await bot.close_session()
+        await question_storage.close()
+        await user_data_storage.close()
+
+
+def main():
+    question_storage = create_question_storage()
+    user_data_storage = create_user_data_storage()
+    bot = create_bot(question_storage, user_data_storage)
+
+    # метрики: см. main.py
+    if os.environ.get('METRICS_PORT'):
+        start_metrics_server(int(os.environ['METRICS_PORT']))
+    metrics_log_interval = float(os.environ.get('METRICS_LOG_INTERVAL', 60))
+    if metrics_log_interval > 0:
+        start_metrics_log(metrics_log_interval)
+
+    asyncio.run(run(bot, question_storage, user_data_storage))
+
+
+# при импорте бот не запускается
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+from abc import abstractmethod
+
+import asyncio
+import logging
+import time
+
+import aiohttp
+
+import metrics
+
+from question import CircuitBreaker, question_from_akentev_json
+
+
+# Асинхронный вариант хранилища вопросов (см. QuestionStorage), который используется в async_main.py
+class AsyncQuestionStorage:
+
+    @abstractmethod
+    async def get_question(self, complexity, user_id=None):
+        """
+        Получает очередной вопрос.
+
+        :param complexity: предпочитаемая сложность (str)
+        :param user_id: telegram-ID пользователя, которому задаётся вопрос (int), если он известен
+        :return: Question (вопрос (str), варианты ответа ([str]), правильный ответ (str))
+        """
+        pass
+
+
+# Реализация асинхронного хранилища вопросов, которая ходит через внешнее API; все запросы идут через одну
+# сессию aiohttp с пулом keep-alive соединений
+class AsyncAkentevQuestionStorage(AsyncQuestionStorage):
+
+    def __init__(self, api_url='https://stepik.akentev.com/api/millionaire', timeout=5.0, pool_size=100):
+        """
+        :param api_url: адрес API, которое возвращает вопросы (str)
+        :param timeout: максимальное время ожидания ответа от API в секундах (float)
+        :param pool_size: максимальное кол-во одновременно открытых соединений с API (int)
+        """
+        self.api_url = api_url
+        self.timeout = timeout
+        self.pool_size = pool_size
+        # сессию можно создать только внутри работающего event loop, поэтому она создаётся при первом запросе
+        self.session = None
+
+    async def get_question(self, complexity, user_id=None):
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            )
+        async with self.session.get(self.api_url, params={'complexity': complexity}) as r:
+            r.raise_for_status()
+            data = await r.json(content_type=None)
+
+        return question_from_akentev_json(data)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+
+# Реализация асинхронного хранилища вопросов поверх обычного QuestionStorage. Если хранилище может надолго
+# заблокировать поток (например, ходит в сеть), то с blocking=True запросы к нему выполняются в отдельном потоке
+class SyncToAsyncQuestionStorage(AsyncQuestionStorage):
+
+    def __init__(self, storage, blocking=False):
+        """
+        :param storage: обычное хранилище вопросов (QuestionStorage)
+        :param blocking: выполнять ли запросы к хранилищу в отдельном потоке (bool)
+        """
+        self.storage = storage
+        self.blocking = blocking
+
+    async def get_question(self, complexity, user_id=None):
+        if self.blocking:
+            return await asyncio.to_thread(self.storage.get_question, complexity, user_id)
+        return self.storage.get_question(complexity, user_id)
+
+
+# Реализация асинхронного хранилища вопросов, которая по очереди пытается получить вопрос у других хранилищ.
+# Как и в CompositeQuestionStorage, у каждого хранилища есть свой предохранитель (CircuitBreaker), а ожидание
+# ответа от каждого хранилища ограничено по времени
+class AsyncCompositeQuestionStorage(AsyncQuestionStorage):
+
+    def __init__(self, storages, timeout=None, breaker_factory=CircuitBreaker):
+        """
+        :param storages: хранилища вопросов в порядке приоритета ([AsyncQuestionStorage])
+        :param timeout: максимальное время ожидания ответа от одного хранилища в секундах (float)
+        :param breaker_factory: функция, создающая предохранитель для каждого хранилища (() -> CircuitBreaker)
+        """
+        self.storages = storages
+        self.breakers = [breaker_factory() for _ in storages]
+        self.timeout = timeout
+
+    async def get_question(self, complexity, user_id=None):
+        for storage, breaker in zip(self.storages, self.breakers):
+            if not breaker.allow_request():
+                continue
+            source = type(storage).__name__
+            start = time.monotonic()
+            try:
+                question = await asyncio.wait_for(storage.get_question(complexity, user_id), self.timeout)
+            except Exception as e:
+                latency = time.monotonic() - start
+                breaker.record_failure(latency)
+                metrics.question_source_latency.observe(latency, source, 'failure')
+                metrics.question_source_errors.inc(source)
+                logging.warning(repr(e))
+                continue
+            latency = time.monotonic() - start
+            breaker.record_success(latency)
+            metrics.question_source_latency.observe(latency, source, 'success')
+            return question
+        raise RuntimeError('Не удалось получить вопрос ни от одного хранилища вопросов')
+
+    def get_health(self):
+        """
+        Возвращает для каждого хранилища состояние его предохранителя, долю успешных запросов и среднее время ответа.
+
+        :return: статистика по хранилищам ([map])
+        """
+        return [dict(source=type(storage).__name__, **breaker.get_health())
+                for storage, breaker in zip(self.storages, self.breakers)]
+
+    async def close(self):
+        """
+        Закрывает хранилища, которые держат соединения (например, сессию aiohttp AsyncAkentevQuestionStorage).
+        """
+        for storage in self.storages:
+            close = getattr(storage, 'close', None)
+            if close is not None:
+                await close()
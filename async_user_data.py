@@ -0,0 +1,269 @@
+import json
+import os
+
+from abc import abstractmethod
+
+import redis.asyncio
+
+from user_data import RedisUserDataLayout, DEFAULT_COMPLEXITY, check_complexity, question_from_json
+
+
+class AsyncUserDataStorage:
+    """
+    Асинхронный вариант хранилища состояния пользователей (см. UserDataStorage), который используется в async_main.py.
+    """
+
+    @abstractmethod
+    async def get_user_current_question(self, user_id):
+        """
+        Возвращает вопрос, который был задан пользователю последним и на который ещё не получен ответ. None, если
+        сейчас пользователь в той стадии, когда неотвеченных вопросов нет.
+
+        :param user_id: telegram-ID пользователя (int)
+        """
+        pass
+
+    @abstractmethod
+    async def put_user_current_question(self, user_id, question):
+        """
+        Сохраняет вопрос, который был задан пользователю.
+
+        :param user_id: telegram-ID пользователя (int), которому задавался вопрос
+        :param question: вопрос, который был задан (Question)
+        """
+        pass
+
+    @abstractmethod
+    async def clear_user_current_question(self, user_id):
+        """
+        Очищает информацию о последнем заданном вопросе пользователю.
+
+        :param user_id: telegram-ID пользователя (int)
+        """
+        pass
+
+    @abstractmethod
+    async def get_user_complexity(self, user_id):
+        """
+        Возвращает сложность, которая была выбрана пользователем (или значение по умолчанию, если пользователь
+        ничего не выбирал.
+
+        :param user_id: telegramID пользователя (int)
+        """
+        pass
+
+    @abstractmethod
+    async def set_user_complexity(self, user_id, complexity):
+        """
+        Устанавливает сложность игры для пользователя: 1, 2 или 3. Если передано что-то другое, то происходит
+        исключительная ситуация (ValueError).
+
+        :param user_id: telegram-ID пользователя (int)
+        :param complexity: сложность игры (int): 1, 2 или 3
+        """
+        pass
+
+    @abstractmethod
+    async def get_user_victories_count(self, user_id):
+        """
+        Возвращает кол-во побед пользователя (int).
+
+        :param user_id: telegram-ID пользователя (int)
+        """
+        pass
+
+    @abstractmethod
+    async def get_user_defeats_count(self, user_id):
+        """
+        Возвращает кол-во поражений пользователя (int).
+
+        :param user_id: telegram-ID пользователя (int)
+        """
+        pass
+
+    @abstractmethod
+    async def add_user_victory(self, user_id):
+        """
+        Записывает на счёт пользователя одну новую победу.
+
+        :param user_id: telegram-ID пользователя (int)
+        """
+        pass
+
+    @abstractmethod
+    async def add_user_defeat(self, user_id):
+        """
+        Записывает на счёт пользователя одно новое поражение.
+
+        :param user_id: telegram-ID пользователя (int)
+        """
+        pass
+
+    @abstractmethod
+    async def get_user_rank(self, user_id):
+        """
+        Возвращает место пользователя в рейтинге по кол-ву побед, начиная с 1 (int).
+
+        :param user_id: telegram-ID пользователя (int)
+        """
+        pass
+
+    @abstractmethod
+    async def get_top_users(self, count):
+        """
+        Возвращает лучших пользователей по кол-ву побед ([(int, int)]: telegram-ID и кол-во побед).
+
+        :param count: кол-во пользователей (int)
+        """
+        pass
+
+
+class SyncToAsyncUserDataStorage(AsyncUserDataStorage):
+    """
+    Реализация AsyncUserDataStorage поверх обычного UserDataStorage, который не блокирует поток надолго
+    (например, InMemoryUserDataStorage или JournaledFileUserDataStorage).
+    """
+
+    def __init__(self, storage):
+        """
+        :param storage: обычное хранилище состояния пользователей (UserDataStorage)
+        """
+        self.storage = storage
+
+    async def get_user_current_question(self, user_id):
+        return self.storage.get_user_current_question(user_id)
+
+    async def put_user_current_question(self, user_id, question):
+        self.storage.put_user_current_question(user_id, question)
+
+    async def clear_user_current_question(self, user_id):
+        self.storage.clear_user_current_question(user_id)
+
+    async def get_user_complexity(self, user_id):
+        return self.storage.get_user_complexity(user_id)
+
+    async def set_user_complexity(self, user_id, complexity):
+        self.storage.set_user_complexity(user_id, complexity)
+
+    async def get_user_victories_count(self, user_id):
+        return self.storage.get_user_victories_count(user_id)
+
+    async def get_user_defeats_count(self, user_id):
+        return self.storage.get_user_defeats_count(user_id)
+
+    async def add_user_victory(self, user_id):
+        self.storage.add_user_victory(user_id)
+
+    async def add_user_defeat(self, user_id):
+        self.storage.add_user_defeat(user_id)
+
+    async def get_user_rank(self, user_id):
+        return self.storage.get_user_rank(user_id)
+
+    async def get_top_users(self, count):
+        return self.storage.get_top_users(count)
+
+    async def close(self):
+        close = getattr(self.storage, 'close', None)
+        if close is not None:
+            close()
+
+
+class AsyncRedisUserDataStorage(RedisUserDataLayout, AsyncUserDataStorage):
+    """
+    Асинхронный вариант RedisUserDataStorage: хранит состояние каждого пользователя в отдельном хэше Redis
+    в том же формате (RedisUserDataLayout, включая общий каталог вопросов), поэтому синхронный и асинхронный бот
+    могут работать с одними и теми же данными. Изменения выполняются так же атомарно: с версией пользователя
+    и уведомлением в канал mosigobot.invalidations, а срок ответа на вопрос хранится так же (question_ttl);
+    истёкшие вопросы удаляет RedisUserDataStorage.expire_questions.
+    """
+
+    def __init__(self, redis_url=None, redis_db=None, instance_id=None, question_ttl=None):
+        """
+        В конструктор принимает URL для коннекта в Redis или уже готовый асинхронный клиент Redis.
+
+        :param redis_url: URL для коннекта в Redis (str)
+        :param redis_db: асинхронный клиент Redis (redis.asyncio.Redis), если он уже создан
+        :param instance_id: ID экземпляра бота, которым подписываются уведомления об изменениях (str);
+        по умолчанию случайный
+        :param question_ttl: сколько секунд пользователь может отвечать на вопрос (float); None - без ограничения
+        """
+        self.redis_db = redis_db if redis_db is not None else redis.asyncio.from_url(redis_url)
+        self.instance_id = instance_id if instance_id is not None else os.urandom(8).hex()
+        self.question_ttl = question_ttl
+
+    async def __set_user_question(self, user_id, question):
+        user_key = self.user_key(user_id)
+
+        async def update(pipe):
+            previous_question_id = self.parse_asked_question_id(
+                await pipe.hmget(user_key, *self.asked_question_fields))
+            pipe.multi()
+            return self.queue_set_user_question(pipe, user_id, previous_question_id, question)
+
+        await self.__remove_unused_questions(await self.redis_db.transaction(update, user_key,
+                                                                             value_from_callable=True))
+
+    async def __remove_unused_questions(self, question_ids):
+        # см. RedisUserDataStorage: счётчики ссылок проверяются отдельной короткой транзакцией
+        if not question_ids:
+            return
+
+        async def update(pipe):
+            self.queue_unused_questions_removal(pipe, question_ids, await pipe.hmget(self.question_refs_key,
+                                                                                    question_ids))
+
+        await self.redis_db.transaction(update, self.question_refs_key)
+
+    async def get_user_current_question(self, user_id):
+        question_id, question_json = await self.redis_db.hmget(self.user_key(user_id), 'question_id', 'question')
+        if question_id is not None:
+            question_json = await self.redis_db.hget(self.questions_key, question_id)
+        if question_json is None:
+            return None
+        return question_from_json(json.loads(question_json))
+
+    async def put_user_current_question(self, user_id, question):
+        await self.__set_user_question(user_id, question)
+
+    async def clear_user_current_question(self, user_id):
+        await self.__set_user_question(user_id, None)
+
+    async def get_user_complexity(self, user_id):
+        complexity = await self.redis_db.hget(self.user_key(user_id), 'complexity')
+        if complexity is None:
+            return DEFAULT_COMPLEXITY
+        return complexity.decode('utf-8')
+
+    async def set_user_complexity(self, user_id, complexity):
+        check_complexity(complexity)
+        pipe = self.redis_db.pipeline(transaction=True)
+        self.queue_set_complexity(pipe, user_id, complexity)
+        await pipe.execute()
+
+    async def get_user_victories_count(self, user_id):
+        return int(await self.redis_db.hget(self.user_key(user_id), 'victories') or 0)
+
+    async def get_user_defeats_count(self, user_id):
+        return int(await self.redis_db.hget(self.user_key(user_id), 'defeats') or 0)
+
+    async def add_user_victory(self, user_id):
+        pipe = self.redis_db.pipeline(transaction=True)
+        self.queue_add_victory(pipe, user_id)
+        await pipe.execute()
+
+    async def add_user_defeat(self, user_id):
+        pipe = self.redis_db.pipeline(transaction=True)
+        self.queue_add_defeat(pipe, user_id)
+        await pipe.execute()
+
+    async def get_user_rank(self, user_id):
+        victories = int(await self.redis_db.zscore(self.leaderboard_key, user_id) or 0)
+        return 1 + await self.redis_db.zcount(self.leaderboard_key, f'({victories}', '+inf')
+
+    async def get_top_users(self, count):
+        top = await self.redis_db.zrevrange(self.leaderboard_key, 0, count - 1, withscores=True)
+        return [(int(user_id), int(victories)) for user_id, victories in top]
+
+    async def close(self):
+        await self.redis_db.aclose()
@@ -0,0 +1,70 @@
+"""
+Сравнение результатов двух запусков benchmarks.storage_benchmark (например, до и после изменения).
+
+Для каждого измерения, которое есть в обоих файлах, печатается отношение нового значения к старому:
+для времени сравнивается медиана, для памяти и размера - кол-во байт. Измерения, которые стали хуже
+больше чем в --threshold раз, помечаются как регрессии, и скрипт завершается с кодом 1.
+
+Запуск из корня репозитория:
+
+    python -m benchmarks.compare before.json after.json --threshold 1.2
+"""
+import argparse
+import json
+import sys
+
+# поля, которые вместе определяют одно измерение
+key_fields = ['benchmark', 'users', 'backend', 'operation']
+
+
+def result_key(result):
+    return tuple(result.get(field) for field in key_fields)
+
+
+def result_value(result):
+    """
+    :return: значение, по которому сравниваются результаты (float), или None, если сравнивать нечего
+    """
+    for field in ['median_us', 'bytes']:
+        if field in result:
+            return result[field]
+    return None
+
+
+def load_results(file_name):
+    with open(file_name, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    return data['meta'], {result_key(result): result for result in data['results']}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Сравнение результатов бенчмарков')
+    parser.add_argument('before', help='результаты до изменения (json)')
+    parser.add_argument('after', help='результаты после изменения (json)')
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help='во сколько раз должно ухудшиться значение, чтобы считаться регрессией')
+    args = parser.parse_args()
+
+    before_meta, before = load_results(args.before)
+    after_meta, after = load_results(args.after)
+    print(f'{before_meta.get("commit")} -> {after_meta.get("commit")}')
+
+    regressions = 0
+    for key, after_result in after.items():
+        before_result = before.get(key)
+        if before_result is None:
+            continue
+        before_value, after_value = result_value(before_result), result_value(after_result)
+        if not before_value or after_value is None:
+            continue
+        ratio = after_value / before_value
+        regression = ratio > args.threshold
+        regressions += regression
+        name = ' '.join(str(field) for field in key if field is not None)
+        print(f'{"REGRESSION " if regression else ""}{name}: {before_value} -> {after_value} (x{ratio:.2f})')
+
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
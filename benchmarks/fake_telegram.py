@@ -0,0 +1,255 @@
+"""
+Локальный заменитель Telegram Bot API для нагрузочного тестирования (см. benchmarks/load_test.py).
+
+Сервер поддерживает методы, которыми пользуется бот: getMe, getUpdates (long polling), sendMessage,
+answerCallbackQuery, setWebhook и deleteWebhook. Обновления от игроков добавляются через push_update:
+если бот зарегистрировал webhook, обновление сразу доставляется POST-запросом на его адрес (с повтором,
+если бот ответил 503), иначе оно ждёт, пока бот заберёт его через getUpdates. Сообщения, которые отправил бот,
+складываются в очередь чата, откуда их забирает сессия игрока.
+"""
+import itertools
+import json
+import queue
+import threading
+import time
+
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qsl
+
+import requests
+
+from requests.adapters import HTTPAdapter
+
+# пользователь, от имени которого бот отправляет сообщения
+bot_user = {'id': 1, 'is_bot': True, 'first_name': 'mosigobot', 'username': 'mosigobot'}
+
+
+def player_user(chat_id):
+    return {'id': chat_id, 'is_bot': False, 'first_name': f'Игрок {chat_id}'}
+
+
+class FakeTelegramServer(ThreadingHTTPServer):
+    """
+    HTTP-сервер, который отвечает боту так же, как Bot API, и хранит всё состояние в памяти.
+    """
+
+    daemon_threads = True
+    # игроки и бот открывают много соединений одновременно
+    request_queue_size = 1024
+
+    def __init__(self, address=('127.0.0.1', 0), webhook_retry_delay=0.05, webhook_max_retries=100,
+                 webhook_pool_size=1000):
+        """
+        :param address: адрес, на котором сервер принимает запросы ((str, int)); порт 0 - любой свободный
+        :param webhook_retry_delay: пауза перед повторной доставкой обновления, если бот ответил ошибкой (float)
+        :param webhook_max_retries: сколько раз повторять доставку одного обновления (int)
+        :param webhook_pool_size: максимальное кол-во открытых соединений с webhook бота (int)
+        """
+        super().__init__(address, FakeTelegramRequestHandler)
+        self.webhook_retry_delay = webhook_retry_delay
+        self.webhook_max_retries = webhook_max_retries
+
+        self.lock = threading.Condition()
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.pending_updates = []
+        self.chats = {}
+        self.webhook_url = None
+        self.webhook_secret = None
+        # обновления доставляются из потоков всех игроков сразу, поэтому соединений с ботом нужно много
+        self.webhook_session = requests.Session()
+        self.webhook_session.mount('http://', HTTPAdapter(pool_maxsize=webhook_pool_size))
+
+        # сколько раз бот вызвал каждый метод API и сколько раз пришлось повторить доставку по webhook
+        self.calls = Counter()
+        self.webhook_retries = 0
+
+        self.thread = None
+
+    @property
+    def url(self):
+        return f'http://{self.server_address[0]}:{self.server_address[1]}'
+
+    def start(self):
+        """
+        Запускает сервер в отдельном потоке.
+        """
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def chat_queue(self, chat_id):
+        """
+        :param chat_id: ID чата (int)
+        :return: очередь сообщений, которые бот отправил в чат (queue.Queue)
+        """
+        with self.lock:
+            if chat_id not in self.chats:
+                self.chats[chat_id] = queue.Queue()
+            return self.chats[chat_id]
+
+    def wait_for_webhook(self, timeout=10.0):
+        """
+        Ждёт, пока бот зарегистрирует webhook.
+
+        :return: True, если webhook зарегистрирован (bool)
+        """
+        with self.lock:
+            return self.lock.wait_for(lambda: self.webhook_url is not None, timeout)
+
+    def push_update(self, update):
+        """
+        Передаёт боту обновление: доставляет его по webhook или ставит в очередь для getUpdates.
+
+        :param update: обновление без update_id (map)
+        :return: обновление с присвоенным update_id (map)
+        """
+        with self.lock:
+            update = dict(update, update_id=next(self.update_ids))
+            webhook_url, webhook_secret = self.webhook_url, self.webhook_secret
+            if webhook_url is None:
+                self.pending_updates.append(update)
+                self.lock.notify_all()
+                return update
+
+        headers = {} if webhook_secret is None else {'X-Telegram-Bot-Api-Secret-Token': webhook_secret}
+        for attempt in range(self.webhook_max_retries):
+            response = self.webhook_session.post(webhook_url, json=update, headers=headers, timeout=10)
+            if response.status_code == 200:
+                return update
+            with self.lock:
+                self.webhook_retries += 1
+            time.sleep(self.webhook_retry_delay)
+        raise RuntimeError(f'Bot did not accept update {update["update_id"]}: HTTP {response.status_code}')
+
+    def call(self, method, params):
+        """
+        Выполняет метод Bot API.
+
+        :param method: название метода (str)
+        :param params: параметры вызова (map)
+        :return: значение поля result ответа
+        """
+        with self.lock:
+            self.calls[method] += 1
+
+        if method == 'getUpdates':
+            return self.get_updates(int(params.get('offset', 0)), int(params.get('limit', 100)),
+                                    float(params.get('timeout', 0)))
+        if method == 'sendMessage':
+            return self.send_message(params)
+        if method == 'getMe':
+            return bot_user
+        if method == 'setWebhook':
+            with self.lock:
+                # setWebhook с пустым url удаляет webhook
+                self.webhook_url = params.get('url') or None
+                self.webhook_secret = params.get('secret_token')
+                self.lock.notify_all()
+            return True
+        if method == 'deleteWebhook':
+            with self.lock:
+                self.webhook_url = None
+                self.webhook_secret = None
+            return True
+        return True
+
+    def get_updates(self, offset, limit, timeout):
+        with self.lock:
+            # обновления с ID меньше offset бот уже обработал
+            self.pending_updates = [update for update in self.pending_updates if update['update_id'] >= offset]
+            self.lock.wait_for(lambda: self.pending_updates, timeout)
+            return self.pending_updates[:limit]
+
+    def send_message(self, params):
+        chat_id = int(params['chat_id'])
+        message = {
+            'message_id': next(self.message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': bot_user,
+            'text': params.get('text', '')
+        }
+        # как и Bot API, в отправленном сообщении возвращаем только inline-клавиатуру
+        reply_markup = json.loads(params['reply_markup']) if params.get('reply_markup') else {}
+        if 'inline_keyboard' in reply_markup:
+            message['reply_markup'] = reply_markup
+        self.chat_queue(chat_id).put((time.perf_counter(), message))
+        return message
+
+
+class FakeTelegramRequestHandler(BaseHTTPRequestHandler):
+
+    # keep-alive: бот переиспользует соединения так же, как с настоящим API; без TCP_NODELAY ответ, записанный
+    # двумя частями (заголовки и тело), ждал бы delayed ACK клиента
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def handle_api_request(self):
+        url = urlparse(self.path)
+        parts = url.path.strip('/').split('/')
+        if len(parts) != 2 or not parts[0].startswith('bot'):
+            self.send_json(404, {'ok': False, 'error_code': 404, 'description': 'Not Found'})
+            return
+
+        params = dict(parse_qsl(url.query, keep_blank_values=True))
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if body:
+            if self.headers.get('Content-Type', '').startswith('application/json'):
+                params.update(json.loads(body))
+            else:
+                params.update(parse_qsl(body.decode('utf-8'), keep_blank_values=True))
+
+        self.send_json(200, {'ok': True, 'result': self.server.call(parts[1], params)})
+
+    do_GET = handle_api_request
+    do_POST = handle_api_request
+
+    def send_json(self, status, data):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def text_update(chat_id, text):
+    """
+    :return: обновление с текстовым сообщением от игрока (map)
+    """
+    message = {
+        'message_id': int(time.time() * 1000) % 2 ** 31,
+        'date': int(time.time()),
+        'chat': {'id': chat_id, 'type': 'private'},
+        'from': player_user(chat_id),
+        'text': text
+    }
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return {'message': message}
+
+
+def callback_update(chat_id, message, data):
+    """
+    :param message: сообщение бота, на кнопку которого нажал игрок (map)
+    :param data: callback_data нажатой кнопки (str)
+    :return: обновление с нажатием на кнопку (map)
+    """
+    return {
+        'callback_query': {
+            'id': str(time.time_ns()),
+            'from': player_user(chat_id),
+            'message': message,
+            'chat_instance': str(chat_id),
+            'data': data
+        }
+    }
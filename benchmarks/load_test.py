@@ -0,0 +1,270 @@
+"""
+Нагрузочный тест бота целиком: настоящие обработчики из main.py работают с локальным заменителем Bot API
+(benchmarks/fake_telegram.py), а игроки имитируются сессиями, которые параллельно выполняют сценарий игры:
+/start, затем случайные шаги - вопрос и ответ на него нажатием кнопки, счёт, рейтинг, смена сложности.
+
+Каждый шаг игрока - это одно обновление для бота и один ответ бота; задержка шага измеряется от передачи
+обновления боту до получения его ответа. Для каждого шага выводится пропускная способность и перцентили
+задержки p50/p95/p99 в json (построчно и, если указан --output, одним документом).
+
+Ответы бота проходят через очередь исходящих сообщений с ограничениями частоты Telegram, поэтому игрок без
+пауз между шагами (--think-time 0) упирается в ограничение на чат (около сообщения в секунду). Чтобы измерить
+сами обработчики, ограничения можно ослабить переменными окружения OUTGOING_GLOBAL_RATE и OUTGOING_CHAT_RATE.
+
+Бот получает обновления так же, как в работе: через getUpdates (--mode polling) или по webhook
+(--mode webhook). По умолчанию состояние и вопросы хранятся в памяти; с --storage env и --questions env
+используются хранилища, выбранные переменными окружения, как в main.py.
+
+Запуск из корня репозитория:
+
+    python -m benchmarks.load_test --players 100 --steps 50 --mode webhook --output load.json
+"""
+import argparse
+import datetime
+import json
+import logging
+import platform
+import queue
+import random
+import socket
+import subprocess
+import threading
+import time
+
+from collections import defaultdict
+
+import telebot
+
+import main
+from benchmarks.fake_telegram import FakeTelegramServer, text_update, callback_update
+from question import InMemoryQuestionStorage, DEFAULT_QUESTIONS
+from user_data import InMemoryUserDataStorage
+from webhook import run_webhook
+
+# первый telegram-ID игроков
+first_chat_id = 200000000
+
+# шаги сценария игрока (кроме /start и ответа на вопрос, который всегда идёт сразу после вопроса) и их веса
+player_steps = [
+    ('ask_question', 'Спроси меня вопрос', 6),
+    ('scores', 'Покажи счёт', 2),
+    ('leaderboard', 'Покажи рейтинг', 1),
+    ('complexity', None, 1),
+    ('hello', 'Привет', 1),
+]
+
+
+class PlayerSession:
+    """
+    Игрок, который последовательно выполняет шаги сценария и ждёт ответа бота на каждый шаг.
+    """
+
+    def __init__(self, server, chat_id, steps, think_time, reply_timeout, record):
+        """
+        :param server: заменитель Bot API (FakeTelegramServer)
+        :param chat_id: telegram-ID игрока (int)
+        :param steps: кол-во шагов после /start (int)
+        :param think_time: максимальная пауза между шагами в секундах (float)
+        :param reply_timeout: сколько секунд ждать ответа бота (float)
+        :param record: функция, которая запоминает результат шага (step, latency или None при таймауте)
+        """
+        self.server = server
+        self.chat_id = chat_id
+        self.steps = steps
+        self.think_time = think_time
+        self.reply_timeout = reply_timeout
+        self.record = record
+        self.replies = server.chat_queue(chat_id)
+        self.rnd = random.Random(chat_id)
+
+    def step(self, name, update):
+        """
+        Отправляет боту обновление и ждёт ответа.
+
+        :return: сообщение бота (map) или None, если бот не ответил вовремя
+        """
+        # ответы на предыдущие шаги, которые пришли после таймаута, к этому шагу не относятся
+        while not self.replies.empty():
+            self.replies.get_nowait()
+
+        sent_at = time.perf_counter()
+        self.server.push_update(update)
+        try:
+            received_at, message = self.replies.get(timeout=self.reply_timeout)
+        except queue.Empty:
+            self.record(name, None)
+            return None
+        self.record(name, received_at - sent_at)
+        return message
+
+    def run(self):
+        self.step('start', text_update(self.chat_id, '/start'))
+        names = [name for name, _, _ in player_steps]
+        weights = [weight for _, _, weight in player_steps]
+        texts = {name: text for name, text, _ in player_steps}
+
+        for _ in range(self.steps):
+            if self.think_time:
+                time.sleep(self.rnd.uniform(0, self.think_time))
+            name = self.rnd.choices(names, weights)[0]
+            text = texts[name] if name != 'complexity' else f'Сложность {self.rnd.choice("123")}'
+            message = self.step(name, text_update(self.chat_id, text))
+
+            if name == 'ask_question' and message is not None and 'reply_markup' in message:
+                buttons = [button for row in message['reply_markup']['inline_keyboard'] for button in row]
+                self.step('answer', callback_update(self.chat_id, message, self.rnd.choice(buttons)['callback_data']))
+
+
+def percentile(sorted_values, share):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * share))]
+
+
+def latencies_to_result(latencies, timeouts, duration):
+    """
+    :param latencies: задержки успешных шагов в секундах ([float])
+    :param timeouts: кол-во шагов, на которые бот не ответил (int)
+    :param duration: длительность теста в секундах (float)
+    :return: пропускная способность и перцентили задержки в миллисекундах (map)
+    """
+    result = {'count': len(latencies), 'timeouts': timeouts, 'throughput_rps': round(len(latencies) / duration, 1)}
+    if latencies:
+        values = sorted(latencies)
+        result.update({
+            'p50_ms': round(percentile(values, 0.5) * 1000, 3),
+            'p95_ms': round(percentile(values, 0.95) * 1000, 3),
+            'p99_ms': round(percentile(values, 0.99) * 1000, 3),
+            'max_ms': round(values[-1] * 1000, 3)
+        })
+    return result
+
+
+def get_free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_bot(bot, server, mode, workers):
+    """
+    Запускает бота в отдельном потоке.
+
+    :return: функция, которая останавливает бота
+    """
+    if mode == 'webhook':
+        port = get_free_port()
+        threading.Thread(target=run_webhook, daemon=True, kwargs=dict(
+            bot=bot, webhook_url=f'http://127.0.0.1:{port}/webhook', host='127.0.0.1', port=port, path='/webhook',
+            secret_token='load-test', shards=workers)).start()
+        if not server.wait_for_webhook():
+            raise RuntimeError('Bot did not register webhook')
+        # сервер webhook останавливается вместе с процессом
+        return lambda: None
+
+    thread = threading.Thread(target=bot.polling, daemon=True,
+                              kwargs=dict(non_stop=True, interval=0, timeout=5, long_polling_timeout=1))
+    thread.start()
+
+    def stop():
+        bot.stop_polling()
+        thread.join()
+    return stop
+
+
+def get_git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    """
+    :return: результаты по каждому шагу сценария и по всем шагам вместе ([map])
+    """
+    server = FakeTelegramServer().start()
+    telebot.apihelper.API_URL = server.url + '/bot{0}/{1}'
+    # create_bot выбирает threaded по режиму работы бота
+    main.bot_mode = args.mode
+
+    question_storage = InMemoryQuestionStorage(DEFAULT_QUESTIONS) if args.questions == 'memory' \
+        else main.create_question_storage()
+    user_data_storage = InMemoryUserDataStorage() if args.storage == 'memory' else main.create_user_data_storage()
+    bot = main.create_bot(question_storage, user_data_storage)
+    stop_bot = start_bot(bot, server, args.mode, args.workers)
+
+    lock = threading.Lock()
+    latencies = defaultdict(list)
+    timeouts = defaultdict(int)
+
+    def record(step, latency):
+        with lock:
+            if latency is None:
+                timeouts[step] += 1
+            else:
+                latencies[step].append(latency)
+
+    sessions = [PlayerSession(server, first_chat_id + i, args.steps, args.think_time, args.reply_timeout, record)
+                for i in range(args.players)]
+    threads = [threading.Thread(target=session.run) for session in sessions]
+
+    started_at = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.perf_counter() - started_at
+
+    stop_bot()
+    server.stop()
+
+    results = []
+    for step in sorted(set(latencies) | set(timeouts)):
+        results.append(dict(step=step, **latencies_to_result(latencies[step], timeouts[step], duration)))
+    results.append(dict(step='total', duration_s=round(duration, 3), api_calls=dict(server.calls),
+                        webhook_retries=server.webhook_retries,
+                        **latencies_to_result([latency for values in latencies.values() for latency in values],
+                                              sum(timeouts.values()), duration)))
+    return results
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description='Нагрузочный тест бота с локальным заменителем Telegram Bot API')
+    parser.add_argument('--players', type=int, default=50, help='кол-во одновременно играющих игроков')
+    parser.add_argument('--steps', type=int, default=20, help='кол-во шагов сценария каждого игрока после /start')
+    parser.add_argument('--mode', choices=['polling', 'webhook'], default='polling',
+                        help='как бот получает обновления')
+    parser.add_argument('--workers', type=int, default=8, help='кол-во обработчиков обновлений в режиме webhook')
+    parser.add_argument('--think-time', type=float, default=0.0,
+                        help='максимальная пауза игрока между шагами в секундах')
+    parser.add_argument('--reply-timeout', type=float, default=10.0, help='сколько секунд ждать ответа бота')
+    parser.add_argument('--storage', choices=['memory', 'env'], default='memory',
+                        help='хранилище состояния: в памяти или выбранное переменными окружения, как в main.py')
+    parser.add_argument('--questions', choices=['memory', 'env'], default='memory',
+                        help='хранилище вопросов: в памяти или выбранное переменными окружения, как в main.py')
+    parser.add_argument('--output', help='файл, в который сохраняются результаты (json)')
+    args = parser.parse_args()
+
+    # отладочный лог telebot на каждый запрос к API сильно замедляет бота под нагрузкой
+    telebot.logger.setLevel(logging.WARNING)
+
+    results = run(args)
+    for result in results:
+        print(json.dumps(result, ensure_ascii=False))
+
+    if args.output is not None:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({
+                'meta': {
+                    'commit': get_git_commit(),
+                    'created_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                    'python': platform.python_version(),
+                    'platform': platform.platform(),
+                    'args': vars(args)
+                },
+                'results': results
+            }, f, ensure_ascii=False, indent=4)
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,73 @@
+"""
+Сравнение памяти, которую занимает состояние пользователей в InMemoryUserDataStorage (отдельные словари
+на каждое поле) и в CompactUserDataStorage (номер ячейки + типизированные массивы).
+
+Запуск из корня репозитория:
+
+    python -m benchmarks.memory_benchmark --users 100000 1000000
+"""
+import argparse
+import gc
+import json
+import random
+import tracemalloc
+
+from question import Question
+from user_data import InMemoryUserDataStorage, CompactUserDataStorage
+
+
+def fill_storage(storage, users_count, questions_share=0.01):
+    """
+    Заполняет хранилище синтетическими пользователями: у каждого есть победы, поражения и сложность,
+    у небольшой доли пользователей есть текущий вопрос.
+
+    :param storage: хранилище состояния (UserDataStorage)
+    :param users_count: кол-во пользователей (int)
+    :param questions_share: доля пользователей с текущим вопросом (float)
+    """
+    rnd = random.Random(42)
+    questions = [Question(f'Вопрос {i}?', ['a', 'b', 'c', 'd'], 'a') for i in range(100)]
+    for user_id in range(100000000, 100000000 + users_count):
+        for _ in range(rnd.randint(1, 3)):
+            storage.add_user_victory(user_id)
+        storage.add_user_defeat(user_id)
+        storage.set_user_complexity(user_id, rnd.choice(['1', '2', '3']))
+        if rnd.random() < questions_share:
+            storage.put_user_current_question(user_id, rnd.choice(questions))
+
+
+def measure(storage_class, users_count):
+    """
+    :return: кол-во байт, которое заняло заполненное хранилище (int)
+    """
+    gc.collect()
+    tracemalloc.start()
+    storage = storage_class()
+    fill_storage(storage, users_count)
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del storage
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Сравнение памяти, занимаемой состоянием пользователей')
+    parser.add_argument('--users', type=int, nargs='+', default=[10000, 100000])
+    args = parser.parse_args()
+
+    results = []
+    for users_count in args.users:
+        for storage_class in [InMemoryUserDataStorage, CompactUserDataStorage]:
+            size = measure(storage_class, users_count)
+            results.append({
+                'storage': storage_class.__name__,
+                'users': users_count,
+                'bytes': size,
+                'bytes_per_user': round(size / users_count, 1)
+            })
+            print(json.dumps(results[-1]))
+
+
+if __name__ == '__main__':
+    main()
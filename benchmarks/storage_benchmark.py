@@ -0,0 +1,430 @@
+"""
+Микробенчмарки хранилищ состояния пользователей, сериализации состояния и источников вопросов.
+
+Для синтетической популяции пользователей каждого размера измеряется:
+- serialization: state_to_json / json.dumps / json.loads / state_from_json для состояния целиком;
+- saver: сохранение и загрузка состояния через ToFileJsonSaver и ToRedisJsonSaver;
+- memory: память, которую занимает состояние в InMemoryUserDataStorage и CompactUserDataStorage;
+- operation: стоимость одного вызова каждого метода UserDataStorage для каждого хранилища.
+
+Отдельно (без привязки к размеру популяции) измеряется question_fetch: стоимость получения вопроса
+из AkentevQuestionStorage, CompositeQuestionStorage и PrefetchingQuestionStorage.
+
+Вместо настоящих сервисов используются локальные заменители: API вопросов поднимается на http.server
+в этом же процессе, а вместо Redis используется fakeredis (если он установлен) или локальный Redis,
+указанный в --redis-url. Если нет ни того, ни другого, бенчмарки Redis пропускаются.
+
+Результаты печатаются построчно в json и, если указан --output, сохраняются одним json-документом
+вместе с версией кода (git commit), чтобы их можно было сравнить между коммитами (benchmarks/compare.py).
+
+Запуск из корня репозитория:
+
+    python -m benchmarks.storage_benchmark --users 1000 10000 100000 --output bench.json
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from benchmarks.memory_benchmark import fill_storage, measure
+from question import Question, AkentevQuestionStorage, InMemoryQuestionStorage, CompositeQuestionStorage, \
+    PrefetchingQuestionStorage, DEFAULT_QUESTIONS
+from user_data import InMemoryUserDataStorage, CompactUserDataStorage, JsonDataStorage, ToFileJsonSaver, \
+    ToRedisJsonSaver, SegmentedFileJsonSaver, JournaledFileUserDataStorage, SqliteUserDataStorage, \
+    RedisUserDataStorage, ShardedRedisUserDataStorage, state_to_json, state_from_json
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+import redis
+
+# первый telegram-ID синтетических пользователей (как в memory_benchmark)
+first_user_id = 100000000
+
+
+def timings_to_result(timings_ns):
+    """
+    :param timings_ns: длительность каждого вызова в наносекундах ([int])
+    :return: статистика в микросекундах (map)
+    """
+    timings = sorted(timings_ns)
+    return {
+        'ops': len(timings),
+        'mean_us': round(statistics.mean(timings) / 1000, 3),
+        'median_us': round(timings[len(timings) // 2] / 1000, 3),
+        'p95_us': round(timings[min(len(timings) - 1, int(len(timings) * 0.95))] / 1000, 3),
+        'max_us': round(timings[-1] / 1000, 3)
+    }
+
+
+def time_calls(function, args_list):
+    """
+    Вызывает функцию для каждого набора аргументов и замеряет длительность каждого вызова.
+
+    :param function: функция, которую нужно измерить
+    :param args_list: аргументы для каждого вызова ([tuple])
+    :return: статистика (map, см. timings_to_result)
+    """
+    timings = []
+    for args in args_list:
+        start = time.perf_counter_ns()
+        function(*args)
+        timings.append(time.perf_counter_ns() - start)
+    return timings_to_result(timings)
+
+
+def time_repeated(function, repeat):
+    """
+    :return: статистика для repeat вызовов функции без аргументов (map, см. timings_to_result)
+    """
+    return time_calls(function, [()] * repeat)
+
+
+class RedisFactory:
+    """
+    Создаёт клиенты Redis для бенчмарков: каждый клиент работает с чистой базой.
+    """
+
+    def __init__(self, redis_url=None):
+        """
+        :param redis_url: URL локального Redis (str); если не задан, используется fakeredis
+        """
+        self.redis_url = redis_url
+        self.fake_server = fakeredis.FakeServer() if redis_url is None and fakeredis is not None else None
+
+    @property
+    def available(self):
+        return self.redis_url is not None or self.fake_server is not None
+
+    @property
+    def name(self):
+        return 'redis' if self.redis_url is not None else 'fakeredis'
+
+    def create(self, db=0):
+        """
+        :param db: номер базы Redis (int); разные номера нужны, чтобы шарды не делили одни и те же данные
+        :return: клиент Redis, база которого очищена (redis.Redis)
+        """
+        if self.redis_url is not None:
+            client = redis.from_url(self.redis_url, db=db)
+        else:
+            client = fakeredis.FakeRedis(server=self.fake_server, db=db)
+        client.flushdb()
+        return client
+
+
+def build_population(users_count):
+    """
+    :return: хранилище в памяти, заполненное users_count синтетическими пользователями (InMemoryUserDataStorage)
+    """
+    storage = InMemoryUserDataStorage()
+    fill_storage(storage, users_count)
+    return storage
+
+
+def bench_serialization(population, repeat):
+    state = state_to_json(population)
+    data = json.dumps(state, ensure_ascii=False)
+    yield 'state_to_json', time_repeated(lambda: state_to_json(population), repeat)
+    yield 'json.dumps', time_repeated(lambda: json.dumps(state, ensure_ascii=False), repeat)
+    yield 'json.loads', time_repeated(lambda: json.loads(data), repeat)
+    yield 'state_from_json', time_repeated(lambda: state_from_json(InMemoryUserDataStorage(), json.loads(data)),
+                                           repeat)
+    yield 'size_bytes', {'bytes': len(data.encode('utf-8'))}
+
+
+def bench_savers(population, repeat, work_dir, redis_factory):
+    state = state_to_json(population)
+    savers = [('ToFileJsonSaver', ToFileJsonSaver(os.path.join(work_dir, 'saver.json')))]
+    if redis_factory.available:
+        savers.append(('ToRedisJsonSaver', ToRedisJsonSaver(redis_db=redis_factory.create())))
+    for saver_name, saver in savers:
+        yield saver_name, 'save', time_repeated(lambda: saver.save_to_storage(state), repeat)
+        yield saver_name, 'load', time_repeated(saver.load_from_storage, repeat)
+
+
+def bench_memory(users_count):
+    for storage_class in [InMemoryUserDataStorage, CompactUserDataStorage]:
+        size = measure(storage_class, users_count)
+        yield storage_class.__name__, {'bytes': size, 'bytes_per_user': round(size / users_count, 1)}
+
+
+def create_backends(population, work_dir, redis_factory):
+    """
+    Создаёт все хранилища состояния, у которых измеряется стоимость операций. Хранилища, которые держат состояние
+    в памяти и сохраняют его целиком, начинают с уже сохранённой популяции, потому что стоимость сохранения
+    зависит от её размера.
+
+    :return: пары (название, фабрика хранилища) ([(str, function)])
+    """
+    state = state_to_json(population)
+
+    def json_storage(write_behind):
+        file_name = os.path.join(work_dir, f'json-{write_behind}.json')
+        saver = ToFileJsonSaver(file_name)
+        saver.save_to_storage(state)
+        return JsonDataStorage(saver, write_behind=write_behind)
+
+    def segmented_storage():
+        saver = SegmentedFileJsonSaver(os.path.join(work_dir, 'segmented'))
+        saver.save_to_storage(state)
+        return JsonDataStorage(saver)
+
+    def journaled_storage():
+        file_name = os.path.join(work_dir, 'journaled.json')
+        ToFileJsonSaver(file_name).save_to_storage(state)
+        for suffix in ['.journal', '.journal.compacting']:
+            if os.path.exists(file_name + suffix):
+                os.remove(file_name + suffix)
+        return JournaledFileUserDataStorage(file_name)
+
+    def sqlite_storage(group_commit_interval):
+        file_name = os.path.join(work_dir, f'sqlite-{group_commit_interval}.db')
+        for suffix in ['', '-wal', '-shm']:
+            if os.path.exists(file_name + suffix):
+                os.remove(file_name + suffix)
+        return SqliteUserDataStorage(file_name, group_commit_interval=group_commit_interval)
+
+    backends = [
+        ('InMemoryUserDataStorage', InMemoryUserDataStorage),
+        ('CompactUserDataStorage', CompactUserDataStorage),
+        ('JsonDataStorage', lambda: json_storage(False)),
+        ('JsonDataStorage(write_behind)', lambda: json_storage(True)),
+        ('JsonDataStorage(segmented)', segmented_storage),
+        ('JournaledFileUserDataStorage', journaled_storage),
+        ('SqliteUserDataStorage', lambda: sqlite_storage(None)),
+        ('SqliteUserDataStorage(group_commit)', lambda: sqlite_storage(0.05)),
+    ]
+    if redis_factory.available:
+        backends.append(('RedisUserDataStorage', lambda: RedisUserDataStorage(redis_db=redis_factory.create())))
+        backends.append(('ShardedRedisUserDataStorage', lambda: ShardedRedisUserDataStorage(
+            redis_clients={f'shard{i}': redis_factory.create(db=i + 1) for i in range(3)})))
+    return backends
+
+
+def bench_operations(storage, ops, active_users):
+    """
+    Измеряет стоимость каждого метода UserDataStorage на ops вызовах для случайных пользователей
+    из active_users.
+    """
+    rnd = random.Random(7)
+    questions = [Question(f'Вопрос {i}?', ['a', 'b', 'c', 'd'], 'a') for i in range(100)]
+    users = [(rnd.choice(active_users),) for _ in range(ops)]
+    # текущий вопрос можно очистить только один раз, поэтому для операций с вопросом пользователи не повторяются
+    question_users = [(user_id,) for user_id in rnd.sample(active_users, min(ops, len(active_users)))]
+
+    operations = [
+        ('put_user_current_question', storage.put_user_current_question,
+         [(user_id, rnd.choice(questions)) for (user_id,) in question_users]),
+        ('get_user_current_question', storage.get_user_current_question, question_users),
+        ('clear_user_current_question', storage.clear_user_current_question, question_users),
+        ('set_user_complexity', storage.set_user_complexity,
+         [(user_id, rnd.choice(['1', '2', '3'])) for (user_id,) in users]),
+        ('get_user_complexity', storage.get_user_complexity, users),
+        ('add_user_victory', storage.add_user_victory, users),
+        ('add_user_defeat', storage.add_user_defeat, users),
+        ('get_user_victories_count', storage.get_user_victories_count, users),
+        ('get_user_defeats_count', storage.get_user_defeats_count, users),
+        ('get_user_rank', storage.get_user_rank, users),
+        ('get_top_users', storage.get_top_users, [(10,)] * ops),
+    ]
+    for operation_name, function, args_list in operations:
+        yield operation_name, time_calls(function, args_list)
+
+
+class FakeQuestionApiHandler(BaseHTTPRequestHandler):
+    """
+    Заменитель API stepik.akentev.com: отвечает вопросом в том же формате. Если у сервера задан fail_rate,
+    то такая доля запросов завершается ошибкой 500.
+    """
+
+    def do_GET(self):
+        if random.random() < self.server.fail_rate:
+            self.send_response(500)
+            self.end_headers()
+            return
+        question = random.choice(DEFAULT_QUESTIONS)
+        body = json.dumps({
+            'question': question.question,
+            'answers': [question.correct_answer] + [answer for answer in question.answers
+                                                    if answer != question.correct_answer]
+        }, ensure_ascii=False).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_fake_question_api(fail_rate=0.0):
+    """
+    Запускает заменитель API вопросов в отдельном потоке.
+
+    :param fail_rate: доля запросов, на которые сервер отвечает ошибкой (float)
+    :return: сервер (ThreadingHTTPServer) и его адрес (str)
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeQuestionApiHandler)
+    server.daemon_threads = True
+    server.fail_rate = fail_rate
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}/api/millionaire'
+
+
+class NeverOpenBreaker:
+    """
+    Circuit breaker, который всегда пропускает запросы: нужен, чтобы измерить стоимость каждого обращения
+    к отказавшему API, а не стоимость пропуска источника.
+    """
+
+    def allow_request(self):
+        return True
+
+    def record_success(self, latency):
+        pass
+
+    def record_failure(self, latency):
+        pass
+
+    def get_health(self):
+        return {}
+
+
+def bench_question_fetch(ops):
+    server, api_url = start_fake_question_api()
+    failing_server, failing_api_url = start_fake_question_api(fail_rate=1.0)
+    local = InMemoryQuestionStorage(DEFAULT_QUESTIONS)
+    try:
+        storages = [
+            ('InMemoryQuestionStorage', local),
+            ('AkentevQuestionStorage', AkentevQuestionStorage(api_url)),
+            ('CompositeQuestionStorage', CompositeQuestionStorage([AkentevQuestionStorage(api_url), local])),
+            ('CompositeQuestionStorage(hedged)', CompositeQuestionStorage(
+                [AkentevQuestionStorage(api_url), local], hedge_delay=1.0, timeout=3.0)),
+            ('CompositeQuestionStorage(api_failing)', CompositeQuestionStorage(
+                [AkentevQuestionStorage(failing_api_url), local], breaker_factory=NeverOpenBreaker)),
+        ]
+        for storage_name, storage in storages:
+            yield storage_name, time_calls(storage.get_question, [(random.choice('123'),) for _ in range(ops)])
+
+        prefetching = PrefetchingQuestionStorage(CompositeQuestionStorage([AkentevQuestionStorage(api_url), local]))
+        try:
+            # даём фоновым потокам наполнить буферы, чтобы измерить стоимость получения готового вопроса
+            time.sleep(0.5)
+            result = time_calls(prefetching.get_question, [('1',) for _ in range(min(ops, prefetching.buffer_size))])
+            result.update(prefetching.get_stats())
+            yield 'PrefetchingQuestionStorage', result
+        finally:
+            prefetching.close()
+    finally:
+        server.shutdown()
+        failing_server.shutdown()
+
+
+def get_git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args, report):
+    redis_factory = RedisFactory(args.redis_url)
+    if not redis_factory.available:
+        print(json.dumps({'warning': 'Redis benchmarks skipped: install fakeredis or pass --redis-url'}))
+
+    work_dir = tempfile.mkdtemp(prefix='mosigobot-bench-')
+    try:
+        for users_count in args.users:
+            population = build_population(users_count)
+            active_users = list(range(first_user_id, first_user_id + min(users_count, args.active_users)))
+
+            for operation, result in bench_serialization(population, args.repeat):
+                report(benchmark='serialization', users=users_count, operation=operation, **result)
+            for saver_name, operation, result in bench_savers(population, args.repeat, work_dir, redis_factory):
+                report(benchmark='saver', users=users_count, backend=saver_name, operation=operation, **result)
+            if not args.skip_memory:
+                for storage_name, result in bench_memory(users_count):
+                    report(benchmark='memory', users=users_count, backend=storage_name, **result)
+
+            for backend_name, create_backend in create_backends(population, work_dir, redis_factory):
+                # хранилище, которое сохраняет всё состояние на каждое изменение, на больших популяциях
+                # измеряется на меньшем кол-ве операций
+                ops = args.ops if backend_name != 'JsonDataStorage' else max(3, min(args.ops, 10 ** 6 // users_count))
+                storage = create_backend()
+                try:
+                    for operation, result in bench_operations(storage, ops, active_users):
+                        report(benchmark='operation', users=users_count, backend=backend_name, operation=operation,
+                               **result)
+                finally:
+                    close = getattr(storage, 'close', None)
+                    if close is not None:
+                        close()
+            del population
+
+        if not args.skip_questions:
+            for storage_name, result in bench_question_fetch(args.question_ops):
+                report(benchmark='question_fetch', backend=storage_name, **result)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Микробенчмарки хранилищ состояния и источников вопросов')
+    parser.add_argument('--users', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='размеры синтетических популяций пользователей')
+    parser.add_argument('--ops', type=int, default=1000, help='кол-во вызовов каждого метода хранилища')
+    parser.add_argument('--active-users', type=int, default=10000,
+                        help='среди скольких пользователей выбираются пользователи для вызовов методов')
+    parser.add_argument('--repeat', type=int, default=5, help='кол-во повторов сериализации и сохранения')
+    parser.add_argument('--question-ops', type=int, default=200, help='кол-во запросов вопроса')
+    parser.add_argument('--redis-url', help='URL локального Redis вместо fakeredis (база будет очищена!)')
+    parser.add_argument('--skip-memory', action='store_true', help='не измерять память')
+    parser.add_argument('--skip-questions', action='store_true', help='не измерять получение вопросов')
+    parser.add_argument('--output', help='файл, в который сохраняются результаты (json)')
+    args = parser.parse_args()
+
+    # предупреждения CompositeQuestionStorage об отказавшем API ожидаемы и только мешают читать результаты
+    logging.basicConfig(level=logging.ERROR)
+
+    results = []
+
+    def report(**result):
+        results.append(result)
+        print(json.dumps(result, ensure_ascii=False), flush=True)
+
+    run(args, report)
+
+    if args.output is not None:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({
+                'meta': {
+                    'commit': get_git_commit(),
+                    'created_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                    'python': platform.python_version(),
+                    'platform': platform.platform(),
+                    'redis': RedisFactory(args.redis_url).name,
+                    'args': vars(args)
+                },
+                'results': results
+            }, f, ensure_ascii=False, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,337 @@
+import functools
+import inspect
+import re
+import time
+
+import telebot
+
+from telebot.types import KeyboardButton, ReplyKeyboardMarkup, InlineKeyboardMarkup, InlineKeyboardButton
+
+import metrics
+
+from message_processor import get_chat_id_to_reply, make_answer_token, parse_answer_token, MessageDispatcher
+
+# Логика обработчиков сообщений общая для синхронного (main.py) и асинхронного (async_main.py) бота.
+# Каждый обработчик - это генератор, который отдаёт (yield) результат каждого обращения к боту или хранилищам
+# и получает обратно его значение. Синхронный бот сразу возвращает значение обратно (run_sync), а асинхронный
+# сначала дожидается корутины (run_async), поэтому один и тот же код работает с обычными и async-объектами.
+
+# регулярное выражение для команды от пользователя на изменение сложности
+# вот как раз сложность "причесать" во что-то приличное пока не успела :(
+complexity_reg_exp = re.compile(r'^сложность ([123])$')
+
+# стартовое сообщение, которое выводит бот, если его спрашивают про правила или если он не понял, что от него хотят
+start_message = 'Это бот-игра в "Кто хочет стать миллионером". Скажи мне "Спроси меня вопрос", чтобы сыграть, ' \
+                'или "Покажи счёт", чтобы узнать число твоих побед и поражений. ' \
+                'Скажи "Покажи рейтинг", чтобы увидеть лучших игроков и своё место среди них. ' \
+                'Меняй сложность игры, сказав "Сложность 1", "Сложность 2" или "Сложность 3"!'
+
+# сообщение пользователю в случае внутренней ошибки бота
+internal_error_message = 'Со мной что-то не так... Попробуй сказать мне что-то другое'
+
+# сколько лучших игроков показывать в рейтинге
+leaderboard_size = 10
+
+# сколько клавиатур с вариантами ответа держать в кэше
+question_markup_cache_size = 4096
+
+
+def build_start_markup():
+    """
+    Создаёт клавиатуру с готовыми командами, которая отправляется вместе со стартовым сообщением.
+
+    :return: клавиатура (ReplyKeyboardMarkup)
+    """
+    markup = ReplyKeyboardMarkup()
+
+    markup.row(KeyboardButton('Спроси меня вопрос'), KeyboardButton('Покажи счёт'))
+    markup.row(KeyboardButton('Сложность 1'), KeyboardButton('Сложность 2'), KeyboardButton('Сложность 3'))
+    markup.row(KeyboardButton('Покажи рейтинг'), KeyboardButton('Как играть?'))
+
+    return markup
+
+
+# стартовая клавиатура не меняется, поэтому собираем и сериализуем её один раз: telebot отправляет строку с json
+# как есть, не создавая объекты клавиатуры заново
+start_markup_json = build_start_markup().to_json()
+
+
+@functools.lru_cache(maxsize=question_markup_cache_size)
+def get_question_markup_json(question_id, answers):
+    """
+    Возвращает сериализованную клавиатуру с вариантами ответа на вопрос. Клавиатуры кэшируются для каждого
+    вопроса, поэтому при повторе вопроса или популярном вопросе она не собирается заново.
+
+    В callback_data кнопки передаётся не текст ответа, а токен из ID вопроса и номера варианта ответа
+    (см. make_answer_token).
+
+    :param question_id: ID вопроса (str)
+    :param answers: варианты ответа ((str))
+    :return: клавиатура в виде json (str)
+    """
+    markup = InlineKeyboardMarkup(row_width=2)
+    buttons = [InlineKeyboardButton(answer, callback_data=make_answer_token(question_id, index))
+               for index, answer in enumerate(answers)]
+    markup.add(buttons[0], buttons[1])
+    markup.add(buttons[2], buttons[3])
+    return markup.to_json()
+
+
+def run_sync(handler_steps):
+    """
+    Выполняет обработчик-генератор, работающий с синхронными ботом и хранилищами.
+
+    :param handler_steps: генератор, который вернул обработчик (или None, если обработчика нет)
+    :return: значение, которое вернул обработчик
+    """
+    if handler_steps is None:
+        return None
+    try:
+        value = next(handler_steps)
+        while True:
+            value = handler_steps.send(value)
+    except StopIteration as e:
+        return e.value
+
+
+async def run_async(handler_steps):
+    """
+    Выполняет обработчик-генератор, работающий с асинхронными ботом и хранилищами: каждую корутину, которую
+    отдал обработчик, дожидается и передаёт обратно её результат (или ошибку).
+
+    :param handler_steps: генератор, который вернул обработчик (или None, если обработчика нет)
+    :return: значение, которое вернул обработчик
+    """
+    if handler_steps is None:
+        return None
+    try:
+        value = next(handler_steps)
+        while True:
+            if inspect.isawaitable(value):
+                try:
+                    value = await value
+                except Exception as e:
+                    value = handler_steps.throw(e)
+                    continue
+            value = handler_steps.send(value)
+    except StopIteration as e:
+        return e.value
+
+
+def measure_handler(name, handler_steps):
+    """
+    Выполняет обработчик-генератор (через yield from, поэтому работает с обоими способами выполнения)
+    и записывает в метрики время его работы и ошибку, если обработчик завершился исключением.
+
+    :param name: название обработчика (str)
+    :param handler_steps: генератор, который вернул обработчик
+    :return: значение, которое вернул обработчик
+    """
+    start = time.perf_counter()
+    try:
+        return (yield from handler_steps)
+    except Exception as e:
+        metrics.handler_errors.inc(type(e).__name__)
+        raise
+    finally:
+        metrics.handler_latency.observe(time.perf_counter() - start, name)
+
+
+def instrumented(handler):
+    """
+    Декоратор для обработчиков-генераторов: время работы каждого вызова попадает в метрики.
+    """
+    name = handler.__name__
+
+    @functools.wraps(handler)
+    def wrapper(*args, **kwargs):
+        return measure_handler(name, handler(*args, **kwargs))
+    return wrapper
+
+
+class GameHandlers:
+    """
+    Обработчики сообщений бота-игры. Все текстовые сообщения, кроме команды /start, разбираются диспетчером
+    (self.dispatcher), нажатия на кнопки с ответами обрабатывает answer_callback.
+    """
+
+    def __init__(self, bot, question_storage, user_data_storage):
+        """
+        :param bot: объект, через который отправляются сообщения: бот (TeleBot или AsyncTeleBot)
+            или очередь исходящих сообщений (OutgoingMessageQueue)
+        :param question_storage: хранилище вопросов (QuestionStorage или AsyncQuestionStorage)
+        :param user_data_storage: хранилище состояния пользователей (UserDataStorage или AsyncUserDataStorage)
+        """
+        self.bot = bot
+        self.question_storage = question_storage
+        self.user_data_storage = user_data_storage
+
+        self.dispatcher = MessageDispatcher()
+        self.dispatcher.command('что ты умеешь?', 'как играть?')(self.start_handler)
+        self.dispatcher.command('привет', 'привет!')(self.hello_handler)
+        self.dispatcher.pattern(complexity_reg_exp)(self.complexity_handler)
+        self.dispatcher.command('спроси меня вопрос')(self.ask_question_handler)
+        self.dispatcher.command('покажи счёт')(self.scores_handler)
+        self.dispatcher.command('покажи рейтинг')(self.leaderboard_handler)
+        self.dispatcher.default(self.default_handler)
+
+    def send_message_about_internal_exception(self, user_id, e):
+        """
+        Отправляет сообщение о том, что случилась внутренняя ошибка в логике работы бота.
+
+        :param user_id: telegramID пользователя (int)
+        :param e: объект случившейся ошибки (Exception)
+        """
+        telebot.logger.error(e)
+        metrics.handler_errors.inc(type(e).__name__)
+        yield self.bot.send_message(user_id, internal_error_message)
+
+    def send_start_message(self, user_id):
+        """
+        Отправляет сообщение, в котором описываются возможности бота. Также отправляется клавиатура
+        с готовыми командами.
+
+        :param user_id: telegramID пользователя (int)
+        """
+        yield self.bot.send_message(user_id, start_message, reply_markup=start_markup_json)
+
+    def send_message_with_question(self, user_id, question, prefix=''):
+        """
+        Отправляет сообщение с вопросом для пользователя.
+
+        :param user_id: telegramID пользователя (int)
+        :param question: вопрос, который задаётся (Question)
+        :param prefix: текст, который добавляется перед текстом вопроса (str)
+        """
+        markup_json = get_question_markup_json(question.id, tuple(question.answers))
+
+        message = f'{prefix}{question.question}'
+        yield self.bot.send_message(user_id, message, reply_markup=markup_json)
+
+    def dispatch(self, message):
+        """
+        Возвращает обработчик-генератор для текстового сообщения.
+
+        :param message: сообщение от пользователя (telebot.types.Message)
+        """
+        return self.dispatcher.dispatch(message)
+
+    @instrumented
+    def start(self, message):
+        yield from self.send_start_message(get_chat_id_to_reply(message))
+
+    @instrumented
+    def start_handler(self, message):
+        yield from self.send_start_message(get_chat_id_to_reply(message))
+
+    @instrumented
+    def hello_handler(self, message):
+        yield self.bot.send_message(get_chat_id_to_reply(message), 'Ну привет!')
+
+    @instrumented
+    def complexity_handler(self, message, m):
+        user_id = get_chat_id_to_reply(message)
+        try:
+            complexity = m.group(1)
+            yield self.user_data_storage.set_user_complexity(user_id, complexity)
+
+            yield self.bot.send_message(user_id, f'Изменил сложность игры на {complexity} из 3!')
+        except Exception as e:
+            yield from self.send_message_about_internal_exception(user_id, e)
+
+    @instrumented
+    def ask_question_handler(self, message):
+        user_id = get_chat_id_to_reply(message)
+        try:
+            question = yield self.user_data_storage.get_user_current_question(user_id)
+            if question is None:
+                complexity = yield self.user_data_storage.get_user_complexity(user_id)
+                question = yield self.question_storage.get_question(complexity, user_id)
+                yield self.user_data_storage.put_user_current_question(user_id, question)
+                yield from self.send_message_with_question(user_id, question)
+            else:
+                yield from self.send_message_with_question(
+                    user_id, question, prefix='Ты пока не ответил на предыдущий вопрос. Повторю его для тебя!\n\n')
+        except Exception as e:
+            yield from self.send_message_about_internal_exception(user_id, e)
+
+    @instrumented
+    def scores_handler(self, message):
+        user_id = get_chat_id_to_reply(message)
+        try:
+            victories = yield self.user_data_storage.get_user_victories_count(user_id)
+            defeats = yield self.user_data_storage.get_user_defeats_count(user_id)
+            yield self.bot.send_message(user_id, f'Побед: {victories}, поражений: {defeats}')
+        except Exception as e:
+            yield from self.send_message_about_internal_exception(user_id, e)
+
+    @instrumented
+    def leaderboard_handler(self, message):
+        user_id = get_chat_id_to_reply(message)
+        try:
+            top = yield self.user_data_storage.get_top_users(leaderboard_size)
+            rank = yield self.user_data_storage.get_user_rank(user_id)
+            victories = yield self.user_data_storage.get_user_victories_count(user_id)
+
+            lines = []
+            place = 0
+            for i, (top_user_id, top_victories) in enumerate(top):
+                # игроки с одинаковым кол-вом побед делят место, как и в get_user_rank
+                if i == 0 or top_victories != top[i - 1][1]:
+                    place = i + 1
+                name = 'Ты' if top_user_id == user_id else f'Игрок {top_user_id}'
+                lines.append(f'{place}. {name} - побед: {top_victories}')
+            if not lines:
+                lines.append('Пока никто не побеждал. Стань первым!')
+            lines.append('')
+            lines.append(f'Твоё место: {rank}, побед: {victories}')
+            yield self.bot.send_message(user_id, '\n'.join(lines))
+        except Exception as e:
+            yield from self.send_message_about_internal_exception(user_id, e)
+
+    @instrumented
+    def answer_callback(self, callback):
+        user_id = get_chat_id_to_reply(callback)
+        try:
+            question_id, answer_index = parse_answer_token(callback.data)
+
+            question = yield self.user_data_storage.get_user_current_question(user_id)
+            if question is not None:
+                if question_id is None:
+                    # кнопки сообщений, отправленных до появления токенов, содержат сам текст ответа
+                    answer_index = question.find_answer(callback.data)
+                elif question_id != question.id or answer_index >= len(question.answers):
+                    answer_index = None
+
+                if answer_index is not None:
+                    if answer_index == question.correct_index:
+                        yield self.bot.send_message(user_id, '👍 Правильно!')
+                        yield self.user_data_storage.add_user_victory(user_id)
+                    else:
+                        yield self.bot.send_message(
+                            user_id, f'😔 Неправильно. Верный ответ был "{question.correct_answer}"')
+                        yield self.user_data_storage.add_user_defeat(user_id)
+
+                    yield self.user_data_storage.clear_user_current_question(user_id)
+                else:
+                    yield from self.send_message_with_question(
+                        user_id, question,
+                        prefix='Ты отвечаешь не на последний вопрос! Могу засчитать за неверный '
+                               'ответ, но, может, всё же ответишь как нужно?\n\n')
+            else:
+                yield self.bot.send_message(
+                    user_id, 'На этот вопрос ты уже отвечал или время на ответ вышло! Попроси меня задать новый')
+        except Exception as e:
+            yield from self.send_message_about_internal_exception(user_id, e)
+
+    @instrumented
+    def default_handler(self, message):
+        user_id = get_chat_id_to_reply(message)
+        try:
+            question = yield self.user_data_storage.get_user_current_question(user_id)
+            if question is not None:
+                yield self.bot.send_message(user_id, 'Нажми на кнопку ответа, который считаешь верным')
+            else:
+                yield from self.send_start_message(user_id)
+        except Exception as e:
+            yield from self.send_message_about_internal_exception(user_id, e)
@@ -0,0 +1,233 @@
+import bisect
+import heapq
+import itertools
+
+
+class FenwickTree:
+    """
+    Дерево Фенвика: хранит массив счётчиков и позволяет за O(log n) изменить счётчик и посчитать сумму
+    счётчиков на префиксе массива.
+    """
+
+    def __init__(self, size):
+        """
+        :param size: кол-во счётчиков (int)
+        """
+        self.tree = [0] * (size + 1)
+
+    def __len__(self):
+        return len(self.tree) - 1
+
+    def add(self, index, delta):
+        """
+        Прибавляет delta к счётчику с номером index (нумерация с 0).
+        """
+        i = index + 1
+        while i < len(self.tree):
+            self.tree[i] += delta
+            i += i & -i
+
+    def prefix_sum(self, index):
+        """
+        :return: сумма счётчиков с номерами от 0 до index включительно (int)
+        """
+        result = 0
+        i = min(index + 1, len(self.tree) - 1)
+        while i > 0:
+            result += self.tree[i]
+            i -= i & -i
+        return result
+
+
+class InMemoryLeaderboard:
+    """
+    Рейтинг игроков по кол-ву побед, который обновляется при каждой победе, а не пересчитывается целиком.
+    Для каждого кол-ва побед хранится множество игроков с таким счётом, а дерево Фенвика по кол-ву побед позволяет
+    за O(log n) узнать, сколько игроков набрали больше побед, то есть место игрока. Игроки без побед в рейтинге
+    не хранятся и делят последнее место.
+
+    Игроки с одинаковым кол-вом побед делят место, поэтому в списке лучших они перечисляются в том порядке,
+    в котором набрали это кол-во побед: так список строится за O(count), даже если почти у всех игроков одинаковый
+    счёт.
+    """
+
+    def __init__(self, capacity=64):
+        """
+        :param capacity: начальное максимальное кол-во побед, которое помещается в дерево (int)
+        """
+        self.counts = FenwickTree(capacity)
+        self.players = {}
+        # отсортированный список различных кол-в побед и игроки с каждым кол-вом побед (словарь используется
+        # как множество, которое помнит порядок добавления)
+        self.scores = []
+        self.buckets = {}
+
+    @classmethod
+    def from_scores(cls, scores):
+        """
+        Строит рейтинг по готовому кол-ву побед каждого игрока.
+
+        :param scores: кол-во побед для каждого игрока ({int: int})
+        :return: рейтинг (InMemoryLeaderboard)
+        """
+        leaderboard = cls(capacity=max(scores.values(), default=0) + 1)
+        for user_id, score in scores.items():
+            leaderboard.set_score(user_id, score)
+        return leaderboard
+
+    def __grow(self, score):
+        capacity = len(self.counts)
+        while capacity <= score:
+            capacity *= 2
+        self.counts = FenwickTree(capacity)
+        for bucket_score, bucket in self.buckets.items():
+            self.counts.add(bucket_score, len(bucket))
+
+    def set_score(self, user_id, score):
+        """
+        Запоминает новое кол-во побед игрока.
+
+        :param user_id: telegram-ID игрока (int)
+        :param score: кол-во побед (int)
+        """
+        old_score = self.players.pop(user_id, 0)
+        if old_score > 0:
+            bucket = self.buckets[old_score]
+            del bucket[user_id]
+            if not bucket:
+                del self.buckets[old_score]
+                self.scores.pop(bisect.bisect_left(self.scores, old_score))
+            self.counts.add(old_score, -1)
+
+        if score > 0:
+            if score >= len(self.counts):
+                self.__grow(score)
+            self.players[user_id] = score
+            if score not in self.buckets:
+                self.buckets[score] = {}
+                bisect.insort(self.scores, score)
+            self.buckets[score][user_id] = None
+            self.counts.add(score, 1)
+
+    def count_better(self, score):
+        """
+        :param score: кол-во побед (int)
+        :return: кол-во игроков, у которых побед больше (int)
+        """
+        return len(self.players) - self.counts.prefix_sum(score)
+
+    def get_rank(self, user_id):
+        """
+        :param user_id: telegram-ID игрока (int)
+        :return: место игрока в рейтинге, начиная с 1; игроки с одинаковым кол-вом побед делят место (int)
+        """
+        return 1 + self.count_better(self.players.get(user_id, 0))
+
+    def get_top(self, count):
+        """
+        :param count: кол-во игроков (int)
+        :return: лучшие игроки и их кол-во побед, от большего к меньшему ([(int, int)])
+        """
+        result = []
+        for score in reversed(self.scores):
+            if len(result) >= count:
+                break
+            for user_id in itertools.islice(self.buckets[score], count - len(result)):
+                result.append((user_id, score))
+        return result
+
+
+class CompactLeaderboard:
+    """
+    Рейтинг игроков для CompactUserDataStorage, в котором нет объектов Python на каждого игрока: кол-во побед
+    игроков хранит само хранилище, а рейтинг - только дерево Фенвика с кол-вом игроков для каждого кол-ва побед
+    и top_size лучших игроков. Место игрока считается по его кол-ву побед за O(log n).
+
+    Кол-во побед игрока в работе только растёт, поэтому лучших игроков достаточно сравнивать с худшим из них:
+    игрок, который его обогнал, занимает его место. Больше top_size лучших игроков рейтинг не знает.
+    """
+
+    def __init__(self, capacity=64, top_size=100):
+        """
+        :param capacity: начальное максимальное кол-во побед, которое помещается в дерево (int)
+        :param top_size: сколько лучших игроков помнить (int)
+        """
+        self.counts = FenwickTree(capacity)
+        self.players_count = 0
+        self.top_size = top_size
+        # лучшие игроки и их кол-во побед, а также худший из них: (кол-во побед, -telegram-ID) или None
+        self.top = {}
+        self.top_threshold = None
+
+    @classmethod
+    def from_scores(cls, scores, top_size=100):
+        """
+        Строит рейтинг по готовому кол-ву побед каждого игрока.
+
+        :param scores: пары (telegram-ID, кол-во побед) (iterable)
+        :param top_size: сколько лучших игроков помнить (int)
+        :return: рейтинг (CompactLeaderboard)
+        """
+        leaderboard = cls(top_size=top_size)
+        for user_id, score in scores:
+            leaderboard.change_score(user_id, 0, score)
+        return leaderboard
+
+    def __grow(self, score):
+        capacity = len(self.counts)
+        while capacity <= score:
+            capacity *= 2
+        counts = FenwickTree(capacity)
+        for bucket_score in range(len(self.counts)):
+            bucket_count = self.counts.prefix_sum(bucket_score) - self.counts.prefix_sum(bucket_score - 1)
+            if bucket_count:
+                counts.add(bucket_score, bucket_count)
+        self.counts = counts
+
+    def change_score(self, user_id, old_score, score):
+        """
+        Запоминает новое кол-во побед игрока; новое кол-во побед не меньше старого.
+
+        :param user_id: telegram-ID игрока (int)
+        :param old_score: прежнее кол-во побед (int)
+        :param score: новое кол-во побед (int)
+        """
+        if old_score > 0:
+            self.counts.add(old_score, -1)
+            self.players_count -= 1
+        if score <= 0:
+            return
+        if score >= len(self.counts):
+            self.__grow(score)
+        self.counts.add(score, 1)
+        self.players_count += 1
+
+        key = (score, -user_id)
+        if user_id in self.top:
+            self.top[user_id] = score
+            # худший из лучших игроков изменился, только если выиграл он сам
+            if self.top_threshold[1] != -user_id:
+                return
+        elif len(self.top) < self.top_size:
+            self.top[user_id] = score
+        elif key > self.top_threshold:
+            del self.top[-self.top_threshold[1]]
+            self.top[user_id] = score
+        else:
+            return
+        self.top_threshold = min((top_score, -top_user_id) for top_user_id, top_score in self.top.items())
+
+    def get_rank(self, score):
+        """
+        :param score: кол-во побед игрока (int)
+        :return: место игрока в рейтинге, начиная с 1; игроки с одинаковым кол-вом побед делят место (int)
+        """
+        return 1 + self.players_count - self.counts.prefix_sum(score)
+
+    def get_top(self, count):
+        """
+        :param count: кол-во игроков, не больше top_size (int)
+        :return: лучшие игроки и их кол-во побед, от большего к меньшему ([(int, int)])
+        """
+        best = heapq.nsmallest(count, ((-score, user_id) for user_id, score in self.top.items()))
+        return [(user_id, -score) for score, user_id in best]
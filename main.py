@@ -1,202 +1,241 @@
+import atexit
 import os
+import signal
 
 import telebot
-import re
 import logging
 
-from telebot.types import KeyboardButton, ReplyKeyboardMarkup, InlineKeyboardMarkup, InlineKeyboardButton
-
-from message_processor import get_unified_user_message, get_chat_id_to_reply, unify_message, is_user_try_answer
-from question import CompositeQuestionStorage, AkentevQuestionStorage, InMemoryQuestionStorage, DEFAULT_QUESTIONS
-from user_data import JsonDataStorage, ToFileJsonSaver, ToRedisJsonSaver
-
-token = '1621053959:AAH0OF1Yh6mLDNZW1DahCbTl1KYN77DP9Iw'
-
-bot = telebot.TeleBot(token)
+from handlers import GameHandlers, run_sync
+from metrics import start_metrics_server, start_metrics_log
+from outgoing import OutgoingMessageQueue
+from question import CompositeQuestionStorage, AkentevQuestionStorage, InMemoryQuestionStorage, \
+    PrefetchingQuestionStorage, SqliteQuestionStorage, DEFAULT_QUESTIONS
+from webhook import run_webhook
+from user_data import JsonDataStorage, ToFileJsonSaver, JournaledFileUserDataStorage, RedisUserDataStorage, \
+    InMemoryUserDataStorage, CompactUserDataStorage, SqliteUserDataStorage, ShardedRedisUserDataStorage, \
+    LazyUserDataStorage, UserRecordStore, SegmentedFileJsonSaver, start_question_expiry
+
+# токен бота; для нагрузочного тестирования его можно подменить через переменную окружения BOT_TOKEN
+token = os.environ.get('BOT_TOKEN', '1621053959:AAH0OF1Yh6mLDNZW1DahCbTl1KYN77DP9Iw')
+
+# если задан TELEGRAM_API_URL, то бот обращается не к api.telegram.org, а к указанному серверу
+# (например, к локальному заменителю Bot API из benchmarks/fake_telegram.py)
+telegram_api_url = os.environ.get('TELEGRAM_API_URL')
+if telegram_api_url is not None:
+    telebot.apihelper.API_URL = telegram_api_url.rstrip('/') + '/bot{0}/{1}'
+
+# режим работы бота: по умолчанию бот сам опрашивает Telegram (long polling), а при BOT_MODE=webhook
+# Telegram присылает обновления на наш HTTP-сервер
+bot_mode = os.environ.get('BOT_MODE', 'polling')
 
 # добавляем логирование уровня DEBUG от telebot
 telebot.logger.setLevel(logging.DEBUG)
 
-# регулярное выражение для команды от пользователя на изменение сложности
-# вот как раз сложность "причесать" во что-то приличное пока не успела :(
-complexity_reg_exp = r'^сложность ([123])$'
-
-# стартовое сообщение, которое выводит бот, если его спрашивают про правила или если он не понял, что от него хотят
-start_message = 'Это бот-игра в "Кто хочет стать миллионером". Скажи мне "Спроси меня вопрос", чтобы сыграть, ' \
-                'или "Покажи счёт", чтобы узнать число твоих побед и поражений. ' \
-                'Меняй сложность игры, сказав "Сложность 1", "Сложность 2" или "Сложность 3"!'
-
-# сообщение пользователю в случае внутренней ошибки бота
-internal_error_message = 'Со мной что-то не так... Попробуй сказать мне что-то другое'
-
-# хранилище вопросов для игры, которое использует наш бот: сначала пытаемся получить вопрос через API,
-# если это не получилось (произошла ошибка или API вернуло статус, отличный от 200), то берём вопрос из памяти
-question_storage = CompositeQuestionStorage(
-    [
-        AkentevQuestionStorage(),
-        InMemoryQuestionStorage(DEFAULT_QUESTIONS)
-    ]
-)
-
-# по умолчанию храним состояние в файле storage.json в текущей директории
-json_saver = ToFileJsonSaver('storage.json')
-redis_url = os.environ.get('REDIS_URL')
-# если переменная окружения REDIS_URL была задана, то будем хранить состояние в Redis
-if redis_url is not None:
-    json_saver = ToRedisJsonSaver(redis_url)
-# итоговый объект для сохранения состояния по каждому пользователю
-user_data_storage = JsonDataStorage(json_saver)
-
-
-def send_message_about_internal_exception(bot, user_id, e):
-    """
-    Отправляет сообщение о том, что случилась внутренняя ошибка в логике работы бота.
 
-    :param bot: объект бота (TeleBot)
-    :param user_id: telegramID пользователя (int)
-    :param e: объект случившейся ошибки (Exception)
+def create_question_storage():
     """
-    telebot.logger.error(e)
-    bot.send_message(user_id, internal_error_message)
+    Создаёт хранилище вопросов для игры, которое использует наш бот: сначала пытаемся получить вопрос через API,
+    если это не получилось (произошла ошибка или API вернуло статус, отличный от 200), то берём вопрос из памяти
+    (или из локальной базы вопросов, если в QUESTION_BANK указан путь к ней);
+    если API не ответило за секунду, параллельно берём вопрос из памяти, а дольше трёх секунд вопрос не ждём;
+    вопросы API запрашиваются заранее в фоне, чтобы пользователю не приходилось ждать ответа API.
 
+    Заранее запрашиваются только вопросы API: такие вопросы ещё ни к кому не привязаны, а локальное хранилище
+    отвечает сразу и получает ID пользователя, поэтому база вопросов не повторяет пользователю вопросы, которые
+    сама ему задавала. Вопросы API база не видит, и они могут повторяться.
 
-def send_start_message(bot, user_id):
+    :return: хранилище вопросов (QuestionStorage)
     """
-    Отправляет сообщение, в котором описываются возможности бота. Также отправляется клавиатура
-    с готовыми командами.
-
-    :param bot: объект бота (TeleBot)
-    :param user_id: telegramID пользователя (int)
+    # базу вопросов создаёт команда python -m question build-bank <файл с вопросами> <файл базы>
+    question_bank_file = os.environ.get('QUESTION_BANK')
+    local_question_storage = InMemoryQuestionStorage(DEFAULT_QUESTIONS) if question_bank_file is None \
+        else SqliteQuestionStorage(question_bank_file)
+
+    # при QUESTION_SOURCE=local вопросы берутся только из локального хранилища, без обращения к API
+    if os.environ.get('QUESTION_SOURCE') == 'local':
+        return local_question_storage
+    return CompositeQuestionStorage(
+        [
+            PrefetchingQuestionStorage(AkentevQuestionStorage()),
+            local_question_storage
+        ],
+        hedge_delay=1.0,
+        timeout=3.0
+    )
+
+
+def get_question_ttl():
     """
-    markup = ReplyKeyboardMarkup()
-
-    markup.row(KeyboardButton('Спроси меня вопрос'), KeyboardButton('Покажи счёт'))
-    markup.row(KeyboardButton('Сложность 1'), KeyboardButton('Сложность 2'), KeyboardButton('Сложность 3'))
-    markup.row(KeyboardButton('Как играть?'))
-
-    bot.send_message(user_id, start_message, reply_markup=markup)
+    :return: сколько секунд пользователь может отвечать на вопрос (QUESTION_TTL), или None, если время
+        не ограничено (float)
+    """
+    question_ttl = os.environ.get('QUESTION_TTL')
+    return float(question_ttl) if question_ttl else None
 
 
-def send_message_with_question(bot, user_id, question, prefix=''):
+def create_user_data_storage():
     """
-    Отправляет сообщение с вопросом для пользователя.
+    Создаёт хранилище состояния пользователей, выбранное переменными окружения.
 
-    :param bot: объект бота (TeleBot)
-    :param user_id: telegramID пользователя (int)
-    :param question: вопрос, который задаётся (Question)
-    :param prefix: текст, который добавляется перед текстом вопроса (str)
+    :return: хранилище состояния пользователей (UserDataStorage)
     """
-    markup = InlineKeyboardMarkup(row_width=2)
-    [val1, val2, val3, val4] = question.answers
-    markup.add(InlineKeyboardButton(val1, callback_data=val1), InlineKeyboardButton(val2, callback_data=val2))
-    markup.add(InlineKeyboardButton(val3, callback_data=val3), InlineKeyboardButton(val4, callback_data=val4))
-
-    message = f'{prefix}{question.question}'
-    bot.send_message(user_id, message, reply_markup=markup)
-
-
-@bot.message_handler(commands=['start'])
-@bot.message_handler(
-    func=lambda message: get_unified_user_message(message) in ['что ты умеешь?', 'как играть?'])
-def start(message):
-    send_start_message(bot, get_chat_id_to_reply(message))
-
+    user_data_storage = create_backing_user_data_storage()
+
+    # при STORAGE_LAZY_USERS=N состояние пользователя загружается из Redis или SQLite при первом обращении,
+    # в памяти держатся не больше N недавно активных пользователей, а изменения записываются раз в секунду
+    # и при вытеснении пользователя; файловые хранилища так не умеют и используются как есть (с предупреждением)
+    lazy_users = os.environ.get('STORAGE_LAZY_USERS')
+    if lazy_users is not None:
+        if isinstance(user_data_storage, UserRecordStore):
+            user_data_storage = LazyUserDataStorage(user_data_storage, max_users=int(lazy_users),
+                                                    flush_interval=1.0)
+            atexit.register(user_data_storage.close)
+        else:
+            logging.warning(f'STORAGE_LAZY_USERS не поддерживается хранилищем {type(user_data_storage).__name__} '
+                            f'и не используется: все пользователи загружаются при старте. Для ленивой загрузки '
+                            f'укажите REDIS_URL, REDIS_URLS или STORAGE_BACKEND=sqlite')
+
+    # при QUESTION_TTL=N вопрос, на который пользователь не ответил за N секунд, удаляется фоновым потоком
+    # (в SQLite время на ответ не ограничивается)
+    question_ttl = get_question_ttl()
+    if question_ttl is not None:
+        start_question_expiry(user_data_storage, interval=min(60.0, question_ttl))
+    return user_data_storage
+
+
+def create_backing_user_data_storage():
+    # при STORAGE_COMPACT=1 состояние пользователей в памяти хранится в компактном виде (для миллионов пользователей)
+    in_memory_storage_class = CompactUserDataStorage if os.environ.get('STORAGE_COMPACT') == '1' \
+        else InMemoryUserDataStorage
+    question_ttl = get_question_ttl()
+
+    redis_url = os.environ.get('REDIS_URL')
+    redis_urls = os.environ.get('REDIS_URLS')
+    # если в REDIS_URLS через запятую перечислены несколько Redis, то распределяем пользователей между ними;
+    # если список изменился с прошлого запуска, то до начала работы переносим пользователей, сменивших шард
+    # (остальные экземпляры бота при этом ждут; экземпляры со старым списком нужно остановить заранее)
+    if redis_urls is not None:
+        user_data_storage = ShardedRedisUserDataStorage(redis_urls.split(','), question_ttl=question_ttl)
+        user_data_storage.rebalance()
+        return user_data_storage
+    # если переменная окружения REDIS_URL была задана, то храним состояние каждого пользователя в отдельном хэше
+    # Redis; состояние, сохранённое раньше одним json-документом, при первом запуске переносится в новый формат.
+    # С одним Redis (или одним набором REDIS_URLS) могут одновременно работать несколько экземпляров бота
+    if redis_url is not None:
+        user_data_storage = RedisUserDataStorage(redis_url, question_ttl=question_ttl)
+        user_data_storage.migrate_from_json_blob()
+        return user_data_storage
+    # STORAGE_BACKEND=sqlite: храним состояние в базе SQLite storage.db, фиксируя изменения пачками раз в 50 мс
+    if os.environ.get('STORAGE_BACKEND') == 'sqlite':
+        user_data_storage = SqliteUserDataStorage('storage.db', group_commit_interval=0.05)
+    # STORAGE_BACKEND=segmented: храним состояние в директории storage, разбитым на сегменты по диапазонам
+    # telegram-ID, и в фоновом потоке перезаписываем только сегменты изменившихся пользователей;
+    # состояние из storage.json при первом запуске переносится в сегменты
+    elif os.environ.get('STORAGE_BACKEND') == 'segmented':
+        saver = SegmentedFileJsonSaver('storage')
+        saver.migrate_from_file('storage.json')
+        user_data_storage = JsonDataStorage(saver, write_behind=True,
+                                            in_memory_storage=in_memory_storage_class(question_ttl=question_ttl))
+    # STORAGE_BACKEND=json: храним состояние в файле storage.json целиком, сохраняя его в фоновом потоке
+    elif os.environ.get('STORAGE_BACKEND') == 'json':
+        user_data_storage = JsonDataStorage(ToFileJsonSaver('storage.json'), write_behind=True,
+                                            in_memory_storage=in_memory_storage_class(question_ttl=question_ttl))
+    # иначе храним состояние в файле storage.json в текущей директории, а изменения дописываем в журнал рядом с ним
+    else:
+        user_data_storage = JournaledFileUserDataStorage(
+            'storage.json', in_memory_storage=in_memory_storage_class(question_ttl=question_ttl))
+    atexit.register(user_data_storage.close)
+    return user_data_storage
+
+
+def create_bot(question_storage, user_data_storage):
+    """
+    Создаёт бота и регистрирует в нём обработчики сообщений.
 
-@bot.message_handler(
-    func=lambda message: get_unified_user_message(message) in ['что ты умеешь?', 'как играть?'])
-def start_handler(message):
-    send_start_message(bot, get_chat_id_to_reply(message))
+    :param question_storage: хранилище вопросов (QuestionStorage)
+    :param user_data_storage: хранилище состояния пользователей (UserDataStorage)
+    :return: бот (TeleBot)
+    """
+    # в режиме webhook обновления распределяются по обработчикам нашим пулом (с сохранением порядка для каждого
+    # пользователя), поэтому собственный пул потоков telebot не нужен
+    bot = telebot.TeleBot(token, threaded=bot_mode != 'webhook')
 
+    # обработчики не ждут ответа Telegram: сообщения ставятся в очередь, и фоновые потоки отправляют их с учётом
+    # ограничений Telegram на частоту отправки (всего 30 сообщений в секунду, в один чат - примерно одно в секунду)
+    outgoing = OutgoingMessageQueue(
+        bot,
+        workers=int(os.environ.get('OUTGOING_WORKERS', 4)),
+        global_rate=float(os.environ.get('OUTGOING_GLOBAL_RATE', 30)),
+        chat_rate=float(os.environ.get('OUTGOING_CHAT_RATE', 1))
+    )
+    atexit.register(outgoing.close, timeout=10)
 
-@bot.message_handler(
-    func=lambda message: get_unified_user_message(message) in ['привет', 'привет!', 'привет'])
-def hello_handler(message):
-    bot.send_message(get_chat_id_to_reply(message), 'Ну привет!')
+    # обработчики сообщений; сама логика общая с асинхронной версией бота (async_main.py) и лежит в handlers.py
+    handlers = GameHandlers(outgoing, question_storage, user_data_storage)
 
+    @bot.message_handler(commands=['start'])
+    def start(message):
+        run_sync(handlers.start(message))
 
-@bot.message_handler(
-    func=lambda message: re.match(complexity_reg_exp, get_unified_user_message(message)))
-def complexity_handler(message):
-    user_id = get_chat_id_to_reply(message)
-    try:
-        m = re.match(complexity_reg_exp, get_unified_user_message(message))
-        if m:
-            complexity = m.group(1)
-            user_data_storage.set_user_complexity(user_id, complexity)
+    @bot.callback_query_handler(func=lambda call: True)
+    def answer_callback(callback):
+        run_sync(handlers.answer_callback(callback))
 
-            bot.send_message(user_id, f'Изменил сложность игры на {complexity} из 3!')
-    except Exception as e:
-        send_message_about_internal_exception(bot, user_id, e)
+    # все текстовые сообщения, кроме команды /start, разбираются одним диспетчером
+    @bot.message_handler(func=lambda message: True)
+    def text_message_handler(message):
+        run_sync(handlers.dispatch(message))
 
+    return bot
 
-@bot.message_handler(
-    func=lambda message: get_unified_user_message(message) == 'спроси меня вопрос')
-def ask_question_handler(message):
-    user_id = get_chat_id_to_reply(message)
-    try:
-        question = user_data_storage.get_user_current_question(user_id)
-        if question is None:
-            complexity = user_data_storage.get_user_complexity(user_id)
-            question = question_storage.get_question(complexity)
-            user_data_storage.put_user_current_question(user_id, question)
-            send_message_with_question(bot, user_id, question)
-        else:
-            send_message_with_question(bot, user_id, question,
-                                       prefix='Ты пока не ответил на предыдущий вопрос. Повторю его для тебя!\n\n')
-    except Exception as e:
-        send_message_about_internal_exception(bot, user_id, e)
 
+def exit_on_sigterm():
+    """
+    Heroku (как и большинство супервизоров) останавливает бота сигналом SIGTERM, а при нём, в отличие от обычного
+    завершения, обработчики atexit не вызываются, и всё, что хранилища копят в памяти (изменения write-behind,
+    несохранённые пользователи ленивого хранилища, незафиксированная пачка SQLite), и неотправленные сообщения
+    теряются. Поэтому SIGTERM превращается в SystemExit в главном потоке: polling или webhook-сервер прерывается,
+    и бот завершается так же, как при обычном выходе - сначала отправляется очередь исходящих сообщений,
+    затем закрываются хранилища (atexit вызывает их в порядке, обратном регистрации).
+    """
+    def handle_sigterm(signum, frame):
+        # повторный SIGTERM не должен прервать сохранение состояния
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        logging.info('Получен SIGTERM: бот останавливается')
+        raise SystemExit(0)
 
-@bot.message_handler(
-    func=lambda message: get_unified_user_message(message) in ['покажи счёт'])
-def scores_handler(message):
-    user_id = get_chat_id_to_reply(message)
-    try:
-        victories = user_data_storage.get_user_victories_count(user_id)
-        defeats = user_data_storage.get_user_defeats_count(user_id)
-        bot.send_message(user_id, f'Побед: {victories}, поражений: {defeats}')
-    except Exception as e:
-        send_message_about_internal_exception(bot, user_id, e)
+    signal.signal(signal.SIGTERM, handle_sigterm)
 
 
-@bot.callback_query_handler(func=lambda call: True)
-def answer_callback(callback):
-    user_id = get_chat_id_to_reply(callback)
-    try:
-        user_message = unify_message(callback.data)
-
-        question = user_data_storage.get_user_current_question(user_id)
-        if question is not None:
-            if is_user_try_answer(user_message, question.answers):
-                if user_message == unify_message(question.correct_answer):
-                    bot.send_message(user_id, '👍 Правильно!')
-                    user_data_storage.add_user_victory(user_id)
-                else:
-                    bot.send_message(user_id, f'😔 Неправильно. Верный ответ был "{question.correct_answer}"')
-                    user_data_storage.add_user_defeat(user_id)
-
-                user_data_storage.clear_user_current_question(user_id)
-            else:
-                send_message_with_question(bot, user_id, question,
-                                           prefix='Ты отвечаешь не на последний вопрос! Могу засчитать за неверный '
-                                                  'ответ, но, может, всё же ответишь как нужно?\n\n')
-        else:
-            bot.send_message(user_id, 'На этот вопрос ты уже отвечал! Попроси меня задать новый')
-    except Exception as e:
-        send_message_about_internal_exception(bot, user_id, e)
+def main():
+    exit_on_sigterm()
+    bot = create_bot(create_question_storage(), create_user_data_storage())
 
+    # метрики отдаются в формате Prometheus на http://<хост>:METRICS_PORT/metrics и раз в METRICS_LOG_INTERVAL
+    # секунд (по умолчанию раз в минуту; 0 - никогда) пишутся в лог
+    if os.environ.get('METRICS_PORT'):
+        start_metrics_server(int(os.environ['METRICS_PORT']))
+    metrics_log_interval = float(os.environ.get('METRICS_LOG_INTERVAL', 60))
+    if metrics_log_interval > 0:
+        start_metrics_log(metrics_log_interval)
 
-@bot.message_handler(func=lambda message: True)
-def default_handler(message):
-    user_id = get_chat_id_to_reply(message)
     try:
-        question = user_data_storage.get_user_current_question(user_id)
-        if question is not None:
-            bot.send_message(user_id, 'Нажми на кнопку ответа, который считаешь верным')
+        if bot_mode == 'webhook':
+            run_webhook(
+                bot,
+                os.environ['WEBHOOK_URL'],
+                port=int(os.environ.get('PORT', 8443)),
+                path=os.environ.get('WEBHOOK_PATH', '/'),
+                secret_token=os.environ.get('WEBHOOK_SECRET'),
+                shards=int(os.environ.get('WEBHOOK_WORKERS', 8))
+            )
         else:
-            send_start_message(bot, user_id)
-    except Exception as e:
-        send_message_about_internal_exception(bot, user_id, e)
+            bot.polling()
+    finally:
+        # обработчики, которые ещё выполняются, заканчивают работу до того, как atexit закроет хранилища
+        bot.stop_bot()
 
 
-bot.polling()
+# при импорте (например, из нагрузочного теста) бот не запускается
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,6 @@
+import re
+
+
 # Вспомогательная функция, возвращающая унифицированное сообщение, пришедшее от пользователя боту
 def get_unified_user_message(message):
     return unify_message(message.text)
@@ -15,10 +18,91 @@ def get_chat_id_to_reply(message):
     return message.from_user.id
 
 
-# Вспомогательная функция, которая проверяет, что ответ пользователя находится в списке возможных вариантов,
-# которые бот предлагал в качестве ответа
-def is_user_try_answer(user_message, answers):
-    for answer in answers:
-        if user_message == unify_message(answer):
-            return True
-    return False
\ No newline at end of file
+# длина ID вопроса (question.Question.id), по которой токен кнопки с вариантом ответа отличается от текста ответа
+question_id_length = 16
+
+
+# Функция, которая строит callback_data кнопки с вариантом ответа: ID вопроса и номер варианта ответа.
+# В отличие от текста ответа такой токен всегда короче ограничения Telegram в 64 байта и однозначно
+# указывает, на какой вопрос отвечает пользователь
+def make_answer_token(question_id, answer_index):
+    return f'{question_id}:{answer_index}'
+
+
+# Функция, обратная make_answer_token: возвращает ID вопроса и номер варианта ответа или (None, None),
+# если callback_data не является таким токеном (например, у кнопок, в которых передавался сам текст ответа)
+def parse_answer_token(data):
+    if data is not None:
+        question_id, separator, answer_index = data.partition(':')
+        if separator and len(question_id) == question_id_length and answer_index.isdigit():
+            return question_id, int(answer_index)
+    return None, None
+
+
+# Диспетчер текстовых сообщений: приводит текст сообщения к унифицированному виду один раз, а затем ищет
+# обработчик точной команды в словаре и только если такой команды нет - проверяет (заранее скомпилированные)
+# регулярные выражения для команд с параметрами. Если ничего не подошло, вызывается обработчик по умолчанию
+class MessageDispatcher:
+
+    def __init__(self):
+        self.commands = {}
+        self.patterns = []
+        self.default_handler = None
+
+    def command(self, *phrases):
+        """
+        Декоратор, регистрирующий обработчик для команд, которые совпадают с одной из фраз (после унификации).
+        Обработчик вызывается с одним аргументом - сообщением.
+
+        :param phrases: фразы, на которые реагирует обработчик (str)
+        """
+        def decorator(handler):
+            for phrase in phrases:
+                self.commands[unify_message(phrase)] = handler
+            return handler
+        return decorator
+
+    def pattern(self, reg_exp):
+        """
+        Декоратор, регистрирующий обработчик для команд с параметрами. Обработчик вызывается с двумя аргументами:
+        сообщением и результатом сопоставления с регулярным выражением (re.Match).
+
+        :param reg_exp: регулярное выражение для унифицированного текста сообщения (str или re.Pattern)
+        """
+        def decorator(handler):
+            self.patterns.append((re.compile(reg_exp), handler))
+            return handler
+        return decorator
+
+    def default(self, handler):
+        """
+        Декоратор, регистрирующий обработчик для сообщений, которым не подошла ни одна команда.
+        """
+        self.default_handler = handler
+        return handler
+
+    def resolve(self, text):
+        """
+        Находит обработчик для унифицированного текста сообщения.
+
+        :param text: унифицированный текст сообщения (str)
+        :return: обработчик и дополнительные аргументы для него ((function, tuple))
+        """
+        handler = self.commands.get(text)
+        if handler is not None:
+            return handler, ()
+        for reg_exp, handler in self.patterns:
+            m = reg_exp.match(text)
+            if m:
+                return handler, (m,)
+        return self.default_handler, ()
+
+    def dispatch(self, message):
+        """
+        Вызывает подходящий обработчик для сообщения.
+
+        :param message: сообщение от пользователя (telebot.types.Message)
+        """
+        handler, args = self.resolve(get_unified_user_message(message))
+        if handler is not None:
+            return handler(message, *args)
@@ -0,0 +1,378 @@
+import bisect
+import json
+import logging
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Метрики бота: счётчики, гистограммы задержек и показатели (например, размеры очередей), которые отдаются
+# в текстовом формате Prometheus (start_metrics_server) и периодически пишутся в лог (start_metrics_log).
+# Запись в метрику - это несколько операций со словарём под блокировкой, поэтому метрики можно держать
+# включёнными всегда.
+
+# сводка по метрикам пишется в собственный лог, независимо от настроек логирования telebot
+logger = logging.getLogger('mosigobot.metrics')
+
+# границы корзин гистограмм задержек по умолчанию, в секундах
+default_latency_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_labels(label_names, label_values, extra=()):
+    pairs = [f'{name}="{value}"' for name, value in zip(label_names, label_values)]
+    pairs.extend(f'{name}="{value}"' for name, value in extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """
+    Счётчик событий (например, ошибок) с набором меток.
+    """
+
+    type_name = 'counter'
+
+    def __init__(self, name, documentation, label_names=()):
+        """
+        :param name: название метрики (str)
+        :param documentation: описание метрики (str)
+        :param label_names: названия меток ([str])
+        """
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        """
+        Увеличивает счётчик для переданных значений меток.
+        """
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def get(self, *label_values):
+        with self.lock:
+            return self.values.get(label_values, 0)
+
+    def render(self):
+        with self.lock:
+            values = list(self.values.items())
+        for label_values, value in values:
+            yield f'{self.name}{format_labels(self.label_names, label_values)} {format_value(value)}'
+
+    def summary(self):
+        with self.lock:
+            return {'total': sum(self.values.values())} if self.values else None
+
+
+class Histogram:
+    """
+    Гистограмма значений (например, задержек в секундах) с фиксированными корзинами и набором меток.
+    """
+
+    type_name = 'histogram'
+
+    def __init__(self, name, documentation, label_names=(), buckets=default_latency_buckets):
+        """
+        :param name: название метрики (str)
+        :param documentation: описание метрики (str)
+        :param label_names: названия меток ([str])
+        :param buckets: верхние границы корзин по возрастанию ([float])
+        """
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        # для каждого набора меток: кол-во значений в каждой корзине (последняя - больше всех границ),
+        # сумма и кол-во значений
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        """
+        Добавляет значение в гистограмму для переданных значений меток.
+        """
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            data = self.values.get(label_values)
+            if data is None:
+                data = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            data[0][index] += 1
+            data[1] += value
+            data[2] += 1
+
+    def time(self, *label_values):
+        """
+        :return: контекстный менеджер, который добавляет в гистограмму время выполнения блока
+        """
+        return Timer(self, label_values)
+
+    def quantile(self, q, *label_values):
+        """
+        Оценивает квантиль по корзинам: возвращается верхняя граница корзины, в которую попал квантиль.
+
+        :param q: квантиль от 0 до 1 (float)
+        :return: оценка квантиля (float) или None, если значений нет
+        """
+        with self.lock:
+            data = self.values.get(label_values)
+            if data is None:
+                return None
+            counts, _, count = list(data[0]), data[1], data[2]
+        rank = q * count
+        seen = 0
+        for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+            seen += bucket_count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def render(self):
+        with self.lock:
+            values = [(label_values, list(data[0]), data[1], data[2]) for label_values, data in self.values.items()]
+        for label_values, counts, total, count in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                labels = format_labels(self.label_names, label_values, [('le', format_value(bound))])
+                yield f'{self.name}_bucket{labels} {cumulative}'
+            labels = format_labels(self.label_names, label_values)
+            yield f'{self.name}_sum{labels} {format_value(total)}'
+            yield f'{self.name}_count{labels} {count}'
+
+    def summary(self):
+        with self.lock:
+            label_values_list = list(self.values)
+        result = {}
+        for label_values in label_values_list:
+            with self.lock:
+                _, total, count = self.values[label_values]
+            result[','.join(map(str, label_values)) or 'all'] = {
+                'count': count,
+                'avg_ms': round(total / count * 1000, 2),
+                'p95_ms': round(self.quantile(0.95, *label_values) * 1000, 2)
+            }
+        return result or None
+
+
+class Timer:
+
+    def __init__(self, histogram, label_values):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.histogram.observe(time.perf_counter() - self.start, *self.label_values)
+        return False
+
+
+class Gauge:
+    """
+    Показатель, значение которого вычисляется в момент чтения метрик (например, размер очереди).
+    """
+
+    type_name = 'gauge'
+
+    def __init__(self, name, documentation, label_names=()):
+        """
+        :param name: название метрики (str)
+        :param documentation: описание метрики (str)
+        :param label_names: названия меток ([str])
+        """
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.callbacks = {}
+        self.lock = threading.Lock()
+
+    def set_function(self, function, key=None):
+        """
+        Задаёт функцию, которая вычисляет значение показателя. Функций может быть несколько (например, по одной
+        на каждый экземпляр хранилища); повторный вызов с тем же key заменяет функцию.
+
+        :param function: функция без аргументов, которая возвращает число или словарь {значения меток: число}
+        :param key: ключ функции (любой hashable)
+        """
+        with self.lock:
+            self.callbacks[key] = function
+
+    def collect(self):
+        """
+        :return: значения показателя для каждого набора меток ({tuple: float})
+        """
+        with self.lock:
+            callbacks = list(self.callbacks.values())
+        result = {}
+        for function in callbacks:
+            try:
+                value = function()
+            except Exception as e:
+                logging.warning(f'Не удалось вычислить метрику {self.name}: {e}')
+                continue
+            if isinstance(value, dict):
+                for label_values, item in value.items():
+                    label_values = label_values if isinstance(label_values, tuple) else (label_values,)
+                    result[label_values] = result.get(label_values, 0) + item
+            else:
+                result[()] = result.get((), 0) + value
+        return result
+
+    def render(self):
+        for label_values, value in self.collect().items():
+            yield f'{self.name}{format_labels(self.label_names, label_values)} {format_value(value)}'
+
+    def summary(self):
+        values = self.collect()
+        if not values:
+            return None
+        return {','.join(map(str, label_values)) or 'all': value for label_values, value in values.items()}
+
+
+class MetricsRegistry:
+    """
+    Набор метрик бота. Метрика с одним и тем же названием создаётся один раз, повторные вызовы возвращают её же.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def __get_or_create(self, metric_class, name, *args, **kwargs):
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = metric_class(name, *args, **kwargs)
+            return self.metrics[name]
+
+    def counter(self, name, documentation, label_names=()):
+        return self.__get_or_create(Counter, name, documentation, label_names)
+
+    def histogram(self, name, documentation, label_names=(), buckets=default_latency_buckets):
+        return self.__get_or_create(Histogram, name, documentation, label_names, buckets)
+
+    def gauge(self, name, documentation, label_names=()):
+        return self.__get_or_create(Gauge, name, documentation, label_names)
+
+    def render(self):
+        """
+        :return: все метрики в текстовом формате Prometheus (str)
+        """
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type_name}')
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """
+        :return: краткая сводка по метрикам, в которые что-то записано (map)
+        """
+        with self.lock:
+            metrics = list(self.metrics.values())
+        result = {}
+        for metric in metrics:
+            summary = metric.summary()
+            if summary is not None:
+                result[metric.name] = summary
+        return result
+
+
+# метрики всего бота
+registry = MetricsRegistry()
+
+handler_latency = registry.histogram(
+    'mosigobot_handler_latency_seconds', 'Время обработки сообщения обработчиком', ['handler'])
+handler_errors = registry.counter(
+    'mosigobot_handler_errors_total', 'Кол-во ошибок в обработчиках сообщений', ['error'])
+storage_save_latency = registry.histogram(
+    'mosigobot_storage_save_seconds', 'Время сохранения состояния пользователей', ['storage'])
+storage_save_errors = registry.counter(
+    'mosigobot_storage_save_errors_total', 'Кол-во ошибок сохранения состояния пользователей', ['storage'])
+storage_write_conflicts = registry.counter(
+    'mosigobot_storage_write_conflicts_total',
+    'Кол-во записей состояния пользователя, которые пришлось повторить из-за изменений другого экземпляра бота',
+    ['storage'])
+questions_expired = registry.counter(
+    'mosigobot_questions_expired_total', 'Кол-во вопросов, удалённых без ответа по истечении времени', ['storage'])
+question_source_latency = registry.histogram(
+    'mosigobot_question_source_latency_seconds', 'Время получения вопроса от источника', ['source', 'result'])
+question_source_errors = registry.counter(
+    'mosigobot_question_source_errors_total', 'Кол-во ошибок при получении вопроса от источника', ['source'])
+outgoing_send_latency = registry.histogram(
+    'mosigobot_outgoing_send_seconds', 'Время отправки сообщения в Telegram', ['result'])
+outgoing_retries = registry.counter(
+    'mosigobot_outgoing_retries_total', 'Кол-во повторных отправок сообщений', ['error'])
+outgoing_dropped = registry.counter(
+    'mosigobot_outgoing_dropped_total', 'Кол-во сообщений, которые не удалось отправить', ['error'])
+queue_size = registry.gauge(
+    'mosigobot_queue_size', 'Кол-во элементов в очередях бота', ['queue'])
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = self.server.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(format, *args)
+
+
+def start_metrics_server(port, host='0.0.0.0', metrics_registry=registry):
+    """
+    Запускает в фоновом потоке HTTP-сервер, который отдаёт метрики по адресу /metrics.
+
+    :param port: порт сервера (int)
+    :param host: адрес сервера (str)
+    :param metrics_registry: метрики (MetricsRegistry)
+    :return: сервер (ThreadingHTTPServer)
+    """
+    server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    server.daemon_threads = True
+    server.registry = metrics_registry
+    threading.Thread(target=server.serve_forever, daemon=True, name='metrics-server').start()
+    return server
+
+
+def start_metrics_log(interval=60.0, metrics_registry=registry):
+    """
+    Запускает фоновый поток, который раз в interval секунд пишет в лог сводку по метрикам.
+
+    :param interval: период в секундах (float)
+    :param metrics_registry: метрики (MetricsRegistry)
+    :return: событие, установка которого останавливает поток (threading.Event)
+    """
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(asctime)s %(name)s: %(message)s'))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+    stopped = threading.Event()
+
+    def log_loop():
+        while not stopped.wait(interval):
+            logger.info(json.dumps(metrics_registry.summary(), ensure_ascii=False))
+
+    threading.Thread(target=log_loop, daemon=True, name='metrics-log').start()
+    return stopped
@@ -0,0 +1,243 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from collections import deque
+
+from telebot.apihelper import ApiTelegramException
+
+import metrics
+
+
+class TokenBucket:
+    """
+    Ограничитель частоты: в среднем не больше rate событий в секунду, но до capacity событий подряд.
+    Токены можно занимать наперёд: reserve всегда забирает токен и возвращает, сколько нужно подождать,
+    пока он появится, поэтому несколько потоков, занявших токены, выстраиваются друг за другом.
+    """
+
+    def __init__(self, rate, capacity):
+        """
+        :param rate: сколько токенов добавляется в секунду (float)
+        :param capacity: максимальное кол-во накопленных токенов (float)
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def __refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def reserve(self, now=None):
+        """
+        Забирает один токен.
+
+        :return: через сколько секунд токен можно использовать (float, 0 - сразу)
+        """
+        now = time.monotonic() if now is None else now
+        self.__refill(now)
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def is_full(self, now=None):
+        """
+        :return: накоплено ли максимальное кол-во токенов, то есть ограничитель ничем не отличается от нового (bool)
+        """
+        now = time.monotonic() if now is None else now
+        self.__refill(now)
+        return self.tokens >= self.capacity
+
+
+class OutgoingMessageQueue:
+    """
+    Очередь исходящих сообщений. Обработчики не ждут ответа Telegram: send_message только ставит сообщение
+    в очередь чата и сразу возвращает управление, а отправляют сообщения фоновые потоки.
+
+    Отправка учитывает ограничения Telegram: общий ограничитель частоты на всего бота и отдельный на каждый чат.
+    Сообщения одного чата отправляются строго по порядку (в каждый момент чат обслуживает не больше одного потока).
+    Если Telegram ответил 429, сообщение остаётся первым в очереди чата и отправляется повторно через
+    retry_after секунд из ответа; другие чаты в это время обслуживаются как обычно.
+    """
+
+    # сколько ограничителей частоты пустых чатов хранить, прежде чем удалять те, что уже полностью восстановились
+    max_idle_chat_buckets = 10000
+
+    def __init__(self, bot, workers=4, global_rate=30.0, global_burst=30, chat_rate=1.0, chat_burst=3,
+                 max_retries=5, retry_delay=1.0):
+        """
+        :param bot: бот (TeleBot), через которого отправляются сообщения
+        :param workers: кол-во потоков, которые отправляют сообщения (int)
+        :param global_rate: сколько сообщений в секунду можно отправлять всем чатам вместе (float)
+        :param global_burst: сколько сообщений можно отправить подряд всем чатам вместе (int)
+        :param chat_rate: сколько сообщений в секунду можно отправлять в один чат (float)
+        :param chat_burst: сколько сообщений подряд можно отправить в один чат (int)
+        :param max_retries: сколько раз повторять отправку сообщения, прежде чем отказаться от него (int)
+        :param retry_delay: пауза перед повтором после ошибки без retry_after, например сетевой (float)
+        """
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.chat_buckets = {}
+        # очереди сообщений (kwargs вызова send_message и кол-во попыток) по чатам; чат есть здесь,
+        # пока у него есть неотправленные сообщения
+        self.chats = {}
+        # чаты, которые ждут своей очереди: (время, когда чат можно обслуживать, порядковый номер, ID чата)
+        self.ready = []
+        self.sequence = itertools.count()
+        self.pending_count = 0
+
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.threads = [threading.Thread(target=self.__work, daemon=True, name=f'outgoing-{i}')
+                        for i in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+        metrics.queue_size.set_function(lambda: {'outgoing_messages': self.pending_count}, key='outgoing_messages')
+
+    def send_message(self, chat_id, text, **kwargs):
+        """
+        Ставит сообщение в очередь отправки. Параметры те же, что у TeleBot.send_message.
+
+        :param chat_id: ID чата (int)
+        :param text: текст сообщения (str)
+        """
+        now = time.monotonic()
+        with self.condition:
+            if self.stopped:
+                raise RuntimeError('Очередь исходящих сообщений остановлена')
+            self.pending_count += 1
+            messages = self.chats.get(chat_id)
+            if messages is not None:
+                # чат уже ждёт своей очереди или обслуживается: сообщение уйдёт после предыдущих
+                messages.append([dict(chat_id=chat_id, text=text, **kwargs), 0])
+                return
+            self.chats[chat_id] = deque([[dict(chat_id=chat_id, text=text, **kwargs), 0]])
+            self.__schedule(chat_id, now + self.__chat_bucket(chat_id).reserve(now))
+            self.condition.notify()
+
+    def __chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) > self.max_idle_chat_buckets:
+                self.__prune_chat_buckets()
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def __prune_chat_buckets(self):
+        now = time.monotonic()
+        for chat_id in [chat_id for chat_id, bucket in self.chat_buckets.items()
+                        if chat_id not in self.chats and bucket.is_full(now)]:
+            del self.chat_buckets[chat_id]
+
+    def __schedule(self, chat_id, ready_at):
+        heapq.heappush(self.ready, (ready_at, next(self.sequence), chat_id))
+
+    def __next_chat(self):
+        with self.condition:
+            while True:
+                if self.stopped and not self.chats:
+                    return None
+                if self.ready:
+                    ready_at, _, chat_id = self.ready[0]
+                    wait_time = ready_at - time.monotonic()
+                    if wait_time <= 0:
+                        heapq.heappop(self.ready)
+                        return chat_id, self.chats[chat_id][0]
+                    self.condition.wait(wait_time)
+                else:
+                    self.condition.wait()
+
+    def __work(self):
+        while True:
+            item = self.__next_chat()
+            if item is None:
+                return
+            chat_id, message = item
+
+            with self.condition:
+                wait_time = self.global_bucket.reserve()
+            if wait_time > 0:
+                time.sleep(wait_time)
+
+            retry_after = self.__send(message)
+
+            now = time.monotonic()
+            with self.condition:
+                messages = self.chats[chat_id]
+                if retry_after is None:
+                    messages.popleft()
+                    self.pending_count -= 1
+                if messages:
+                    ready_at = now + retry_after if retry_after is not None \
+                        else now + self.__chat_bucket(chat_id).reserve(now)
+                    self.__schedule(chat_id, ready_at)
+                    self.condition.notify()
+                else:
+                    del self.chats[chat_id]
+                    self.condition.notify_all()
+
+    def __send(self, message):
+        """
+        Отправляет сообщение.
+
+        :param message: сообщение и кол-во сделанных попыток ([map, int])
+        :return: None, если сообщение отправлено (или от него пришлось отказаться), иначе через сколько секунд
+            повторить отправку (float)
+        """
+        kwargs, attempts = message
+        start = time.perf_counter()
+        try:
+            self.bot.send_message(**kwargs)
+            metrics.outgoing_send_latency.observe(time.perf_counter() - start, 'success')
+            return None
+        except Exception as e:
+            metrics.outgoing_send_latency.observe(time.perf_counter() - start, 'failure')
+            retry_after = self.__get_retry_after(e)
+            message[1] = attempts = attempts + 1
+            if retry_after is None or attempts > self.max_retries:
+                logging.error(f'Не удалось отправить сообщение в чат {kwargs["chat_id"]}: {e}')
+                metrics.outgoing_dropped.inc(type(e).__name__)
+                return None
+            metrics.outgoing_retries.inc(str(getattr(e, 'error_code', type(e).__name__)))
+            return retry_after
+
+    def __get_retry_after(self, e):
+        """
+        :return: через сколько секунд можно повторить отправку после ошибки e (float) или None, если повторять
+            бесполезно (например, пользователь заблокировал бота)
+        """
+        if isinstance(e, ApiTelegramException):
+            if e.error_code == 429:
+                return float(e.result_json.get('parameters', {}).get('retry_after', self.retry_delay))
+            # ошибки в самом запросе (400, 403 и т.п.) при повторе не исчезнут
+            return self.retry_delay if e.error_code >= 500 else None
+        return self.retry_delay
+
+    def get_pending_count(self):
+        """
+        :return: кол-во сообщений, которые ещё не отправлены (int)
+        """
+        with self.condition:
+            return self.pending_count
+
+    def close(self, timeout=None):
+        """
+        Перестаёт принимать новые сообщения, дожидается отправки уже принятых и останавливает потоки.
+
+        :param timeout: сколько секунд ждать отправки (float); None - без ограничения
+        """
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for thread in self.threads:
+            thread.join(None if deadline is None else max(0.0, deadline - time.monotonic()))
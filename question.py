@@ -1,11 +1,31 @@
 from abc import abstractmethod
+from array import array
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
+import argparse
+import hashlib
+import json
+import logging
+import queue
 import random
+import sqlite3
+import threading
+import time
+
 import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+from message_processor import unify_message, question_id_length
 
 
 class Question:
 
+    # вопросов в памяти может быть очень много, поэтому экономим память на __dict__ каждого из них
+    __slots__ = ('question', 'answers', 'correct_answer', 'id', 'normalized_answers', 'correct_index')
+
     def __init__(self, question, answers, correct_answer):
         """
         Вопрос для игры "Кто хочет стать миллионером". Если верный ответ не содержится в вариантах ответа,
@@ -20,17 +40,103 @@ class Question:
         self.question = question
         self.answers = answers
         self.correct_answer = correct_answer
+        # стабильный идентификатор вопроса: одинаковые по содержанию вопросы имеют одинаковый id
+        self.id = hashlib.sha1(
+            json.dumps([question, answers, correct_answer], ensure_ascii=False).encode('utf-8')
+        ).hexdigest()[:question_id_length]
+        # ответы приводятся к унифицированному виду один раз при создании вопроса, а не при каждом ответе
+        self.normalized_answers = tuple(unify_message(answer) for answer in answers)
+        self.correct_index = answers.index(correct_answer)
+
+    def find_answer(self, text):
+        """
+        Ищет вариант ответа по тексту, который прислал пользователь.
+
+        :param text: текст ответа (str)
+        :return: номер варианта ответа (int) или None, если такого варианта нет
+        """
+        try:
+            return self.normalized_answers.index(unify_message(text))
+        except ValueError:
+            return None
+
+
+class QuestionCatalog:
+    """
+    Каталог вопросов, которые сейчас заданы пользователям. Каждый вопрос хранится в единственном экземпляре
+    (по id), а для каждого вопроса считается, скольким пользователям он задан: когда вопрос не задан больше никому,
+    он удаляется из каталога. Благодаря этому состояние пользователей может хранить только id вопроса.
+    """
+
+    def __init__(self):
+        self.questions = {}
+        self.refs = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, question):
+        """
+        Добавляет в каталог ещё одну ссылку на вопрос.
+
+        :param question: вопрос (Question)
+        :return: экземпляр вопроса из каталога (Question)
+        """
+        with self.lock:
+            question = self.questions.setdefault(question.id, question)
+            self.refs[question.id] = self.refs.get(question.id, 0) + 1
+            return question
+
+    def release(self, question_id):
+        """
+        Убирает из каталога одну ссылку на вопрос; вопрос, на который больше никто не ссылается, удаляется.
+
+        :param question_id: id вопроса (str)
+        """
+        with self.lock:
+            refs = self.refs.get(question_id, 0) - 1
+            if refs > 0:
+                self.refs[question_id] = refs
+            else:
+                self.refs.pop(question_id, None)
+                self.questions.pop(question_id, None)
+
+    def get(self, question_id):
+        """
+        :param question_id: id вопроса (str)
+        :return: вопрос (Question) или None, если такого вопроса в каталоге нет
+        """
+        return self.questions.get(question_id)
+
+    def __len__(self):
+        return len(self.questions)
+
+
+def question_from_akentev_json(data):
+    """
+    Создаёт вопрос из ответа API stepik.akentev.com: верный ответ там всегда идёт первым, поэтому варианты
+    ответа перемешиваются.
+
+    :param data: ответ API (map)
+    :return: вопрос (Question)
+    """
+    question = data['question']
+    answers = data['answers']
+    solution = answers[0]
+
+    random.shuffle(answers)
+
+    return Question(question, answers, solution)
 
 
 # Объект, представляющий собой хранилище вопросов
 class QuestionStorage:
 
     @abstractmethod
-    def get_question(self, complexity):
+    def get_question(self, complexity, user_id=None):
         """
         Получает очередной вопрос при помощи внешнего API.
 
         :param complexity: предпочитаемая сложность (str)
+        :param user_id: telegram-ID пользователя, которому задаётся вопрос (int), если он известен
         :return: Question (вопрос (str), варианты ответа ([str]), правильный ответ (str))
         """
         pass
@@ -39,24 +145,32 @@ class QuestionStorage:
 # Реализация хранилища вопросов, которая ходит через внешнее API и получает очередной вопрос оттуда
 class AkentevQuestionStorage(QuestionStorage):
 
-    def get_question(self, complexity):
-        r = requests.get(
-            'https://stepik.akentev.com/api/millionaire',
+    def __init__(self, api_url='https://stepik.akentev.com/api/millionaire', timeout=5.0, pool_size=10):
+        """
+        Запросы к API идут через одну сессию requests, которая переиспользует keep-alive соединения.
+
+        :param api_url: адрес API, которое возвращает вопросы (str)
+        :param timeout: максимальное время ожидания ответа от API в секундах (float)
+        :param pool_size: максимальное кол-во одновременно открытых соединений с API (int)
+        """
+        self.api_url = api_url
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get_question(self, complexity, user_id=None):
+        r = self.session.get(
+            self.api_url,
             params={
                 'complexity': complexity
-            }
+            },
+            timeout=self.timeout
         )
         r.raise_for_status()
 
-        data = r.json()
-
-        question = data['question']
-        answers = data['answers']
-        solution = answers[0]
-
-        random.shuffle(answers)
-
-        return Question(question, answers, solution)
+        return question_from_akentev_json(r.json())
 
 
 # Реализация хранилища вопросов, которая берёт данные из хранящегося в памяти массива вопросов
@@ -70,25 +184,438 @@ class InMemoryQuestionStorage(QuestionStorage):
         """
         self.questions = questions_db
 
-    def get_question(self, complexity):
+    def get_question(self, complexity, user_id=None):
         return random.choice(self.questions)
 
 
+class CircuitBreaker:
+
+    def __init__(self, failure_threshold=5, error_rate_threshold=0.5, window_size=20, reset_timeout=30.0):
+        """
+        Предохранитель для источника данных. Размыкается (open), если источник ответил ошибкой failure_threshold раз
+        подряд или если доля ошибок среди последних window_size запросов достигла error_rate_threshold. Пока
+        предохранитель разомкнут, к источнику не обращаются; через reset_timeout секунд пропускается один пробный
+        запрос (half_open): если он успешен, предохранитель замыкается (closed), иначе снова размыкается.
+
+        :param failure_threshold: кол-во ошибок подряд, после которого предохранитель размыкается (int)
+        :param error_rate_threshold: доля ошибок в окне, после которой предохранитель размыкается (float)
+        :param window_size: кол-во последних запросов, по которым считается доля ошибок (int)
+        :param reset_timeout: через сколько секунд после размыкания пропустить пробный запрос (float)
+        """
+        self.failure_threshold = failure_threshold
+        self.error_rate_threshold = error_rate_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+
+        self.state = 'closed'
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.consecutive_failures = 0
+        # результаты последних запросов: True - успех, False - ошибка
+        self.window = deque(maxlen=window_size)
+
+        self.successes_count = 0
+        self.failures_count = 0
+        self.rejected_count = 0
+        self.latency_total = 0.0
+
+    def allow_request(self):
+        """
+        Проверяет, можно ли сейчас обратиться к источнику.
+
+        :return: True, если обращаться можно (bool)
+        """
+        with self.lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = 'half_open'
+            if self.state == 'half_open' and not self.probe_in_flight:
+                self.probe_in_flight = True
+                return True
+            self.rejected_count += 1
+            return False
+
+    def record_success(self, latency):
+        with self.lock:
+            self.successes_count += 1
+            self.latency_total += latency
+            self.consecutive_failures = 0
+            self.window.append(True)
+            if self.state == 'half_open':
+                self.state = 'closed'
+                self.probe_in_flight = False
+                self.window.clear()
+
+    def record_failure(self, latency):
+        with self.lock:
+            self.failures_count += 1
+            self.latency_total += latency
+            self.consecutive_failures += 1
+            self.window.append(False)
+            if self.state == 'half_open':
+                self.__open()
+            elif self.state == 'closed' and (self.consecutive_failures >= self.failure_threshold
+                                             or self.__error_rate() >= self.error_rate_threshold):
+                self.__open()
+
+    def __error_rate(self):
+        # пока окно не заполнено, по доле ошибок не судим
+        if len(self.window) < self.window.maxlen:
+            return 0.0
+        return self.window.count(False) / len(self.window)
+
+    def __open(self):
+        self.state = 'open'
+        self.opened_at = time.monotonic()
+        self.probe_in_flight = False
+
+    def get_health(self):
+        """
+        Возвращает состояние предохранителя и статистику запросов к источнику.
+
+        :return: статистика (map)
+        """
+        with self.lock:
+            requests_count = self.successes_count + self.failures_count
+            return {
+                'state': self.state,
+                'requests': requests_count,
+                'rejected': self.rejected_count,
+                'success_rate': self.successes_count / requests_count if requests_count else 1.0,
+                'latency_avg': self.latency_total / requests_count if requests_count else 0.0,
+                'consecutive_failures': self.consecutive_failures
+            }
+
+
 # Реализация хранилища вопросов, которая имеет ссылки на другие хранилища вопросов и пытается запросить очередной
-# вопрос у каждого хранилища, пока это не закончится успехом
+# вопрос у каждого хранилища, пока это не закончится успехом. У каждого хранилища есть свой предохранитель
+# (CircuitBreaker): к хранилищу, которое в последнее время постоянно ошибается, не обращаемся вовсе
 class CompositeQuestionStorage(QuestionStorage):
 
-    def __init__(self, storages):
+    def __init__(self, storages, hedge_delay=None, timeout=None, breaker_factory=CircuitBreaker,
+                 workers_per_storage=8):
+        """
+        Без hedge_delay хранилища опрашиваются строго по очереди. Если hedge_delay задан, то запросы выполняются
+        в фоновых потоках: если очередное хранилище не ответило за hedge_delay секунд (или ответило ошибкой),
+        параллельно запрашивается следующее, и возвращается первый успешно полученный вопрос.
+
+        У каждого хранилища свои потоки: если медленное хранилище заняло все свои потоки, запросы к следующему
+        хранилищу не ждут в очереди за ними.
+
+        :param storages: хранилища вопросов в порядке приоритета ([QuestionStorage])
+        :param hedge_delay: через сколько секунд ожидания запрашивать следующее хранилище (float)
+        :param timeout: максимальное общее время ожидания вопроса в секундах, только вместе с hedge_delay (float)
+        :param breaker_factory: функция, создающая предохранитель для каждого хранилища (() -> CircuitBreaker)
+        :param workers_per_storage: кол-во потоков для запросов к каждому хранилищу, только вместе с hedge_delay (int)
+        """
         self.storages = storages
+        self.breakers = [breaker_factory() for _ in storages]
+        self.hedge_delay = hedge_delay
+        self.timeout = timeout
+        if hedge_delay is not None:
+            self.executors = [ThreadPoolExecutor(max_workers=workers_per_storage,
+                                                 thread_name_prefix=f'question-hedge-{i}')
+                              for i in range(len(storages))]
+
+    def get_question(self, complexity, user_id=None):
+        if self.hedge_delay is not None:
+            return self.__get_question_hedged(complexity, user_id)
 
-    def get_question(self, complexity):
-        for storage in self.storages:
+        for storage, breaker in zip(self.storages, self.breakers):
+            if not breaker.allow_request():
+                continue
             try:
-                return storage.get_question(complexity)
+                return self.__get_question_from(storage, breaker, complexity, user_id)
             except Exception as e:
-                print(e)
+                logging.warning(e)
         raise RuntimeError('Не удалось получить вопрос ни от одного хранилища вопросов')
 
+    @staticmethod
+    def __get_question_from(storage, breaker, complexity, user_id):
+        source = type(storage).__name__
+        start = time.monotonic()
+        try:
+            question = storage.get_question(complexity, user_id)
+        except Exception:
+            latency = time.monotonic() - start
+            breaker.record_failure(latency)
+            metrics.question_source_latency.observe(latency, source, 'failure')
+            metrics.question_source_errors.inc(source)
+            raise
+        latency = time.monotonic() - start
+        breaker.record_success(latency)
+        metrics.question_source_latency.observe(latency, source, 'success')
+        return question
+
+    def __get_question_hedged(self, complexity, user_id):
+        deadline = time.monotonic() + self.timeout if self.timeout is not None else None
+        not_started = list(zip(self.storages, self.breakers, self.executors))
+        running = set()
+
+        while not_started or running:
+            while not_started:
+                storage, breaker, executor = not_started.pop(0)
+                if breaker.allow_request():
+                    running.add(executor.submit(self.__get_question_from, storage, breaker, complexity, user_id))
+                    break
+            if not running:
+                break
+
+            wait_time = self.hedge_delay if not_started else None
+            if deadline is not None:
+                time_left = deadline - time.monotonic()
+                if time_left <= 0:
+                    break
+                wait_time = time_left if wait_time is None else min(wait_time, time_left)
+
+            done, running = wait(running, timeout=wait_time, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    return future.result()
+                except Exception as e:
+                    logging.warning(e)
+
+        raise RuntimeError('Не удалось получить вопрос ни от одного хранилища вопросов')
+
+    def get_health(self):
+        """
+        Возвращает для каждого хранилища состояние его предохранителя, долю успешных запросов и среднее время ответа.
+
+        :return: статистика по хранилищам ([map])
+        """
+        return [dict(source=type(storage).__name__, **breaker.get_health())
+                for storage, breaker in zip(self.storages, self.breakers)]
+
+
+# Реализация хранилища вопросов, которая заранее запрашивает вопросы у другого хранилища в фоновых потоках
+# и держит для каждой сложности небольшую очередь готовых вопросов. Вопрос отдаётся из памяти, а синхронно
+# к исходному хранилищу обращаемся только тогда, когда очередь для нужной сложности пуста. Вопросы запрашиваются
+# заранее без ID пользователя, поэтому хранилища, которые выбирают вопрос для пользователя (SqliteQuestionStorage),
+# оборачивать не нужно
+class PrefetchingQuestionStorage(QuestionStorage):
+
+    def __init__(self, storage, complexities=('1', '2', '3'), buffer_size=10, workers=3):
+        """
+        :param storage: хранилище, из которого запрашиваются вопросы (QuestionStorage)
+        :param complexities: сложности, для которых вопросы запрашиваются заранее ([str])
+        :param buffer_size: максимальное кол-во готовых вопросов для каждой сложности (int)
+        :param workers: кол-во фоновых потоков, которые запрашивают вопросы (int)
+        """
+        self.storage = storage
+        self.buffer_size = buffer_size
+        self.queues = {complexity: queue.Queue(maxsize=buffer_size) for complexity in complexities}
+        # сколько вопросов для каждой сложности уже запрошено, но ещё не получено
+        self.pending = {complexity: 0 for complexity in complexities}
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='question-prefetch')
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.refills_count = 0
+        self.refill_errors_count = 0
+        self.refill_time_total = 0.0
+        self.refill_time_max = 0.0
+
+        metrics.queue_size.set_function(
+            lambda: {f'question_prefetch_{complexity}': q.qsize() for complexity, q in self.queues.items()},
+            key='question_prefetch')
+
+        for complexity in complexities:
+            self.__schedule_refill(complexity)
+
+    def __schedule_refill(self, complexity):
+        with self.lock:
+            missing = self.buffer_size - self.queues[complexity].qsize() - self.pending[complexity]
+            if missing <= 0:
+                return
+            self.pending[complexity] += missing
+        for _ in range(missing):
+            self.executor.submit(self.__refill, complexity)
+
+    def __refill(self, complexity):
+        start = time.monotonic()
+        try:
+            question = self.storage.get_question(complexity)
+        except Exception as e:
+            logging.warning(f'Не удалось заранее получить вопрос сложности {complexity}: {e}')
+            with self.lock:
+                self.pending[complexity] -= 1
+                self.refill_errors_count += 1
+            return
+
+        elapsed = time.monotonic() - start
+        try:
+            self.queues[complexity].put_nowait(question)
+        except queue.Full:
+            pass
+        with self.lock:
+            self.pending[complexity] -= 1
+            self.refills_count += 1
+            self.refill_time_total += elapsed
+            self.refill_time_max = max(self.refill_time_max, elapsed)
+
+    def get_question(self, complexity, user_id=None):
+        # вопросы в очереди запрошены заранее, ещё без привязки к пользователю
+        if complexity not in self.queues:
+            return self.storage.get_question(complexity, user_id)
+
+        try:
+            question = self.queues[complexity].get_nowait()
+            with self.lock:
+                self.hits += 1
+        except queue.Empty:
+            with self.lock:
+                self.misses += 1
+            question = self.storage.get_question(complexity, user_id)
+
+        self.__schedule_refill(complexity)
+        return question
+
+    def get_stats(self):
+        """
+        Возвращает статистику работы хранилища: сколько вопросов отдано из памяти (hits) и сколько пришлось
+        запрашивать синхронно (misses), сколько вопросов получено фоновыми потоками и за какое время.
+
+        :return: статистика (map)
+        """
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'refills': self.refills_count,
+                'refill_errors': self.refill_errors_count,
+                'refill_latency_avg': self.refill_time_total / self.refills_count if self.refills_count else 0.0,
+                'refill_latency_max': self.refill_time_max,
+                'buffered': {complexity: q.qsize() for complexity, q in self.queues.items()}
+            }
+
+    def close(self):
+        """
+        Останавливает фоновые потоки, не дожидаясь запросов, которые ещё не начали выполняться.
+        """
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def build_question_bank(source_file_name, db_file_name):
+    """
+    Создаёт (или дополняет) локальную базу вопросов SQLite из файла, в каждой строке которого записан вопрос в виде
+    json: {"question": ..., "answers": [...], "correct_answer": ..., "complexity": "1"}.
+
+    :param source_file_name: файл с вопросами (str)
+    :param db_file_name: файл базы вопросов (str)
+    :return: кол-во добавленных вопросов (int)
+    """
+    db = sqlite3.connect(db_file_name)
+    try:
+        db.execute('CREATE TABLE IF NOT EXISTS questions ('
+                   'id INTEGER PRIMARY KEY, complexity TEXT NOT NULL, question TEXT NOT NULL, '
+                   'answers TEXT NOT NULL, correct_answer TEXT NOT NULL)')
+        db.execute('CREATE INDEX IF NOT EXISTS questions_complexity ON questions (complexity)')
+
+        def rows():
+            with open(source_file_name, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    data = json.loads(line)
+                    # проверяем, что верный ответ есть среди вариантов ответа
+                    question = Question(data['question'], data['answers'], data['correct_answer'])
+                    yield (str(data['complexity']), question.question,
+                           json.dumps(question.answers, ensure_ascii=False), question.correct_answer)
+
+        with db:
+            cursor = db.executemany(
+                'INSERT INTO questions (complexity, question, answers, correct_answer) VALUES (?, ?, ?, ?)', rows())
+        return cursor.rowcount
+    finally:
+        db.close()
+
+
+# Реализация хранилища вопросов, которая берёт вопросы из локальной базы SQLite (см. build_question_bank).
+# При старте в память загружаются только номера вопросов для каждой сложности, а сами вопросы читаются
+# по номеру, поэтому выбор случайного вопроса не зависит от размера базы. Одному пользователю не задаются
+# вопросы, которые он уже получал среди последних repeat_window вопросов
+class SqliteQuestionStorage(QuestionStorage):
+
+    # для скольких пользователей помнить последние заданные вопросы
+    max_tracked_users = 100000
+    # сколько раз пытаться выбрать вопрос, которого не было среди последних, прежде чем повторить вопрос
+    max_sample_attempts = 20
+
+    def __init__(self, db_file_name, repeat_window=50, mmap_size=256 * 1024 * 1024):
+        """
+        :param db_file_name: файл базы вопросов (str)
+        :param repeat_window: среди скольких последних вопросов пользователя не должно быть повторов (int)
+        :param mmap_size: сколько байт файла базы SQLite отображать в память (int)
+        """
+        self.db = sqlite3.connect(db_file_name, check_same_thread=False)
+        self.db.execute(f'PRAGMA mmap_size = {int(mmap_size)}')
+        self.lock = threading.Lock()
+
+        # номера вопросов для каждой сложности
+        self.index = {}
+        for question_id, complexity in self.db.execute('SELECT id, complexity FROM questions'):
+            self.index.setdefault(complexity, array('q')).append(question_id)
+
+        # для каждого пользователя - последние заданные ему вопросы (очередь и множество для быстрой проверки)
+        self.repeat_window = repeat_window
+        self.recent_questions = OrderedDict()
+
+    def __sample(self, complexity, user_id):
+        question_ids = self.index.get(complexity)
+        if not question_ids:
+            # если вопросов нужной сложности нет, берём вопрос любой сложности
+            question_ids = random.choice([ids for ids in self.index.values() if ids])
+        if user_id is None:
+            return random.choice(question_ids)
+
+        recent = self.recent_questions.pop(user_id, None) or (deque(), set())
+        self.recent_questions[user_id] = recent
+        if len(self.recent_questions) > self.max_tracked_users:
+            self.recent_questions.popitem(last=False)
+        recent_queue, recent_set = recent
+
+        for _ in range(self.max_sample_attempts):
+            question_id = random.choice(question_ids)
+            if question_id not in recent_set:
+                break
+
+        recent_queue.append(question_id)
+        recent_set.add(question_id)
+        if len(recent_queue) > self.repeat_window:
+            recent_set.discard(recent_queue.popleft())
+        return question_id
+
+    def __read(self, question_id):
+        # вызывается под self.lock
+        row = self.db.execute(
+            'SELECT question, answers, correct_answer FROM questions WHERE id = ?', (question_id,)).fetchone()
+        if row is None:
+            raise KeyError(question_id)
+        question, answers, correct_answer = row
+        return Question(question, json.loads(answers), correct_answer)
+
+    def get_question(self, complexity, user_id=None):
+        with self.lock:
+            if not self.index:
+                raise RuntimeError('Локальная база вопросов пуста')
+            return self.__read(self.__sample(complexity, user_id))
+
+    def get_question_by_number(self, question_id):
+        """
+        Читает вопрос по его номеру в базе: вопросы нумеруются с 1 в порядке, в котором их добавил
+        build_question_bank. Если такого вопроса нет, происходит исключительная ситуация (KeyError).
+
+        :param question_id: номер вопроса (int)
+        :return: вопрос (Question)
+        """
+        with self.lock:
+            return self.__read(question_id)
+
+    def __len__(self):
+        return sum(len(question_ids) for question_ids in self.index.values())
+
 
 # база вопросов с правильными ответами (используется в случае неработоспособности API)
 DEFAULT_QUESTIONS = [
@@ -99,3 +626,23 @@ DEFAULT_QUESTIONS = [
     Question('Какая планета Солнечной системы находится дальше всего от Солнца и Земли?',
              ['Юпитер', 'Нептун', 'Венера', 'Марс'], 'Нептун')
 ]
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Работа с локальной базой вопросов')
+    commands = parser.add_subparsers(dest='command', required=True)
+    build_bank = commands.add_parser(
+        'build-bank', help='создать (или дополнить) базу вопросов для QUESTION_BANK из файла с вопросами')
+    build_bank.add_argument('source', help='файл, в каждой строке которого записан вопрос в виде json '
+                                           '(см. build_question_bank)')
+    build_bank.add_argument('db', help='файл базы вопросов SQLite')
+    args = parser.parse_args(args)
+
+    if args.command == 'build-bank':
+        added_count = build_question_bank(args.source, args.db)
+        print(f'Добавлено вопросов: {added_count}')
+
+
+# python -m question build-bank questions.jsonl questions.db
+if __name__ == '__main__':
+    main()
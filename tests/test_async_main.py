@@ -0,0 +1,88 @@
+import asyncio
+import json
+import os
+import signal
+
+import fakeredis
+import redis
+import redis.asyncio
+
+import async_main
+
+from async_question import AsyncCompositeQuestionStorage, AsyncQuestionStorage
+from async_user_data import SyncToAsyncUserDataStorage
+from question import Question
+from user_data import InMemoryUserDataStorage, RedisUserDataStorage, state_to_json
+
+questions = [Question(f'Вопрос {i}?', ['a', 'b', 'c', 'd'], 'a') for i in range(2)]
+
+
+def test_async_bot_migrates_json_blob(monkeypatch):
+    server = fakeredis.FakeServer()
+    legacy_storage = InMemoryUserDataStorage()
+    legacy_storage.add_user_victory(1)
+    legacy_storage.put_user_current_question(1, questions[0])
+    fakeredis.FakeRedis(server=server).set(RedisUserDataStorage.legacy_key, json.dumps(
+        state_to_json(legacy_storage), ensure_ascii=False))
+
+    monkeypatch.setenv('REDIS_URL', 'redis://redis.example')
+    monkeypatch.delenv('QUESTION_TTL', raising=False)
+    monkeypatch.setattr(redis, 'from_url', lambda url: fakeredis.FakeRedis(server=server))
+    monkeypatch.setattr(redis.asyncio, 'from_url', lambda url: fakeredis.FakeAsyncRedis(server=server))
+    storage = async_main.create_user_data_storage()
+
+    async def check():
+        assert await storage.get_user_victories_count(1) == 1
+        assert (await storage.get_user_current_question(1)).id == questions[0].id
+        # вопрос, перенесённый из json-документа, освобождается так же, как заданный асинхронным ботом
+        await storage.put_user_current_question(1, questions[1])
+        await storage.clear_user_current_question(1)
+        await storage.close()
+
+    asyncio.run(check())
+    assert fakeredis.FakeRedis(server=server).hlen(RedisUserDataStorage.questions_key) == 0
+
+
+class ClosableQuestionStorage(AsyncQuestionStorage):
+
+    def __init__(self):
+        self.closed = False
+
+    async def get_question(self, complexity, user_id=None):
+        return questions[0]
+
+    async def close(self):
+        self.closed = True
+
+
+class ClosableUserDataStorage(InMemoryUserDataStorage):
+
+    def __init__(self):
+        super().__init__()
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class PollingBot:
+    """
+    Бот, который опрашивает Telegram, пока его не остановят.
+    """
+
+    async def polling(self):
+        await asyncio.sleep(60)
+
+
+def test_async_bot_closes_storages_on_sigterm():
+    question_storage = ClosableQuestionStorage()
+    user_data_storage = ClosableUserDataStorage()
+
+    async def run_and_stop():
+        asyncio.get_running_loop().call_later(0.1, os.kill, os.getpid(), signal.SIGTERM)
+        await async_main.run(PollingBot(), AsyncCompositeQuestionStorage([question_storage]),
+                             SyncToAsyncUserDataStorage(user_data_storage))
+
+    asyncio.run(asyncio.wait_for(run_and_stop(), 5))
+    assert question_storage.closed
+    assert user_data_storage.closed
@@ -0,0 +1,135 @@
+import json
+
+from types import SimpleNamespace
+
+from handlers import GameHandlers, build_start_markup, get_question_markup_json, run_sync, start_markup_json, \
+    start_message
+from message_processor import MessageDispatcher, make_answer_token, parse_answer_token
+from question import Question, InMemoryQuestionStorage
+from user_data import InMemoryUserDataStorage
+
+question = Question('Столица Франции?', ['Лион', 'Париж', 'Марсель', 'Ницца'], 'Париж')
+
+
+class RecordingBot:
+    """
+    Бот, который не отправляет сообщения, а запоминает их.
+    """
+
+    def __init__(self):
+        self.sent = []
+
+    def send_message(self, chat_id, text, reply_markup=None):
+        self.sent.append((chat_id, text, reply_markup))
+
+
+def make_message(text, user_id=1):
+    return SimpleNamespace(text=text, from_user=SimpleNamespace(id=user_id))
+
+
+def make_handlers():
+    bot = RecordingBot()
+    user_data_storage = InMemoryUserDataStorage()
+    return GameHandlers(bot, InMemoryQuestionStorage([question]), user_data_storage), bot, user_data_storage
+
+
+def test_dispatcher_routes_messages_by_unified_text():
+    handlers, bot, user_data_storage = make_handlers()
+
+    run_sync(handlers.dispatch(make_message('  ПРИВЕТ! ')))
+    run_sync(handlers.dispatch(make_message('Сложность 3')))
+    assert user_data_storage.get_user_complexity(1) == '3'
+    run_sync(handlers.dispatch(make_message('Покажи счёт')))
+    # сложности 4 нет: сообщение разбирается как непонятное
+    run_sync(handlers.dispatch(make_message('сложность 4')))
+    run_sync(handlers.dispatch(make_message(None)))
+    assert [(text, markup) for _, text, markup in bot.sent] == [
+        ('Ну привет!', None),
+        ('Изменил сложность игры на 3 из 3!', None),
+        ('Побед: 0, поражений: 0', None),
+        (start_message, start_markup_json),
+        (start_message, start_markup_json)
+    ]
+
+    # пока на вопрос не ответили, непонятное сообщение - это подсказка, а не правила игры
+    run_sync(handlers.dispatch(make_message('Спроси меня вопрос')))
+    assert bot.sent[-1][1] == question.question
+    run_sync(handlers.dispatch(make_message('что?')))
+    assert bot.sent[-1][1] == 'Нажми на кнопку ответа, который считаешь верным'
+
+
+def test_dispatcher_prefers_exact_commands_over_patterns():
+    dispatcher = MessageDispatcher()
+    calls = []
+    dispatcher.command('Сложность 1')(lambda message: calls.append('command'))
+    dispatcher.pattern(r'^сложность (\d)$')(lambda message, m: calls.append(f'pattern {m.group(1)}'))
+
+    dispatcher.dispatch(make_message('сложность 1'))
+    dispatcher.dispatch(make_message('сложность 2'))
+    # обработчика по умолчанию нет: сообщение пропускается
+    assert dispatcher.dispatch(make_message('что-то ещё')) is None
+    assert calls == ['command', 'pattern 2']
+
+
+def test_question_keyboard_is_serialized_once_per_question():
+    get_question_markup_json.cache_clear()
+    handlers, bot, _ = make_handlers()
+    for user_id in [1, 2, 3]:
+        run_sync(handlers.dispatch(make_message('Спроси меня вопрос', user_id)))
+    # пользователь 1 ещё не ответил: вопрос повторяется с той же клавиатурой
+    run_sync(handlers.dispatch(make_message('Спроси меня вопрос', 1)))
+
+    markups = [markup for _, _, markup in bot.sent]
+    assert all(markup is markups[0] for markup in markups)
+    info = get_question_markup_json.cache_info()
+    assert (info.misses, info.hits) == (1, 3)
+
+    rows = json.loads(markups[0])['inline_keyboard']
+    assert [[button['text'] for button in row] for row in rows] == [['Лион', 'Париж'], ['Марсель', 'Ницца']]
+    assert rows[0][1]['callback_data'] == f'{question.id}:1'
+
+    assert start_markup_json == build_start_markup().to_json()
+
+
+def test_answer_token_round_trip():
+    token = make_answer_token(question.id, 3)
+    assert len(token.encode('utf-8')) <= 64
+    assert parse_answer_token(token) == (question.id, 3)
+    # кнопки старых сообщений содержат сам текст ответа, а не токен
+    for data in [None, '', 'Париж', 'ответ: 1', f'{question.id}:', f'{question.id}:x', f'{question.id[:-1]}:1']:
+        assert parse_answer_token(data) == (None, None)
+
+
+def make_callback(data, user_id=1):
+    return SimpleNamespace(data=data, from_user=SimpleNamespace(id=user_id))
+
+
+def test_answer_callback_checks_token_against_current_question():
+    handlers, bot, user_data_storage = make_handlers()
+    other_question = Question('Столица Италии?', ['Рим', 'Милан', 'Турин', 'Неаполь'], 'Рим')
+    retry_prefix = 'Ты отвечаешь не на последний вопрос!'
+
+    user_data_storage.put_user_current_question(1, question)
+    # кнопка другого вопроса и несуществующий вариант ответа не засчитываются, вопрос повторяется
+    for data in [make_answer_token(other_question.id, 0), make_answer_token(question.id, 4)]:
+        run_sync(handlers.answer_callback(make_callback(data)))
+        assert bot.sent[-1][1].startswith(retry_prefix)
+    assert user_data_storage.get_user_current_question(1) is question
+
+    run_sync(handlers.answer_callback(make_callback(make_answer_token(question.id, 1))))
+    assert bot.sent[-1][1] == '👍 Правильно!'
+    assert user_data_storage.get_user_victories_count(1) == 1
+    assert user_data_storage.get_user_current_question(1) is None
+    # повторное нажатие той же кнопки
+    run_sync(handlers.answer_callback(make_callback(make_answer_token(question.id, 1))))
+    assert bot.sent[-1][1].startswith('На этот вопрос ты уже отвечал')
+    assert user_data_storage.get_user_victories_count(1) == 1
+
+    # ответ текстом старой кнопки сравнивается без учёта регистра и пробелов
+    user_data_storage.put_user_current_question(1, question)
+    run_sync(handlers.answer_callback(make_callback(' ЛИОН ')))
+    assert bot.sent[-1][1] == '😔 Неправильно. Верный ответ был "Париж"'
+    assert user_data_storage.get_user_defeats_count(1) == 1
+    user_data_storage.put_user_current_question(1, question)
+    run_sync(handlers.answer_callback(make_callback('Рим')))
+    assert bot.sent[-1][1].startswith(retry_prefix)
@@ -0,0 +1,41 @@
+import json
+import os
+import signal
+import subprocess
+import sys
+
+project_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# бот с write-behind хранилищем, у которого есть несохранённая победа, ждёт сигнала остановки
+write_behind_bot = '''
+import atexit
+import sys
+import time
+
+from main import exit_on_sigterm
+from user_data import JsonDataStorage, ToFileJsonSaver
+
+exit_on_sigterm()
+storage = JsonDataStorage(ToFileJsonSaver(sys.argv[1]), write_behind=True, flush_interval=60)
+atexit.register(storage.close)
+storage.add_user_victory(1)
+print('ready', flush=True)
+time.sleep(60)
+'''
+
+
+def test_sigterm_saves_write_behind_storage(tmp_path):
+    file_name = str(tmp_path / 'storage.json')
+    bot = subprocess.Popen([sys.executable, '-c', write_behind_bot, file_name], cwd=project_dir,
+                           stdout=subprocess.PIPE, text=True)
+    try:
+        assert bot.stdout.readline() == 'ready\n'
+        assert not os.path.exists(file_name)
+        bot.send_signal(signal.SIGTERM)
+        assert bot.wait(timeout=10) == 0
+    finally:
+        bot.kill()
+        bot.stdout.close()
+
+    with open(file_name, encoding='utf-8') as f:
+        assert json.load(f)['user_victories'] == {'1': 1}
@@ -0,0 +1,74 @@
+import threading
+import time
+
+from telebot.apihelper import ApiTelegramException
+
+from outgoing import OutgoingMessageQueue, TokenBucket
+
+
+def test_token_bucket_allows_burst_and_then_limits_rate():
+    bucket = TokenBucket(rate=2.0, capacity=3)
+    now = bucket.updated_at
+    assert [bucket.reserve(now) for _ in range(3)] == [0.0, 0.0, 0.0]
+    # токены занимаются наперёд: каждый следующий можно использовать на 1 / rate секунд позже
+    assert [bucket.reserve(now) for _ in range(2)] == [0.5, 1.0]
+    assert not bucket.is_full(now + 1.0)
+    assert bucket.reserve(now + 1.5) == 0.0
+    # накопленных токенов не больше capacity, сколько бы ни прошло времени
+    assert bucket.is_full(now + 60)
+    assert [bucket.reserve(now + 60) for _ in range(4)] == [0.0, 0.0, 0.0, 0.5]
+
+
+class RecordingBot:
+    """
+    Бот, который запоминает, когда отправлено каждое сообщение, и может ответить ошибкой 429 на выбранные
+    сообщения (как Telegram при превышении ограничений).
+    """
+
+    def __init__(self, too_many_requests=()):
+        self.sent = []
+        self.too_many_requests = set(too_many_requests)
+        self.lock = threading.Lock()
+
+    def send_message(self, chat_id, text, **kwargs):
+        with self.lock:
+            if text in self.too_many_requests:
+                self.too_many_requests.remove(text)
+                raise ApiTelegramException('sendMessage', None, {
+                    'error_code': 429, 'description': 'Too Many Requests', 'parameters': {'retry_after': 0.3}})
+            self.sent.append((chat_id, text, time.monotonic()))
+
+
+def test_outgoing_queue_limits_rate_per_chat_and_keeps_order():
+    bot = RecordingBot()
+    outgoing = OutgoingMessageQueue(bot, workers=4, global_rate=1000.0, global_burst=1000, chat_rate=20.0,
+                                    chat_burst=1)
+    start = time.monotonic()
+    for i in range(5):
+        for chat_id in [1, 2]:
+            outgoing.send_message(chat_id, f'сообщение {i}')
+    # send_message не ждёт отправки
+    assert time.monotonic() - start < 0.1
+    outgoing.close(timeout=5)
+    assert outgoing.get_pending_count() == 0
+
+    for chat_id in [1, 2]:
+        sent = [(text, sent_at) for sent_chat_id, text, sent_at in bot.sent if sent_chat_id == chat_id]
+        assert [text for text, _ in sent] == [f'сообщение {i}' for i in range(5)]
+        # в один чат - не чаще 20 сообщений в секунду
+        assert sent[-1][1] - sent[0][1] >= 4 / 20.0 - 0.02
+
+
+def test_outgoing_queue_retries_after_too_many_requests():
+    bot = RecordingBot(too_many_requests=['первое'])
+    outgoing = OutgoingMessageQueue(bot, workers=2, chat_rate=100.0, chat_burst=10)
+    start = time.monotonic()
+    outgoing.send_message(1, 'первое')
+    outgoing.send_message(1, 'второе')
+    outgoing.send_message(2, 'другой чат')
+    outgoing.close(timeout=5)
+
+    # другой чат не ждёт, пока первый чат выдерживает паузу retry_after
+    assert [(chat_id, text) for chat_id, text, _ in bot.sent] == [(2, 'другой чат'), (1, 'первое'), (1, 'второе')]
+    assert bot.sent[0][2] - start < 0.2
+    assert bot.sent[1][2] - start >= 0.3
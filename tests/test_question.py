@@ -0,0 +1,207 @@
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+from question import Question, QuestionStorage, CircuitBreaker, CompositeQuestionStorage, InMemoryQuestionStorage, \
+    PrefetchingQuestionStorage, SqliteQuestionStorage, DEFAULT_QUESTIONS
+
+project_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class SlowQuestionStorage(QuestionStorage):
+    """
+    Хранилище, которое отвечает успешно, но медленно (как перегруженное API).
+    """
+
+    def __init__(self, delay):
+        self.delay = delay
+
+    def get_question(self, complexity, user_id=None):
+        time.sleep(self.delay)
+        return Question('Медленный вопрос?', ['a', 'b', 'c', 'd'], 'a')
+
+
+def test_hedged_fallback_is_not_starved_by_slow_primary():
+    # все запросы к основному хранилищу выполняются дольше hedge_delay, поэтому каждый вызов должен успеть
+    # получить вопрос из запасного хранилища, даже если основное хранилище занимает все свои потоки
+    storage = CompositeQuestionStorage([SlowQuestionStorage(0.25), InMemoryQuestionStorage(DEFAULT_QUESTIONS)],
+                                       hedge_delay=0.1, timeout=0.3)
+    results = []
+    errors = []
+
+    def ask():
+        try:
+            results.append(storage.get_question('1'))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=ask) for _ in range(40)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert len(results) == 40
+
+
+def test_question_is_slotted_and_identified_by_content():
+    question = Question('Столица Франции?', ['Лион', 'Париж', 'Марсель', 'Ницца'], 'Париж')
+    assert not hasattr(question, '__dict__')
+    with pytest.raises(AttributeError):
+        question.complexity = '1'
+    assert question.id == Question('Столица Франции?', ['Лион', 'Париж', 'Марсель', 'Ницца'], 'Париж').id
+    assert question.id != Question('Столица Франции?', ['Лион', 'Париж', 'Марсель', 'Ницца'], 'Лион').id
+    with pytest.raises(ValueError):
+        Question('Столица Франции?', ['Лион', 'Марсель'], 'Париж')
+
+
+def test_question_bank_is_built_from_json_lines(tmp_path):
+    source_file_name = str(tmp_path / 'questions.jsonl')
+    db_file_name = str(tmp_path / 'questions.db')
+    source = [{'question': f'Вопрос {i}?', 'answers': ['a', 'b', 'c', 'd'], 'correct_answer': 'b',
+               'complexity': 1 + i % 2} for i in range(6)]
+    with open(source_file_name, 'w', encoding='utf-8') as f:
+        for data in source:
+            f.write(json.dumps(data, ensure_ascii=False) + '\n\n')
+
+    result = subprocess.run([sys.executable, '-m', 'question', 'build-bank', source_file_name, db_file_name],
+                            cwd=project_dir, capture_output=True, text=True, check=True)
+    assert result.stdout == 'Добавлено вопросов: 6\n'
+
+    random.seed(1)
+    storage = SqliteQuestionStorage(db_file_name, repeat_window=2)
+    assert len(storage) == 6
+    for number, data in enumerate(source, start=1):
+        question = storage.get_question_by_number(number)
+        assert (question.question, question.answers, question.correct_answer) == \
+               (data['question'], data['answers'], data['correct_answer'])
+    with pytest.raises(KeyError):
+        storage.get_question_by_number(7)
+
+    complexity_2 = {data['question'] for data in source if data['complexity'] == 2}
+    assert {storage.get_question('2').question for _ in range(30)} == complexity_2
+    # три вопроса сложности 2 подряд одному пользователю не повторяются (repeat_window=2)
+    for _ in range(10):
+        asked = [storage.get_question('2', user_id=1).question for _ in range(3)]
+        assert sorted(asked) == sorted(complexity_2)
+    # вопросов неизвестной сложности нет: берётся вопрос любой сложности
+    assert storage.get_question('3').question in {data['question'] for data in source}
+
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+class CountingQuestionStorage(QuestionStorage):
+    """
+    Хранилище, которое нумерует выданные вопросы и может отказывать, как недоступное API.
+    """
+
+    def __init__(self):
+        self.calls = []
+        self.failing = False
+        self.lock = threading.Lock()
+
+    def get_question(self, complexity, user_id=None):
+        if self.failing:
+            raise ConnectionError('API недоступно')
+        with self.lock:
+            self.calls.append((complexity, user_id))
+            return Question(f'Вопрос {len(self.calls)} сложности {complexity}?', ['a', 'b', 'c', 'd'], 'a')
+
+
+def test_prefetching_storage_serves_buffered_questions():
+    source = CountingQuestionStorage()
+    storage = PrefetchingQuestionStorage(source, complexities=('1', '2'), buffer_size=3, workers=2)
+    try:
+        wait_until(lambda: storage.get_stats()['buffered'] == {'1': 3, '2': 3})
+        assert sorted(complexity for complexity, _ in source.calls) == ['1', '1', '1', '2', '2', '2']
+
+        # вопрос берётся из буфера, а буфер пополняется в фоне
+        assert storage.get_question('2', user_id=5).question.endswith('сложности 2?')
+        wait_until(lambda: storage.get_stats()['buffered']['2'] == 3)
+        assert len(source.calls) == 7
+        # сложность, для которой буфера нет, запрашивается сразу
+        storage.get_question('3', user_id=5)
+        assert source.calls[-1] == ('3', 5)
+
+        # пока источник недоступен, буфер опустошается, а затем вопрос запрашивается синхронно
+        source.failing = True
+        for _ in range(3):
+            storage.get_question('1')
+        with pytest.raises(ConnectionError):
+            storage.get_question('1')
+        wait_until(lambda: storage.get_stats()['refill_errors'] >= 3)
+        source.failing = False
+        assert storage.get_question('1', user_id=7).question.endswith('сложности 1?')
+        assert source.calls[-1] == ('1', 7)
+
+        stats = storage.get_stats()
+        assert (stats['hits'], stats['misses']) == (4, 2)
+        wait_until(lambda: storage.get_stats()['buffered']['1'] == 3)
+    finally:
+        storage.close()
+
+
+def test_circuit_breaker_skips_failing_source_and_probes_it():
+    source = CountingQuestionStorage()
+    storage = CompositeQuestionStorage([source, InMemoryQuestionStorage(DEFAULT_QUESTIONS)],
+                                       breaker_factory=lambda: CircuitBreaker(failure_threshold=3, reset_timeout=0.2))
+    breaker = storage.breakers[0]
+    assert storage.get_question('1').question.endswith('сложности 1?')
+
+    # после трёх ошибок подряд источник больше не опрашивается, вопросы берутся из запасного хранилища
+    source.failing = True
+    for _ in range(3):
+        assert storage.get_question('1') in DEFAULT_QUESTIONS
+    assert breaker.get_health()['state'] == 'open'
+    source.failing = False
+    for _ in range(5):
+        assert storage.get_question('1') in DEFAULT_QUESTIONS
+    assert len(source.calls) == 1
+    assert breaker.get_health()['rejected'] == 5
+
+    # пробный запрос после reset_timeout неудачен: предохранитель снова разомкнут
+    time.sleep(0.25)
+    source.failing = True
+    assert breaker.allow_request()
+    assert breaker.get_health()['state'] == 'half_open'
+    # пока пробный запрос не завершён, остальные запросы к источнику не пропускаются
+    assert not breaker.allow_request()
+    breaker.record_failure(0.01)
+    assert breaker.get_health()['state'] == 'open'
+    assert storage.get_question('1') in DEFAULT_QUESTIONS
+
+    # успешный пробный запрос замыкает предохранитель
+    time.sleep(0.25)
+    source.failing = False
+    assert storage.get_question('1').question.endswith('сложности 1?')
+    health = storage.get_health()[0]
+    assert (health['source'], health['state'], health['consecutive_failures']) == \
+           ('CountingQuestionStorage', 'closed', 0)
+    assert storage.get_question('1').question.endswith('сложности 1?')
+    assert len(source.calls) == 3
+
+
+def test_circuit_breaker_opens_on_error_rate():
+    breaker = CircuitBreaker(failure_threshold=3, error_rate_threshold=0.5, window_size=4)
+    # ошибки не идут подряд, но их половина в окне из четырёх запросов
+    for success in [True, False, True]:
+        if success:
+            breaker.record_success(0.01)
+        else:
+            breaker.record_failure(0.01)
+    assert breaker.get_health()['state'] == 'closed'
+    breaker.record_failure(0.01)
+    assert breaker.get_health()['state'] == 'open'
+    assert not breaker.allow_request()
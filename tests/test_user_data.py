@@ -0,0 +1,648 @@
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+
+from collections import Counter
+
+import fakeredis
+import pytest
+
+import user_data
+
+from leaderboard import InMemoryLeaderboard
+from question import Question
+from user_data import InMemoryUserDataStorage, CompactUserDataStorage, RedisUserDataStorage, LazyUserDataStorage, \
+    ShardedRedisUserDataStorage, JournaledFileUserDataStorage, SqliteUserDataStorage, JsonDataStorage, \
+    SegmentedFileJsonSaver, UserRecord, UserRecordStore, state_to_json, state_from_json
+
+questions = [Question(f'Вопрос {i}?', ['a', 'b', 'c', 'd'], 'a') for i in range(3)]
+
+
+def make_legacy_blob(users_count):
+    storage = InMemoryUserDataStorage()
+    for user_id in range(users_count):
+        storage.set_user_complexity(user_id, '2')
+        storage.add_user_victory(user_id)
+        storage.put_user_current_question(user_id, questions[user_id % len(questions)])
+    return json.dumps(state_to_json(storage), ensure_ascii=False)
+
+
+def question_refs(redis_db):
+    return {key.decode(): int(value) for key, value in redis_db.hgetall(RedisUserDataStorage.question_refs_key).items()}
+
+
+def check_top(top, expected, count):
+    # игроки с одинаковым кол-вом побед делят место, поэтому в разных хранилищах они могут идти в разном порядке
+    assert [victories for _, victories in top] == [victories for _, victories in expected.get_top_users(count)]
+    assert len({user_id for user_id, _ in top}) == len(top)
+    for user_id, victories in top:
+        assert expected.get_user_victories_count(user_id) == victories
+
+
+def test_migration_can_be_repeated_after_crash():
+    redis_db = fakeredis.FakeRedis(server=fakeredis.FakeServer())
+    blob = make_legacy_blob(10)
+    redis_db.set(RedisUserDataStorage.legacy_key, blob)
+    storage = RedisUserDataStorage(redis_db=redis_db)
+    assert storage.migrate_from_json_blob() == 10
+
+    # сбой перед переименованием старого ключа: при следующем запуске миграция выполняется ещё раз
+    redis_db.delete(f'{RedisUserDataStorage.legacy_key}.migrated')
+    redis_db.set(RedisUserDataStorage.legacy_key, blob)
+    assert RedisUserDataStorage(redis_db=redis_db).migrate_from_json_blob() == 10
+
+    assert question_refs(redis_db) == {questions[0].id: 4, questions[1].id: 3, questions[2].id: 3}
+    for user_id in range(10):
+        storage.clear_user_current_question(user_id)
+    assert question_refs(redis_db) == {}
+    assert redis_db.hlen(RedisUserDataStorage.questions_key) == 0
+
+
+def test_concurrent_migration_runs_once():
+    server = fakeredis.FakeServer()
+    fakeredis.FakeRedis(server=server).set(RedisUserDataStorage.legacy_key, make_legacy_blob(10))
+    results = []
+    errors = []
+
+    def migrate():
+        try:
+            results.append(RedisUserDataStorage(redis_db=fakeredis.FakeRedis(server=server)).migrate_from_json_blob())
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=migrate) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert sorted(results) == [0, 0, 0, 10]
+    redis_db = fakeredis.FakeRedis(server=server)
+    assert question_refs(redis_db) == {questions[0].id: 4, questions[1].id: 3, questions[2].id: 3}
+    assert not redis_db.exists(RedisUserDataStorage.migration_lock_key)
+
+
+def test_lazy_storage_forgets_expired_questions():
+    store = RedisUserDataStorage(redis_db=fakeredis.FakeRedis(server=fakeredis.FakeServer()), question_ttl=0.2)
+    storage = LazyUserDataStorage(store)
+    storage.put_user_current_question(1, questions[0])
+    storage.put_user_current_question(2, questions[1])
+    storage.flush()
+    # у второго пользователя есть несохранённое изменение, которое не должно потеряться
+    storage.set_user_complexity(2, '3')
+
+    time.sleep(0.3)
+    assert sorted(storage.expire_questions()) == [1, 2]
+
+    assert storage.get_user_current_question(1) is None
+    assert storage.get_user_current_question(2) is None
+    assert storage.get_user_complexity(2) == '3'
+    storage.flush()
+    assert store.get_user_complexity(2) == '3'
+    assert store.get_user_current_question(2) is None
+
+
+class SlowRecordStore(UserRecordStore):
+    """
+    Хранилище состояния пользователей в памяти, каждое обращение к которому занимает delay секунд.
+    """
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.records = {}
+        self.reads = Counter()
+
+    def get_user_record(self, user_id):
+        self.reads[user_id] += 1
+        time.sleep(self.delay)
+        record = self.records.get(user_id, UserRecord())
+        return UserRecord(record.complexity, record.victories, record.defeats, record.question)
+
+    def put_user_records(self, records):
+        time.sleep(self.delay)
+        for user_id, record in records.items():
+            self.records[user_id] = UserRecord(record.complexity, record.victories, record.defeats, record.question)
+        return []
+
+
+def run_in_threads(functions):
+    threads = [threading.Thread(target=function) for function in functions]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def test_lazy_storage_reads_users_in_parallel():
+    store = SlowRecordStore(0.2)
+    storage = LazyUserDataStorage(store)
+
+    start = time.monotonic()
+    run_in_threads([lambda user_id=user_id: storage.get_user_victories_count(user_id) for user_id in range(10)] +
+                   [lambda: storage.get_user_victories_count(100) for _ in range(10)])
+    # по очереди чтение заняло бы не меньше 2.2 секунд
+    assert time.monotonic() - start < 1.0
+    assert store.reads[100] == 1
+
+
+def test_lazy_storage_serves_cached_users_during_flush():
+    store = SlowRecordStore(0.5)
+    storage = LazyUserDataStorage(store)
+    storage.get_user_victories_count(1)
+    storage.add_user_victory(2)
+
+    flush_thread = threading.Thread(target=storage.flush)
+    flush_thread.start()
+    time.sleep(0.1)
+    start = time.monotonic()
+    assert storage.get_user_victories_count(1) == 0
+    storage.add_user_victory(1)
+    assert time.monotonic() - start < 0.1
+    flush_thread.join()
+
+    storage.flush()
+    assert store.records[1].victories == 1
+    assert store.records[2].victories == 1
+
+
+class InterferingRecordStore(SlowRecordStore):
+    """
+    Хранилище, пользователя в котором меняют во время записи: другой поток того же экземпляра бота
+    (during_put) или другой экземпляр бота (conflicting_user_ids - запись этих пользователей отклоняется).
+    """
+
+    def __init__(self):
+        super().__init__(0)
+        self.during_put = None
+        self.conflicting_user_ids = []
+
+    def put_user_records(self, records):
+        if self.during_put is not None:
+            during_put, self.during_put = self.during_put, None
+            during_put()
+        conflicts = [user_id for user_id in records if user_id in self.conflicting_user_ids]
+        self.conflicting_user_ids = []
+        super().put_user_records({user_id: record for user_id, record in records.items() if user_id not in conflicts})
+        return conflicts
+
+
+def test_lazy_storage_replays_only_unwritten_changes():
+    store = InterferingRecordStore()
+    storage = LazyUserDataStorage(store)
+    storage.add_user_victory(1)
+    # пока первая победа записывается, пользователь одерживает вторую: она остаётся несохранённой
+    store.during_put = lambda: storage.add_user_victory(1)
+    storage.flush()
+    assert store.records[1].victories == 1
+
+    # третью победу записал другой экземпляр бота: вторая применяется к свежему состоянию ровно один раз
+    store.records[1].victories += 1
+    store.conflicting_user_ids = [1]
+    storage.flush()
+    assert store.records[1].victories == 3
+    assert storage.get_user_victories_count(1) == 3
+    assert storage.get_stats()['dirty'] == 0
+
+
+def test_lazy_storage_ranks_unsaved_victories_without_writing(tmp_path):
+    # max_users=20: часть пользователей вытесняется и записывается, а у остальных победы только в памяти
+    for max_users in [100, 20]:
+        storage = LazyUserDataStorage(SqliteUserDataStorage(str(tmp_path / f'storage{max_users}.db')),
+                                      max_users=max_users)
+        expected = InMemoryUserDataStorage()
+        rnd = random.Random(max_users)
+        for i in range(1, 2001):
+            user_id = rnd.randrange(50)
+            storage.add_user_victory(user_id)
+            expected.add_user_victory(user_id)
+            if i == 1000:
+                storage.flush()
+            if i % 250 == 0:
+                write_backs = storage.get_stats()['write_backs']
+                check_top(storage.get_top_users(10), expected, 10)
+                for rank_user_id in range(0, 55, 5):
+                    assert storage.get_user_rank(rank_user_id) == expected.get_user_rank(rank_user_id)
+                if max_users == 100:
+                    assert storage.get_stats()['write_backs'] == write_backs
+        storage.close()
+
+
+def test_sharded_storage_rebalances_users_when_shards_change():
+    clients = {name: fakeredis.FakeRedis(server=fakeredis.FakeServer()) for name in ['a', 'b', 'c']}
+    storage = ShardedRedisUserDataStorage(redis_clients={name: clients[name] for name in ['a', 'b']})
+    assert storage.rebalance() == 0
+    for user_id in range(50):
+        for _ in range(user_id % 4):
+            storage.add_user_victory(user_id)
+        storage.put_user_current_question(user_id, questions[user_id % len(questions)])
+
+    def check(storage):
+        for user_id in range(50):
+            assert storage.get_user_victories_count(user_id) == user_id % 4
+            assert storage.get_user_current_question(user_id).id == questions[user_id % len(questions)].id
+            for shard in storage.shards.values():
+                stored = shard.redis_db.exists(RedisUserDataStorage.user_key(user_id))
+                assert stored == (shard is storage.shard_for(user_id))
+        assert storage.get_user_rank(3) == 1
+        refs = sum(sum(int(value) for value in shard.redis_db.hvals(RedisUserDataStorage.question_refs_key))
+                   for shard in storage.shards.values())
+        assert refs == 50
+
+    # добавлен шард c
+    storage = ShardedRedisUserDataStorage(redis_clients=clients)
+    assert storage.rebalance() > 0
+    check(storage)
+    assert storage.rebalance() == 0
+
+    # убран шард b: его пользователи переносятся на оставшиеся шарды
+    storage = ShardedRedisUserDataStorage(redis_clients={name: clients[name] for name in ['a', 'c']})
+    assert storage.rebalance(retired_clients={'b': clients['b']}) > 0
+    check(storage)
+    assert not clients['b'].keys(RedisUserDataStorage.user_key('*'))
+
+
+def test_compact_leaderboard_matches_in_memory_leaderboard():
+    storage = InMemoryUserDataStorage()
+    compact_storage = CompactUserDataStorage()
+    rnd = random.Random(1)
+    for _ in range(20000):
+        user_id = rnd.randrange(1, 1000)
+        storage.add_user_victory(user_id)
+        compact_storage.add_user_victory(user_id)
+
+    loaded_storage = CompactUserDataStorage()
+    state_from_json(loaded_storage, state_to_json(compact_storage))
+    for compared_storage in [compact_storage, loaded_storage]:
+        for user_id in range(1, 1010):
+            assert compared_storage.get_user_rank(user_id) == storage.get_user_rank(user_id)
+        for count in [1, 10, 100, 500]:
+            check_top(compared_storage.get_top_users(count), storage, count)
+
+
+def test_compact_storage_matches_in_memory_storage():
+    storage = InMemoryUserDataStorage()
+    compact_storage = CompactUserDataStorage(capacity=8)
+    rnd = random.Random(2)
+    # telegram-ID бывают больше 2^32, а пользователей намного больше начального кол-ва ячеек
+    user_ids = [rnd.randrange(1, 2 ** 40) for _ in range(3000)]
+    for _ in range(20000):
+        user_id = rnd.choice(user_ids)
+        action = rnd.randrange(4)
+        for compared_storage in [storage, compact_storage]:
+            if action == 0:
+                compared_storage.add_user_victory(user_id)
+            elif action == 1:
+                compared_storage.add_user_defeat(user_id)
+            elif action == 2:
+                compared_storage.set_user_complexity(user_id, str(1 + user_id % 3))
+            else:
+                compared_storage.put_user_current_question(user_id, questions[user_id % len(questions)])
+
+    loaded_storage = CompactUserDataStorage()
+    state_from_json(loaded_storage, state_to_json(compact_storage))
+    assert state_to_json(loaded_storage) == state_to_json(storage)
+    for compared_storage in [compact_storage, loaded_storage]:
+        for user_id in user_ids[:500] + [1, 2 ** 41]:
+            assert compared_storage.get_user_complexity(user_id) == storage.get_user_complexity(user_id)
+            assert compared_storage.get_user_victories_count(user_id) == storage.get_user_victories_count(user_id)
+            assert compared_storage.get_user_defeats_count(user_id) == storage.get_user_defeats_count(user_id)
+            question = compared_storage.get_user_current_question(user_id)
+            expected_question = storage.get_user_current_question(user_id)
+            assert (question and question.id) == (expected_question and expected_question.id)
+
+    # нулём помечены свободные ячейки таблицы
+    with pytest.raises(ValueError):
+        compact_storage.add_user_victory(0)
+    assert compact_storage.get_user_victories_count(0) == 0
+
+
+def test_leaderboard_lists_ties_in_order_reached():
+    leaderboard = InMemoryLeaderboard.from_scores({user_id: 1 for user_id in range(100000, 0, -1)})
+    leaderboard.set_score(7, 2)
+    leaderboard.set_score(7, 1)
+    assert leaderboard.get_top(3) == [(100000, 1), (99999, 1), (99998, 1)]
+    assert leaderboard.get_top(100000)[-1] == (7, 1)
+    assert leaderboard.get_rank(7) == 1
+
+
+def count_committed_victories(file_name):
+    db = sqlite3.connect(file_name)
+    try:
+        return db.execute('SELECT COALESCE(SUM(victories), 0) FROM users').fetchone()[0]
+    finally:
+        db.close()
+
+
+def test_sqlite_group_commit_is_durable_after_close(tmp_path):
+    file_name = str(tmp_path / 'storage.db')
+    # интервал больше времени теста: изменения фиксирует только close
+    storage = SqliteUserDataStorage(file_name, group_commit_interval=60)
+    run_in_threads([lambda user_id=user_id: [storage.add_user_victory(user_id) for _ in range(50)]
+                    for user_id in range(1, 9)])
+    storage.put_user_current_question(1, questions[0])
+    assert storage.get_user_victories_count(1) == 50
+    assert storage.get_user_rank(1) == 1
+    assert storage.commits_count == 0
+    assert count_committed_victories(file_name) == 0
+    storage.close()
+    assert storage.commits_count == 1
+
+    storage = SqliteUserDataStorage(file_name, group_commit_interval=0.05)
+    for user_id in range(1, 9):
+        assert storage.get_user_victories_count(user_id) == 50
+    assert storage.get_user_current_question(1).id == questions[0].id
+    # фоновый поток фиксирует изменения без close
+    storage.add_user_victory(9)
+    deadline = time.monotonic() + 5
+    while count_committed_victories(file_name) != 401:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    storage.close()
+
+    # без group_commit_interval каждое изменение фиксируется сразу
+    storage = SqliteUserDataStorage(file_name)
+    storage.add_user_victory(9)
+    assert count_committed_victories(file_name) == 402
+    storage.close()
+
+
+def test_sqlite_rank_is_counted_by_victories(tmp_path):
+    # база без таблицы victory_counts, как до её появления
+    file_name = str(tmp_path / 'storage.db')
+    db = sqlite3.connect(file_name)
+    db.execute('CREATE TABLE users (user_id INTEGER PRIMARY KEY, complexity TEXT, '
+               'victories INTEGER NOT NULL DEFAULT 0, defeats INTEGER NOT NULL DEFAULT 0, question_id TEXT)')
+    db.executemany('INSERT INTO users (user_id, victories) VALUES (?, ?)', [(i, i % 7) for i in range(100)])
+    db.commit()
+    db.close()
+
+    storage = SqliteUserDataStorage(file_name)
+    expected = InMemoryUserDataStorage()
+    for user_id in range(100):
+        for _ in range(user_id % 7):
+            expected.add_user_victory(user_id)
+    rnd = random.Random(1)
+    for _ in range(300):
+        user_id = rnd.randrange(120)
+        if rnd.random() < 0.1:
+            record = storage.get_user_record(user_id)
+            record.victories = rnd.randrange(10)
+            storage.put_user_records({user_id: record})
+            expected.user_victories[user_id] = record.victories
+            expected.leaderboard.set_score(user_id, record.victories)
+        else:
+            storage.add_user_victory(user_id)
+            expected.add_user_victory(user_id)
+    for user_id in range(120):
+        assert storage.get_user_rank(user_id) == expected.get_user_rank(user_id)
+    check_top(storage.get_top_users(10), expected, 10)
+    storage.close()
+
+
+def test_redis_put_user_records_rejects_stale_versions():
+    server = fakeredis.FakeServer()
+    first = RedisUserDataStorage(redis_db=fakeredis.FakeRedis(server=server))
+    second = RedisUserDataStorage(redis_db=fakeredis.FakeRedis(server=server))
+    first_record = first.get_user_record(1)
+    second_record = second.get_user_record(1)
+
+    first_record.victories += 1
+    assert first.put_user_records({1: first_record}) == []
+    second_record.victories += 1
+    assert second.put_user_records({1: second_record}) == [1]
+    assert first.get_user_victories_count(1) == 1
+
+
+def test_two_lazy_instances_do_not_lose_updates():
+    server = fakeredis.FakeServer()
+    first = LazyUserDataStorage(RedisUserDataStorage(redis_db=fakeredis.FakeRedis(server=server)))
+    second = LazyUserDataStorage(RedisUserDataStorage(redis_db=fakeredis.FakeRedis(server=server)))
+
+    # оба экземпляра прочитали пользователя до того, как другой записал свои изменения
+    first.add_user_victory(1)
+    second.add_user_victory(1)
+    second.put_user_current_question(1, questions[0])
+    first.flush()
+    second.flush()
+
+    assert second.get_stats()['conflicts'] == 1
+    assert second.get_user_victories_count(1) == 2
+    store = RedisUserDataStorage(redis_db=fakeredis.FakeRedis(server=server))
+    assert store.get_user_victories_count(1) == 2
+    assert store.get_user_current_question(1).id == questions[0].id
+    assert store.get_user_rank(1) == 1
+
+
+def test_two_lazy_instances_under_concurrent_load():
+    server = fakeredis.FakeServer()
+    instances = [LazyUserDataStorage(RedisUserDataStorage(redis_db=fakeredis.FakeRedis(server=server)),
+                                     max_users=5, flush_interval=0.01) for _ in range(2)]
+
+    def play(seed):
+        rnd = random.Random(seed)
+        for _ in range(200):
+            instances[seed % 2].add_user_victory(rnd.randrange(10))
+
+    run_in_threads([lambda seed=seed: play(seed) for seed in range(6)])
+    for instance in instances:
+        instance.close()
+
+    store = RedisUserDataStorage(redis_db=fakeredis.FakeRedis(server=server))
+    assert sum(store.get_user_victories_count(user_id) for user_id in range(10)) == 1200
+
+
+def test_questions_are_removed_when_nobody_is_asked_them():
+    for storage in [InMemoryUserDataStorage(), RedisUserDataStorage(redis_db=fakeredis.FakeRedis())]:
+        storage.put_user_current_question(1, questions[0])
+        storage.put_user_current_question(2, questions[0])
+        # новый вопрос заменяет старый, и ссылка на старый освобождается
+        storage.put_user_current_question(2, questions[1])
+        storage.clear_user_current_question(1)
+        assert storage.get_user_current_question(2).id == questions[1].id
+        storage.clear_user_current_question(2)
+
+        if isinstance(storage, InMemoryUserDataStorage):
+            assert len(storage.question_catalog) == 0
+        else:
+            assert question_refs(storage.redis_db) == {}
+            assert storage.redis_db.hlen(RedisUserDataStorage.questions_key) == 0
+
+
+def test_redis_question_changes_of_different_users_do_not_conflict():
+    storage = RedisUserDataStorage(redis_db=fakeredis.FakeRedis(server=fakeredis.FakeServer()))
+    # каждая попытка транзакции начинается с WATCH: считаем попытки изменить каждого пользователя
+    attempts = Counter()
+    pipeline = storage.redis_db.pipeline
+
+    def counting_pipeline(*args, **kwargs):
+        pipe = pipeline(*args, **kwargs)
+        watch = pipe.watch
+
+        def counting_watch(*names):
+            attempts.update(name for name in names if name.startswith(RedisUserDataStorage.user_key('')))
+            return watch(*names)
+
+        pipe.watch = counting_watch
+        return pipe
+
+    storage.redis_db.pipeline = counting_pipeline
+
+    def play(user_id):
+        for i in range(100):
+            storage.put_user_current_question(user_id, questions[i % len(questions)])
+            storage.clear_user_current_question(user_id)
+
+    run_in_threads([lambda user_id=user_id: play(user_id) for user_id in range(8)])
+
+    assert sum(attempts.values()) == 8 * 200
+    assert question_refs(storage.redis_db) == {}
+    assert storage.redis_db.hlen(RedisUserDataStorage.questions_key) == 0
+
+
+def crash(storage):
+    # бот упал: журнал не свёрнут в снимок, файл не закрыт
+    storage.stopped.set()
+    storage.compaction_thread.join()
+    storage.journal.flush()
+
+
+def check_journaled_state(storage, victories):
+    assert storage.get_user_victories_count(1) == victories
+    assert storage.get_user_complexity(1) == '3'
+    assert storage.get_user_current_question(1).id == questions[1].id
+    assert storage.get_user_current_question(2) is None
+
+
+def test_journal_is_replayed_after_crash(tmp_path):
+    file_name = str(tmp_path / 'storage.json')
+    storage = JournaledFileUserDataStorage(file_name)
+    storage.set_user_complexity(1, '3')
+    storage.add_user_victory(1)
+    storage.put_user_current_question(1, questions[0])
+    storage.put_user_current_question(2, questions[0])
+    storage.compact()
+    storage.put_user_current_question(1, questions[1])
+    storage.clear_user_current_question(2)
+    storage.add_user_victory(1)
+    crash(storage)
+
+    storage = JournaledFileUserDataStorage(file_name)
+    check_journaled_state(storage, 2)
+    crash(storage)
+
+    # падение посреди записи: последняя строка журнала недописана
+    with open(f'{file_name}.journal', 'a', encoding='utf-8') as f:
+        f.write('{"op":"victory","us')
+    storage = JournaledFileUserDataStorage(file_name)
+    check_journaled_state(storage, 2)
+    storage.add_user_victory(1)
+    crash(storage)
+
+    storage = JournaledFileUserDataStorage(file_name)
+    check_journaled_state(storage, 3)
+    assert len(storage.in_memory_storage.question_catalog) == 1
+    storage.close()
+
+    storage = JournaledFileUserDataStorage(file_name)
+    check_journaled_state(storage, 3)
+    storage.close()
+
+
+def test_journal_is_replayed_after_crash_during_compaction(tmp_path):
+    file_name = str(tmp_path / 'storage.json')
+    storage = JournaledFileUserDataStorage(file_name)
+    storage.set_user_complexity(1, '3')
+    storage.put_user_current_question(1, questions[1])
+    storage.add_user_victory(1)
+    crash(storage)
+    # свёртка успела только переименовать журнал, а снимок не записан
+    os.replace(f'{file_name}.journal', f'{file_name}.journal.compacting')
+
+    storage = JournaledFileUserDataStorage(file_name)
+    check_journaled_state(storage, 1)
+    storage.add_user_victory(1)
+    crash(storage)
+
+    storage = JournaledFileUserDataStorage(file_name)
+    check_journaled_state(storage, 2)
+    storage.close()
+
+
+def test_journal_survives_crash_during_compaction_after_recovery(tmp_path, monkeypatch):
+    file_name = str(tmp_path / 'storage.json')
+    storage = JournaledFileUserDataStorage(file_name)
+    storage.set_user_complexity(1, '3')
+    storage.put_user_current_question(1, questions[1])
+    storage.add_user_victory(1)
+    crash(storage)
+    os.replace(f'{file_name}.journal', f'{file_name}.journal.compacting')
+
+    # после восстановления журнал .compacting уже свёрнут в снимок
+    storage = JournaledFileUserDataStorage(file_name)
+    assert not os.path.exists(f'{file_name}.journal.compacting')
+    storage.add_user_victory(1)
+
+    # следующая свёртка падает, не записав снимок
+    def fail(file_name, json_data, indent=None):
+        raise OSError('диск переполнен')
+
+    monkeypatch.setattr(user_data, 'write_json_atomically', fail)
+    with pytest.raises(OSError):
+        storage.compact()
+    crash(storage)
+    monkeypatch.undo()
+
+    storage = JournaledFileUserDataStorage(file_name)
+    check_journaled_state(storage, 2)
+    storage.close()
+
+
+def read_segments(directory_name):
+    segments = {}
+    for file_name in sorted(os.listdir(directory_name)):
+        with open(os.path.join(directory_name, file_name), encoding='utf-8') as f:
+            segments[file_name] = f.read()
+    return segments
+
+
+def test_segmented_saver_rewrites_only_changed_segments(tmp_path, monkeypatch):
+    directory_name = str(tmp_path / 'segments')
+    saver = SegmentedFileJsonSaver(directory_name, segment_size=100)
+    storage = JsonDataStorage(saver)
+    for user_id in [5, 150, 250]:
+        storage.add_user_victory(user_id)
+        storage.put_user_current_question(user_id, questions[user_id % len(questions)])
+    assert sorted(os.listdir(directory_name)) == ['segment_0.json', 'segment_1.json', 'segment_2.json']
+
+    # изменение пользователя 150 перезаписывает только его сегмент
+    before = read_segments(directory_name)
+    written_count = saver.segments_written_count
+    storage.clear_user_current_question(150)
+    assert saver.segments_written_count == written_count + 1
+    after = read_segments(directory_name)
+    assert [file_name for file_name in before if before[file_name] != after[file_name]] == ['segment_1.json']
+    # вопрос, который в сегменте больше никому не задан, из него удаляется
+    assert json.loads(after['segment_1.json'])['questions'] == {}
+
+    # сегмент подменяется только целиком: если запись не удалась, остаётся прежний сегмент,
+    # а изменение сохраняется при следующей попытке
+    def fail(src, dst):
+        raise OSError('диск переполнен')
+
+    monkeypatch.setattr(os, 'replace', fail)
+    with pytest.raises(OSError):
+        storage.add_user_victory(250)
+    assert read_segments(directory_name)['segment_2.json'] == after['segment_2.json']
+    monkeypatch.undo()
+    storage.flush()
+
+    loaded_storage = JsonDataStorage(SegmentedFileJsonSaver(directory_name, segment_size=100))
+    for field in ['user_victories', 'user_defeats', 'user_current_questions']:
+        assert state_to_json(loaded_storage.in_memory_storage)[field] == state_to_json(storage.in_memory_storage)[field]
+    assert loaded_storage.get_user_victories_count(250) == 2
+    assert loaded_storage.get_user_current_question(150) is None
+    assert loaded_storage.get_user_current_question(5).id == questions[5 % len(questions)].id
@@ -0,0 +1,86 @@
+import json
+import threading
+import urllib.error
+import urllib.request
+
+from telebot.types import Update
+
+from webhook import ShardedUpdateProcessor, WebhookServer, get_update_user_id
+
+
+def make_update_json(update_id, user_id, text='привет'):
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id, 'date': 0, 'text': text,
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'Игрок'}
+        }
+    }
+
+
+def test_updates_of_one_user_are_processed_in_order():
+    processed = []
+    lock = threading.Lock()
+
+    def process_update(update):
+        with lock:
+            processed.append((get_update_user_id(update), update.update_id))
+
+    processor = ShardedUpdateProcessor(process_update, shards=4, queue_size=1000)
+    for update_id in range(400):
+        assert processor.submit(Update.de_json(make_update_json(update_id, user_id=update_id % 10)))
+    processor.close()
+
+    assert len(processed) == 400
+    for user_id in range(10):
+        assert [update_id for processed_user_id, update_id in processed if processed_user_id == user_id] == \
+               list(range(user_id, 400, 10))
+
+
+def post(url, data, secret_token=None):
+    request = urllib.request.Request(url, data=data, method='POST')
+    if secret_token is not None:
+        request.add_header('X-Telegram-Bot-Api-Secret-Token', secret_token)
+    try:
+        with urllib.request.urlopen(request, timeout=5) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def test_webhook_server_rejects_updates_when_shard_queue_is_full():
+    started = threading.Event()
+    released = threading.Event()
+
+    def process_update(update):
+        started.set()
+        released.wait(5)
+
+    processor = ShardedUpdateProcessor(process_update, shards=2, queue_size=1)
+    secret_token = 'secret'
+    server = WebhookServer(('127.0.0.1', 0), processor, path='/hook', secret_token=secret_token)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_address[1]}/hook'
+
+    def post_update(update_id, user_id):
+        return post(url, json.dumps(make_update_json(update_id, user_id)).encode(), secret_token)
+
+    try:
+        assert post(url, json.dumps(make_update_json(1, 2)).encode()) == 403
+        assert post(url.replace('/hook', '/other'), b'{}', secret_token) == 404
+        assert post(url, b'not json', secret_token) == 400
+
+        # пользователь 2 занимает обработчик 0: первое обновление обрабатывается, второе ждёт в очереди,
+        # третье не помещается, а обновления пользователя 1 попадают в другую очередь
+        assert post_update(1, 2) == 200
+        assert started.wait(5)
+        assert post_update(2, 2) == 200
+        assert post_update(3, 2) == 503
+        assert post_update(4, 1) == 200
+        assert processor.get_queue_sizes()[0] == 1
+    finally:
+        released.set()
+        server.shutdown()
+        server.server_close()
+        processor.close()
@@ -1,9 +1,69 @@
+import bisect
+import functools
+import hashlib
+import heapq
+import itertools
 import json
+import logging
 import os
+import sqlite3
+import threading
+import time
+
 import redis
 
+import metrics
+
 from abc import abstractmethod
-from question import Question
+from array import array
+from collections import OrderedDict
+from concurrent.futures import Future
+from leaderboard import InMemoryLeaderboard, CompactLeaderboard
+from question import Question, QuestionCatalog
+
+# допустимые значения сложности игры и сложность, которая используется, если пользователь ничего не выбирал
+ACCEPTABLE_COMPLEXITIES = ['1', '2', '3']
+DEFAULT_COMPLEXITY = '1'
+
+
+def question_to_json(question):
+    """
+    Преобразует вопрос в json-представление для сохранения.
+
+    :param question: вопрос (Question)
+    :return: вопрос в виде json (map)
+    """
+    return {
+        'question': question.question,
+        'answers': question.answers,
+        'correct_answer': question.correct_answer
+    }
+
+
+def question_from_json(question_json):
+    """
+    Восстанавливает вопрос из json-представления, полученного через question_to_json.
+
+    :param question_json: вопрос в виде json (map)
+    :return: вопрос (Question)
+    """
+    return Question(
+        question_json['question'],
+        question_json['answers'],
+        question_json['correct_answer']
+    )
+
+
+def check_complexity(complexity):
+    """
+    Проверяет, что сложность игры имеет допустимое значение. Если это не так, происходит
+    исключительная ситуация (ValueError).
+
+    :param complexity: сложность игры (str)
+    """
+    if complexity not in ACCEPTABLE_COMPLEXITIES:
+        raise ValueError(f'Недопустимое значение для сложности игры: {complexity}, '
+                         f'допустимые значения: {",".join(ACCEPTABLE_COMPLEXITIES)}')
 
 
 class UserDataStorage:
@@ -94,38 +154,182 @@ class UserDataStorage:
         """
         pass
 
+    @abstractmethod
+    def get_user_rank(self, user_id):
+        """
+        Возвращает место пользователя в рейтинге по кол-ву побед, начиная с 1 (int). Пользователи с одинаковым
+        кол-вом побед делят место.
+
+        :param user_id: telegram-ID пользователя (int)
+        """
+        pass
+
+    @abstractmethod
+    def get_top_users(self, count):
+        """
+        Возвращает лучших пользователей по кол-ву побед: список пар (telegram-ID, кол-во побед), от большего
+        кол-ва побед к меньшему ([(int, int)]).
+
+        :param count: сколько пользователей вернуть (int)
+        """
+        pass
+
+    def expire_questions(self):
+        """
+        Удаляет текущие вопросы, на которые пользователи не ответили за отведённое время. Хранилища, в которых
+        время на ответ не ограничено или вопросы истекают сами, ничего не делают.
+
+        :return: telegram-ID пользователей, у которых удалён вопрос ([int])
+        """
+        return []
+
+
+class UserRecord:
+    """
+    Всё состояние одного пользователя: выбранная сложность, счётчики побед и поражений и текущий вопрос.
+    """
+
+    __slots__ = ('complexity', 'victories', 'defeats', 'question', 'version')
+
+    def __init__(self, complexity=None, victories=0, defeats=0, question=None, version=None):
+        """
+        :param complexity: выбранная сложность (str) или None, если пользователь её не выбирал
+        :param victories: кол-во побед (int)
+        :param defeats: кол-во поражений (int)
+        :param question: текущий вопрос (Question) или None
+        :param version: версия состояния в хранилище, из которого оно прочитано (int), или None, если хранилище
+        версий не ведёт
+        """
+        self.complexity = complexity
+        self.victories = victories
+        self.defeats = defeats
+        self.question = question
+        self.version = version
+
+    def copy(self):
+        return UserRecord(self.complexity, self.victories, self.defeats, self.question, self.version)
+
+
+class UserRecordStore:
+    """
+    Хранилище, которое умеет читать и записывать состояние пользователя целиком (UserRecord), не загружая
+    состояние остальных пользователей. Используется LazyUserDataStorage.
+    """
+
+    @abstractmethod
+    def get_user_record(self, user_id):
+        """
+        Возвращает состояние пользователя (UserRecord); для неизвестного пользователя - состояние по умолчанию.
+
+        :param user_id: telegram-ID пользователя (int)
+        """
+        pass
+
+    @abstractmethod
+    def put_user_records(self, records):
+        """
+        Записывает состояние нескольких пользователей, заменяя сохранённое раньше. Если хранилище ведёт версии,
+        то состояние с версией (UserRecord.version) записывается, только если с момента чтения его никто
+        не изменил, и после записи получает новую версию; остальные записываются без проверки.
+
+        :param records: состояние каждого пользователя ({int: UserRecord})
+        :return: telegram-ID пользователей, состояние которых не записано, потому что его изменил кто-то другой ([int])
+        """
+        pass
+
+    @abstractmethod
+    def count_users_with_more_victories(self, victories):
+        """
+        :param victories: кол-во побед (int)
+        :return: кол-во пользователей, у которых в хранилище записано больше побед (int)
+        """
+        pass
+
+    def subscribe_to_changes(self, callback):
+        """
+        Подписывается на изменения состояния пользователей, которые делают другие экземпляры бота, работающие
+        с тем же хранилищем. Хранилище, которое не разделяется между экземплярами, ничего не делает.
+
+        :param callback: функция, которая вызывается с telegram-ID изменённого пользователя (int)
+        :return: функция, которая отменяет подписку
+        """
+        return lambda: None
+
 
 class InMemoryUserDataStorage(UserDataStorage):
 
-    def __init__(self):
-        # для каждого пользователя храним текущий активный вопрос
+    def __init__(self, question_ttl=None):
+        """
+        :param question_ttl: сколько секунд пользователь может отвечать на вопрос, прежде чем expire_questions
+        удалит вопрос (float); None - без ограничения
+        """
+        # для каждого пользователя храним текущий активный вопрос; сами вопросы хранятся в каталоге
+        # в единственном экземпляре
         self.user_current_questions = {}
+        self.question_catalog = QuestionCatalog()
+
+        # когда истекает текущий вопрос каждого пользователя и куча (срок, telegram-ID) для поиска истёкших;
+        # в куче остаются и устаревшие сроки (пользователь ответил или получил новый вопрос), они пропускаются
+        self.question_ttl = question_ttl
+        self.question_deadlines = {}
+        self.question_deadline_heap = []
+        self.expired_questions_count = 0
 
         # для каждого пользователя храним предпочитаемую сложность
         self.user_complexity = {}
-        self.acceptable_complexities = ['1', '2', '3']
-        self.default_complexity = '1'
+        self.acceptable_complexities = ACCEPTABLE_COMPLEXITIES
+        self.default_complexity = DEFAULT_COMPLEXITY
 
         # для каждого пользователя храним счётчик его побед и поражений
         self.user_victories = {}
         self.user_defeats = {}
 
+        # рейтинг пользователей по кол-ву побед, который обновляется при каждой победе
+        self.leaderboard = InMemoryLeaderboard()
+
     def get_user_current_question(self, user_id):
         return self.user_current_questions.get(user_id)
 
     def put_user_current_question(self, user_id, question):
-        self.user_current_questions[user_id] = question
+        previous_question = self.user_current_questions.get(user_id)
+        self.user_current_questions[user_id] = self.question_catalog.acquire(question)
+        if previous_question is not None:
+            self.question_catalog.release(previous_question.id)
+        if self.question_ttl is not None:
+            deadline = time.monotonic() + self.question_ttl
+            self.question_deadlines[user_id] = deadline
+            heapq.heappush(self.question_deadline_heap, (deadline, user_id))
 
     def clear_user_current_question(self, user_id):
-        del self.user_current_questions[user_id]
+        question = self.user_current_questions.pop(user_id)
+        self.question_catalog.release(question.id)
+        self.question_deadlines.pop(user_id, None)
+
+    def pop_expired_questions(self, now=None):
+        """
+        Удаляет текущие вопросы, срок ответа на которые истёк.
+
+        :param now: текущее время по time.monotonic (float)
+        :return: telegram-ID пользователей, у которых удалён вопрос ([int])
+        """
+        now = time.monotonic() if now is None else now
+        expired_user_ids = []
+        while self.question_deadline_heap and self.question_deadline_heap[0][0] <= now:
+            deadline, user_id = heapq.heappop(self.question_deadline_heap)
+            if self.question_deadlines.get(user_id) == deadline and user_id in self.user_current_questions:
+                self.clear_user_current_question(user_id)
+                expired_user_ids.append(user_id)
+        self.expired_questions_count += len(expired_user_ids)
+        return expired_user_ids
+
+    def expire_questions(self):
+        return self.pop_expired_questions()
 
     def get_user_complexity(self, user_id):
         return self.user_complexity.get(user_id, self.default_complexity)
 
     def set_user_complexity(self, user_id, complexity):
-        if complexity not in self.acceptable_complexities:
-            raise ValueError(f'Недопустимое значение для сложности игры: {complexity}, '
-                             f'допустимые значения: {",".join(self.acceptable_complexities)}')
+        check_complexity(complexity)
         self.user_complexity[user_id] = complexity
 
     def get_user_victories_count(self, user_id):
@@ -136,10 +340,310 @@ class InMemoryUserDataStorage(UserDataStorage):
 
     def add_user_victory(self, user_id):
         self.user_victories[user_id] = self.get_user_victories_count(user_id) + 1
+        self.leaderboard.set_score(user_id, self.user_victories[user_id])
 
     def add_user_defeat(self, user_id):
         self.user_defeats[user_id] = self.get_user_defeats_count(user_id) + 1
 
+    def rebuild_leaderboard(self):
+        """
+        Заново строит рейтинг по кол-ву побед; нужен после того, как состояние загружено целиком.
+        """
+        self.leaderboard = InMemoryLeaderboard.from_scores(self.user_victories)
+
+    def get_user_rank(self, user_id):
+        return self.leaderboard.get_rank(user_id)
+
+    def get_top_users(self, count):
+        return self.leaderboard.get_top(count)
+
+
+class CompactUserDataStorage(InMemoryUserDataStorage):
+    """
+    Компактный вариант InMemoryUserDataStorage для миллионов пользователей. Вместо отдельного словаря на каждое поле
+    (где каждый telegram-ID и каждое значение - отдельный объект Python) используется собственная хэш-таблица
+    с открытой адресацией: telegram-ID, победы, поражения и сложность хранятся в типизированных массивах по номеру
+    ячейки таблицы, всего около 17 байт на пользователя (с учётом свободных ячеек - 25-35 байт). Текущие вопросы
+    хранятся так же, как в InMemoryUserDataStorage: их немного.
+
+    Поля user_complexity, user_victories и user_defeats доступны как словари (они собираются при обращении),
+    поэтому состояние сохраняется и загружается через state_to_json/state_from_json так же, как обычное.
+    telegram-ID 0 хранить нельзя: нулём помечаются свободные ячейки.
+
+    Рейтинг (CompactLeaderboard) тоже не хранит ничего на каждого пользователя: место считается по кол-ву побед
+    из массива, а в памяти держатся только лучшие игроки.
+    """
+
+    # начальное кол-во ячеек (степень двойки) и максимальная доля занятых ячеек, после которой таблица растёт
+    initial_capacity = 1024
+    max_load_factor = 0.75
+
+    def __init__(self, capacity=None, question_ttl=None):
+        """
+        :param capacity: начальное кол-во ячеек хэш-таблицы, степень двойки (int)
+        :param question_ttl: сколько секунд пользователь может отвечать на вопрос (float); None - без ограничения
+        """
+        self.__allocate(capacity or self.initial_capacity)
+        super().__init__(question_ttl)
+        self.leaderboard = CompactLeaderboard()
+
+    def __allocate(self, capacity):
+        self.size = 0
+        self.keys = array('q', bytes(8 * capacity))
+        # сложность хранится числом, 0 - пользователь сложность не выбирал
+        self.victories = array('I', bytes(4 * capacity))
+        self.defeats = array('I', bytes(4 * capacity))
+        self.complexities = array('B', bytes(capacity))
+
+    def __find(self, user_id):
+        # номер ячейки, в которой лежит пользователь, или свободной ячейки, куда его можно положить
+        keys = self.keys
+        mask = len(keys) - 1
+        i = (user_id * 0x9E3779B1) & mask
+        while True:
+            key = keys[i]
+            if key == user_id or key == 0:
+                return i
+            i = (i + 1) & mask
+
+    def __get_slot(self, user_id):
+        i = self.__find(user_id)
+        return i if self.keys[i] != 0 else None
+
+    def __slot(self, user_id):
+        i = self.__find(user_id)
+        if self.keys[i] == 0:
+            if user_id == 0:
+                raise ValueError('telegram-ID 0 не поддерживается')
+            if (self.size + 1) > self.max_load_factor * len(self.keys):
+                self.__grow()
+                i = self.__find(user_id)
+            self.keys[i] = user_id
+            self.size += 1
+        return i
+
+    def __grow(self):
+        old_keys, old_victories, old_defeats, old_complexities = \
+            self.keys, self.victories, self.defeats, self.complexities
+        self.__allocate(2 * len(old_keys))
+        for old_i, user_id in enumerate(old_keys):
+            if user_id != 0:
+                i = self.__find(user_id)
+                self.keys[i] = user_id
+                self.victories[i] = old_victories[old_i]
+                self.defeats[i] = old_defeats[old_i]
+                self.complexities[i] = old_complexities[old_i]
+                self.size += 1
+
+    def __to_map(self, values, value_function=lambda v: v):
+        return {user_id: value_function(values[i]) for i, user_id in enumerate(self.keys)
+                if user_id != 0 and values[i]}
+
+    def __from_map(self, values_name, data, value_function=lambda v: v):
+        values = getattr(self, values_name)
+        for i in range(len(values)):
+            values[i] = 0
+        for user_id, value in data.items():
+            # при росте таблицы массивы создаются заново, поэтому массив берётся по имени после выбора ячейки
+            i = self.__slot(user_id)
+            getattr(self, values_name)[i] = value_function(value)
+
+    @property
+    def user_complexity(self):
+        return self.__to_map(self.complexities, str)
+
+    @user_complexity.setter
+    def user_complexity(self, data):
+        self.__from_map('complexities', data, int)
+
+    @property
+    def user_victories(self):
+        return self.__to_map(self.victories)
+
+    @user_victories.setter
+    def user_victories(self, data):
+        self.__from_map('victories', data)
+
+    @property
+    def user_defeats(self):
+        return self.__to_map(self.defeats)
+
+    @user_defeats.setter
+    def user_defeats(self, data):
+        self.__from_map('defeats', data)
+
+    def get_user_complexity(self, user_id):
+        slot = self.__get_slot(user_id)
+        if slot is None or self.complexities[slot] == 0:
+            return self.default_complexity
+        return str(self.complexities[slot])
+
+    def set_user_complexity(self, user_id, complexity):
+        check_complexity(complexity)
+        slot = self.__slot(user_id)
+        self.complexities[slot] = int(complexity)
+
+    def get_user_victories_count(self, user_id):
+        slot = self.__get_slot(user_id)
+        return 0 if slot is None else self.victories[slot]
+
+    def get_user_defeats_count(self, user_id):
+        slot = self.__get_slot(user_id)
+        return 0 if slot is None else self.defeats[slot]
+
+    def add_user_victory(self, user_id):
+        slot = self.__slot(user_id)
+        self.victories[slot] += 1
+        self.leaderboard.change_score(user_id, self.victories[slot] - 1, self.victories[slot])
+
+    def add_user_defeat(self, user_id):
+        slot = self.__slot(user_id)
+        self.defeats[slot] += 1
+
+    def rebuild_leaderboard(self):
+        self.leaderboard = CompactLeaderboard.from_scores(
+            (user_id, self.victories[i]) for i, user_id in enumerate(self.keys) if user_id != 0)
+
+    def get_user_rank(self, user_id):
+        return self.leaderboard.get_rank(self.get_user_victories_count(user_id))
+
+    def get_top_users(self, count):
+        if count <= self.leaderboard.top_size:
+            return self.leaderboard.get_top(count)
+        # больше лучших игроков, чем помнит рейтинг, приходится искать по всем пользователям
+        best = heapq.nsmallest(count, ((-self.victories[i], user_id) for i, user_id in enumerate(self.keys)
+                                       if user_id != 0 and self.victories[i] > 0))
+        return [(user_id, -victories) for victories, user_id in best]
+
+
+def convert_map(data, key_function=lambda k: k, value_function=lambda v: v):
+    result = {}
+    for k, v in data.items():
+        result[key_function(k)] = value_function(v)
+    return result
+
+
+def state_to_json(in_memory_storage):
+    """
+    Преобразует состояние InMemoryUserDataStorage в json-документ, который понимает JsonDataStorage.
+    Словари копируются, поэтому документ можно сериализовать, не блокируя дальнейшие изменения состояния.
+
+    :param in_memory_storage: состояние бота (InMemoryUserDataStorage)
+    :return: состояние бота, представленное в виде json (map)
+    """
+    return {
+        'questions': convert_map(
+            in_memory_storage.question_catalog.questions,
+            value_function=question_to_json
+        ),
+        'user_current_questions': convert_map(
+            in_memory_storage.user_current_questions,
+            value_function=lambda question: question.id
+        ),
+        'user_complexity': dict(in_memory_storage.user_complexity),
+        'user_victories': dict(in_memory_storage.user_victories),
+        'user_defeats': dict(in_memory_storage.user_defeats)
+    }
+
+
+def state_from_json(in_memory_storage, json_data):
+    """
+    Восстанавливает состояние InMemoryUserDataStorage из json-документа, полученного через state_to_json.
+    Понимает и старый формат, в котором у каждого пользователя хранилась полная копия вопроса.
+
+    :param in_memory_storage: объект, в который загружается состояние (InMemoryUserDataStorage)
+    :param json_data: состояние бота, представленное в виде json (map)
+    """
+    questions = json_data.get('questions', {})
+    in_memory_storage.user_current_questions = {}
+    in_memory_storage.question_catalog = QuestionCatalog()
+    for user_id, question_json in json_data.get('user_current_questions', {}).items():
+        if isinstance(question_json, str):
+            question = in_memory_storage.question_catalog.get(question_json) or \
+                question_from_json(questions[question_json])
+        else:
+            question = question_from_json(question_json)
+        in_memory_storage.put_user_current_question(int(user_id), question)
+
+    in_memory_storage.user_complexity = \
+        convert_map(json_data.get('user_complexity', {}), key_function=int)
+
+    in_memory_storage.user_victories = \
+        convert_map(json_data.get('user_victories', {}), key_function=int)
+
+    in_memory_storage.user_defeats = \
+        convert_map(json_data.get('user_defeats', {}), key_function=int)
+
+    in_memory_storage.rebuild_leaderboard()
+
+
+def users_state_to_json(in_memory_storage, user_ids):
+    """
+    Преобразует в json-документ состояние только перечисленных пользователей. Документ имеет тот же формат,
+    что и state_to_json, и дополнительно содержит список users: пользователь из этого списка, которого нет
+    в каком-то словаре, имеет в нём значение по умолчанию (например, у него нет текущего вопроса).
+    Состояние читается через методы хранилища, поэтому функция не собирает словари CompactUserDataStorage целиком.
+
+    :param in_memory_storage: состояние бота (InMemoryUserDataStorage)
+    :param user_ids: telegram-ID пользователей ([int])
+    :return: состояние пользователей, представленное в виде json (map)
+    """
+    json_data = {
+        'users': list(user_ids),
+        'questions': {},
+        'user_current_questions': {},
+        'user_complexity': {},
+        'user_victories': {},
+        'user_defeats': {}
+    }
+    for user_id in json_data['users']:
+        question = in_memory_storage.get_user_current_question(user_id)
+        if question is not None:
+            json_data['questions'][question.id] = question_to_json(question)
+            json_data['user_current_questions'][user_id] = question.id
+        json_data['user_complexity'][user_id] = in_memory_storage.get_user_complexity(user_id)
+        victories = in_memory_storage.get_user_victories_count(user_id)
+        if victories:
+            json_data['user_victories'][user_id] = victories
+        defeats = in_memory_storage.get_user_defeats_count(user_id)
+        if defeats:
+            json_data['user_defeats'][user_id] = defeats
+    return json_data
+
+
+def write_json_atomically(file_name, json_data, indent=None):
+    """
+    Записывает json-документ в файл так, что после падения бота в файле остаётся либо старый документ, либо
+    новый целиком: документ пишется во временный файл рядом, который затем подменяет старый.
+
+    :param file_name: название файла (str)
+    :param json_data: документ (map)
+    :param indent: отступ при форматировании документа (int) или None, чтобы записать его в одну строку
+    """
+    tmp_file_name = f'{file_name}.tmp'
+    with open(tmp_file_name, 'w', encoding='utf-8') as f:
+        json.dump(json_data, f, ensure_ascii=False, indent=indent)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file_name, file_name)
+    fsync_directory(file_name)
+
+
+def fsync_directory(file_name):
+    """
+    Сбрасывает на диск каталог, в котором лежит файл, чтобы его переименование или удаление не потерялось
+    при падении системы. На системах, где каталог нельзя открыть как файл, ничего не делает.
+
+    :param file_name: название файла (str)
+    """
+    if os.name != 'posix':
+        return
+    fd = os.open(os.path.dirname(os.path.abspath(file_name)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
 
 class JsonSaver:
     """
@@ -188,23 +692,25 @@ class ToFileJsonSaver(JsonSaver):
         return None
 
     def save_to_storage(self, json_data):
-        with open(self.file_name, 'w', encoding='utf-8') as f:
-            json.dump(json_data, f, ensure_ascii=False, indent=4)
+        write_json_atomically(self.file_name, json_data, indent=4)
 
 
 class ToRedisJsonSaver(JsonSaver):
     """
-    Реализация JsonSaver, которая сохраняет состояние в Redis.
+    Реализация JsonSaver, которая сохраняет состояние в Redis. Каждое сохранение перезаписывает всё состояние,
+    поэтому с одним Redis через неё может работать только один экземпляр бота; для нескольких экземпляров
+    есть RedisUserDataStorage.
     """
 
-    def __init__(self, redis_url):
+    def __init__(self, redis_url=None, redis_db=None):
         """
-        В конструктор принимает URL для коннекта в Redis.
+        В конструктор принимает URL для коннекта в Redis или уже готовый клиент Redis.
 
         :param redis_url: URL для коннекта в Redis (str)
+        :param redis_db: клиент Redis (redis.Redis), если он уже создан
         """
         self.in_memory_storage = InMemoryUserDataStorage()
-        self.redis_db = redis.from_url(redis_url)
+        self.redis_db = redis_db if redis_db is not None else redis.from_url(redis_url)
 
     def load_from_storage(self):
         return json.loads(self.redis_db.get('mosigobot.data'))
@@ -213,101 +719,493 @@ class ToRedisJsonSaver(JsonSaver):
         self.redis_db.set('mosigobot.data', json.dumps(json_data, ensure_ascii=False))
 
 
+class IncrementalJsonSaver(JsonSaver):
+    """
+    JsonSaver, который умеет сохранять изменения отдельных пользователей, не перезаписывая состояние остальных.
+    JsonDataStorage с таким сохранятором сериализует только пользователей, изменённых с прошлого сохранения.
+    """
+
+    @abstractmethod
+    def save_users(self, users_json):
+        """
+        Функция для сохранения состояния нескольких пользователей.
+
+        :param users_json: состояние пользователей, полученное через users_state_to_json (map)
+        """
+        pass
+
+
+class SegmentedFileJsonSaver(IncrementalJsonSaver):
+    """
+    Реализация IncrementalJsonSaver, которая хранит состояние в директории, разбитым на сегменты по диапазонам
+    telegram-ID: в файле segment_<n>.json лежит состояние пользователей с ID от n * segment_size
+    до (n + 1) * segment_size в формате state_to_json, вместе с их текущими вопросами. При сохранении изменений
+    перезаписываются только сегменты изменённых пользователей, каждый - атомарно (write_json_atomically).
+    """
+
+    def __init__(self, directory_name, segment_size=10000):
+        """
+        В конструктор принимает имя директории относительно текущей директории, из которой запускается бот.
+
+        :param directory_name: название директории (str)
+        :param segment_size: кол-во telegram-ID в одном сегменте (int)
+        """
+        current_dir = os.path.abspath(os.path.dirname(__file__))
+        self.directory_name = os.path.join(current_dir, directory_name)
+        self.segment_size = segment_size
+        os.makedirs(self.directory_name, exist_ok=True)
+
+        # кол-во перезаписанных сегментов
+        self.segments_written_count = 0
+
+    def segment_file_name(self, segment):
+        return os.path.join(self.directory_name, f'segment_{segment}.json')
+
+    def migrate_from_file(self, file_name):
+        """
+        Однократно переносит состояние, сохранённое одним файлом (ToFileJsonSaver или JournaledFileUserDataStorage
+        вместе с журналом), в сегменты. После переноса файл переименовывается в <file_name>.migrated, поэтому
+        повторный вызов ничего не делает.
+
+        :param file_name: название файла относительно текущей директории, из которой запускается бот (str)
+        :return: перенесено ли состояние (bool)
+        """
+        legacy_saver = ToFileJsonSaver(file_name)
+        journal_file_name = f'{legacy_saver.file_name}.journal'
+        if os.path.isfile(journal_file_name):
+            # хвост журнала сначала сворачивается в снимок
+            JournaledFileUserDataStorage(file_name).close()
+            os.remove(journal_file_name)
+        json_data = legacy_saver.load_from_storage()
+        if json_data is None:
+            return False
+        # загрузка через InMemoryUserDataStorage приводит к текущему формату и старые документы
+        in_memory_storage = InMemoryUserDataStorage()
+        state_from_json(in_memory_storage, json_data)
+        self.save_to_storage(state_to_json(in_memory_storage))
+        os.replace(legacy_saver.file_name, f'{legacy_saver.file_name}.migrated')
+        return True
+
+    def __segment_files(self):
+        for file_name in os.listdir(self.directory_name):
+            if file_name.startswith('segment_') and file_name.endswith('.json'):
+                yield os.path.join(self.directory_name, file_name)
+
+    def __load_segment(self, segment):
+        file_name = self.segment_file_name(segment)
+        if os.path.isfile(file_name):
+            with open(file_name, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        return {}
+
+    def __save_segment(self, segment, segment_json):
+        # в сегменте остаются только вопросы, которые кому-то в нём заданы
+        question_ids = set(segment_json.get('user_current_questions', {}).values())
+        segment_json['questions'] = {question_id: question_json
+                                     for question_id, question_json in segment_json.get('questions', {}).items()
+                                     if question_id in question_ids}
+        write_json_atomically(self.segment_file_name(segment), segment_json)
+        self.segments_written_count += 1
+
+    def __split(self, json_data, user_ids):
+        """
+        Раскладывает состояние пользователей по сегментам.
+
+        :return: номер сегмента -> состояние пользователей этого сегмента в формате state_to_json ({int: map})
+        """
+        segments = {}
+        for user_id in user_ids:
+            segment = int(user_id) // self.segment_size
+            if segment not in segments:
+                segments[segment] = {'users': [], 'questions': {}, 'user_current_questions': {},
+                                     'user_complexity': {}, 'user_victories': {}, 'user_defeats': {}}
+            segments[segment]['users'].append(str(user_id))
+
+        for field in ['user_current_questions', 'user_complexity', 'user_victories', 'user_defeats']:
+            for user_id, value in json_data.get(field, {}).items():
+                segment_json = segments[int(user_id) // self.segment_size]
+                segment_json[field][str(user_id)] = value
+                if field == 'user_current_questions':
+                    segment_json['questions'][value] = json_data['questions'][value]
+        return segments
+
+    def load_from_storage(self):
+        json_data = {'questions': {}, 'user_current_questions': {}, 'user_complexity': {},
+                     'user_victories': {}, 'user_defeats': {}}
+        for file_name in self.__segment_files():
+            with open(file_name, 'r', encoding='utf-8') as f:
+                segment_json = json.load(f)
+            for field, values in json_data.items():
+                values.update(segment_json.get(field, {}))
+        return json_data
+
+    def save_to_storage(self, json_data):
+        user_ids = set()
+        for field in ['user_current_questions', 'user_complexity', 'user_victories', 'user_defeats']:
+            user_ids.update(json_data.get(field, {}))
+        segments = self.__split(json_data, user_ids)
+        for segment, segment_json in segments.items():
+            del segment_json['users']
+            self.__save_segment(segment, segment_json)
+        # сегменты, в которых не осталось пользователей, больше не нужны
+        segment_file_names = {self.segment_file_name(segment) for segment in segments}
+        for file_name in list(self.__segment_files()):
+            if file_name not in segment_file_names:
+                os.remove(file_name)
+
+    def save_users(self, users_json):
+        for segment, changes in self.__split(users_json, users_json['users']).items():
+            segment_json = self.__load_segment(segment)
+            for field in ['user_current_questions', 'user_complexity', 'user_victories', 'user_defeats']:
+                values = segment_json.setdefault(field, {})
+                for user_id in changes['users']:
+                    values.pop(user_id, None)
+                values.update(changes[field])
+            segment_json.setdefault('questions', {}).update(changes['questions'])
+            self.__save_segment(segment, segment_json)
+
+
 class JsonDataStorage(UserDataStorage):
     """
     Реализация UserDataStorage, которая хранит состояние бота в памяти
     (делегируя всю работу объекту InMemoryUserDataStorage), и добавляет логику сохранения состояния
     во всех методах, которые это состояние модифицируют. Нуждается в конкретном объекте JsonSaver,
     с помощью которого будет сохранять состояние и восстанавливать его при инициализации.
-    """
-
-    @staticmethod
-    def __question_to_json(question):
-        return {
-            'question': question.question,
-            'answers': question.answers,
-            'correct_answer': question.correct_answer
-        }
 
-    @staticmethod
-    def __question_from_json(question_json):
-        return Question(
-            question_json['question'],
-            question_json['answers'],
-            question_json['correct_answer']
-        )
+    Если сохранятор умеет сохранять отдельных пользователей (IncrementalJsonSaver), то хранилище запоминает,
+    кто изменился с прошлого сохранения, и сериализует только их, а не всё состояние.
 
-    @staticmethod
-    def __convert_map(data, key_function=lambda k: k, value_function=lambda v: v):
-        result = {}
-        for k, v in data.items():
-            result[key_function(k)] = value_function(v)
-        return result
+    В режиме write_behind изменения не сохраняются сразу: состояние помечается изменённым, а фоновый поток
+    сохраняет его раз в flush_interval секунд или как только накопится flush_threshold изменений. Так несколько
+    изменений подряд (например, победа и очистка текущего вопроса) превращаются в одно сохранение, а обработчики
+    сообщений не ждут записи состояния. Перед остановкой бота нужно вызвать close, чтобы сохранить остатки.
+    """
 
-    def __init__(self, saver):
+    def __init__(self, saver, write_behind=False, flush_interval=1.0, flush_threshold=100, in_memory_storage=None):
         """
         Принимает на вход конкретный объект JsonSaver, чтобы с его помощью сохранять состояние и восстанавливать обратно.
         :param saver: сохранятор состояния (JsonSaver)
+        :param write_behind: сохранять ли состояние в фоновом потоке, а не при каждом изменении (bool)
+        :param flush_interval: как часто (в секундах) фоновый поток сохраняет изменённое состояние (float)
+        :param flush_threshold: кол-во изменений, после которого состояние сохраняется, не дожидаясь интервала (int)
+        :param in_memory_storage: состояние в памяти (InMemoryUserDataStorage или CompactUserDataStorage)
         """
-        self.in_memory_storage = InMemoryUserDataStorage()
+        self.in_memory_storage = in_memory_storage if in_memory_storage is not None else InMemoryUserDataStorage()
         self.saver = saver
         self.__load_from_storage()
 
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        # кол-во изменений, которые ещё не сохранены, и пользователи, которых они затронули
+        self.dirty_count = 0
+        self.dirty_users = set()
+        # кол-во сохранений состояния и кол-во изменений, которые попали в чужое сохранение
+        self.flushes_count = 0
+        self.coalesced_writes_count = 0
+
+        metrics.queue_size.set_function(lambda: {'json_unsaved_changes': self.dirty_count}, key='json_unsaved_changes')
+
+        self.write_behind = write_behind
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        if write_behind:
+            self.stopped = False
+            self.flush_requested = threading.Event()
+            self.flush_thread = threading.Thread(target=self.__flush_loop, daemon=True)
+            self.flush_thread.start()
+
     def __load_from_storage(self):
         data = self.saver.load_from_storage()
         if data:
-            self.__from_json(data)
+            state_from_json(self.in_memory_storage, data)
+
+    def __save_to_storage(self, *user_ids):
+        with self.lock:
+            self.dirty_count += len(user_ids)
+            self.dirty_users.update(user_ids)
+            dirty_count = self.dirty_count
+        if not self.write_behind:
+            self.flush()
+        elif dirty_count >= self.flush_threshold:
+            self.flush_requested.set()
+
+    def __flush_loop(self):
+        while not self.stopped:
+            self.flush_requested.wait(self.flush_interval)
+            self.flush_requested.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logging.exception(e)
+
+    def flush(self):
+        """
+        Сохраняет состояние, если с момента последнего сохранения оно менялось.
+        """
+        with self.save_lock:
+            with self.lock:
+                if self.dirty_count == 0:
+                    return
+                incremental = isinstance(self.saver, IncrementalJsonSaver)
+                json_data = users_state_to_json(self.in_memory_storage, self.dirty_users) if incremental \
+                    else state_to_json(self.in_memory_storage)
+                dirty_count, dirty_users = self.dirty_count, self.dirty_users
+                self.dirty_count = 0
+                self.dirty_users = set()
+
+            saver_name = type(self.saver).__name__
+            try:
+                with metrics.storage_save_latency.time(saver_name):
+                    if incremental:
+                        self.saver.save_users(json_data)
+                    else:
+                        self.saver.save_to_storage(json_data)
+            except Exception:
+                metrics.storage_save_errors.inc(saver_name)
+                with self.lock:
+                    self.dirty_count += dirty_count
+                    self.dirty_users |= dirty_users
+                raise
+
+            self.flushes_count += 1
+            self.coalesced_writes_count += dirty_count - 1
+
+    def close(self):
+        """
+        Останавливает фоновое сохранение (если оно включено) и сохраняет все оставшиеся изменения.
+        """
+        if self.write_behind:
+            self.stopped = True
+            self.flush_requested.set()
+            self.flush_thread.join()
+        self.flush()
 
-    def __save_to_storage(self):
-        json_data = self.__to_json()
-        self.saver.save_to_storage(json_data)
+    def get_user_current_question(self, user_id):
+        return self.in_memory_storage.get_user_current_question(user_id)
 
-    def __to_json(self):
-        return {
-            'user_current_questions': self.__convert_map(
-                self.in_memory_storage.user_current_questions,
-                value_function=self.__question_to_json
-            ),
-            'user_complexity': self.in_memory_storage.user_complexity,
-            'user_victories': self.in_memory_storage.user_victories,
-            'user_defeats': self.in_memory_storage.user_defeats
-        }
+    def put_user_current_question(self, user_id, question):
+        with self.lock:
+            self.in_memory_storage.put_user_current_question(user_id, question)
+        self.__save_to_storage(user_id)
 
-    def __from_json(self, json_data):
+    def clear_user_current_question(self, user_id):
+        with self.lock:
+            self.in_memory_storage.clear_user_current_question(user_id)
+        self.__save_to_storage(user_id)
 
-        self.in_memory_storage.user_current_questions = \
-            self.__convert_map(
-                json_data.get('user_current_questions', {}),
-                key_function=int,
-                value_function=self.__question_from_json
-            )
+    def get_user_complexity(self, user_id):
+        return self.in_memory_storage.get_user_complexity(user_id)
 
-        self.in_memory_storage.user_complexity = \
-            self.__convert_map(json_data.get('user_complexity', {}), key_function=int)
+    def set_user_complexity(self, user_id, complexity):
+        with self.lock:
+            self.in_memory_storage.set_user_complexity(user_id, complexity)
+        self.__save_to_storage(user_id)
 
-        self.in_memory_storage.user_victories = \
-            self.__convert_map(json_data.get('user_victories', {}), key_function=int)
+    def get_user_victories_count(self, user_id):
+        return self.in_memory_storage.get_user_victories_count(user_id)
 
-        self.in_memory_storage.user_defeats = \
-            self.__convert_map(json_data.get('user_defeats', {}), key_function=int)
+    def get_user_defeats_count(self, user_id):
+        return self.in_memory_storage.get_user_defeats_count(user_id)
+
+    def add_user_victory(self, user_id):
+        with self.lock:
+            self.in_memory_storage.add_user_victory(user_id)
+        self.__save_to_storage(user_id)
+
+    def add_user_defeat(self, user_id):
+        with self.lock:
+            self.in_memory_storage.add_user_defeat(user_id)
+        self.__save_to_storage(user_id)
+
+    def expire_questions(self):
+        with self.lock:
+            user_ids = self.in_memory_storage.pop_expired_questions()
+        if user_ids:
+            self.__save_to_storage(*user_ids)
+        return user_ids
+
+    def get_user_rank(self, user_id):
+        with self.lock:
+            return self.in_memory_storage.get_user_rank(user_id)
+
+    def get_top_users(self, count):
+        with self.lock:
+            return self.in_memory_storage.get_top_users(count)
+
+
+class JournaledFileUserDataStorage(UserDataStorage):
+    """
+    Реализация UserDataStorage, которая хранит состояние бота в памяти (делегируя всю работу объекту
+    InMemoryUserDataStorage), а каждое изменение дописывает компактной записью в конец файла-журнала.
+    Стоимость записи пропорциональна изменению, а не размеру всего состояния. Фоновый поток периодически
+    сворачивает журнал в снимок состояния: снимок имеет тот же формат, что и файл ToFileJsonSaver, поэтому
+    его может прочитать и JsonDataStorage. При старте загружается снимок и проигрывается хвост журнала.
+    """
+
+    def __init__(self, file_name, compaction_threshold=10000, compaction_interval=60, in_memory_storage=None):
+        """
+        В конструктор принимает имя файла снимка относительно текущей директории, из которой запускается бот.
+        Журнал хранится рядом, в файле с суффиксом .journal.
+
+        :param file_name: название файла снимка (str)
+        :param compaction_threshold: кол-во записей в журнале, после которого журнал сворачивается в снимок (int)
+        :param compaction_interval: как часто (в секундах) фоновый поток проверяет размер журнала (float)
+        :param in_memory_storage: состояние в памяти (InMemoryUserDataStorage или CompactUserDataStorage)
+        """
+        self.in_memory_storage = in_memory_storage if in_memory_storage is not None else InMemoryUserDataStorage()
+        self.snapshot_saver = ToFileJsonSaver(file_name)
+        self.journal_file_name = f'{self.snapshot_saver.file_name}.journal'
+        self.compacting_file_name = f'{self.journal_file_name}.compacting'
+        self.compaction_threshold = compaction_threshold
+
+        # порядковый номер последней записи в журнале и кол-во записей, ещё не свёрнутых в снимок
+        self.journal_seq = 0
+        self.journal_size = 0
+
+        self.lock = threading.Lock()
+        self.compaction_lock = threading.Lock()
+        self.__load()
+        if os.path.isfile(self.compacting_file_name):
+            # бот упал во время свёртки: журнал .compacting сворачивается в снимок до того, как в журнал попадут
+            # новые записи, иначе следующая свёртка подменит его, пока его записей ещё нет в снимке
+            self.__write_snapshot(self.__snapshot_json())
+        self.journal = open(self.journal_file_name, 'a', encoding='utf-8')
+        metrics.queue_size.set_function(lambda: {'journal_records': self.journal_size}, key='journal_records')
+
+        self.stopped = threading.Event()
+        self.compaction_interval = compaction_interval
+        self.compaction_thread = threading.Thread(target=self.__compaction_loop, daemon=True)
+        self.compaction_thread.start()
+
+    def __load(self):
+        data = self.snapshot_saver.load_from_storage()
+        if data:
+            state_from_json(self.in_memory_storage, data)
+            self.journal_seq = data.get('journal_seq', 0)
+
+        # журнал .compacting остаётся, если бот упал во время свёртки; записи, которые уже попали
+        # в снимок, пропускаются по порядковому номеру
+        for file_name in [self.compacting_file_name, self.journal_file_name]:
+            if not os.path.isfile(file_name):
+                continue
+            valid_size = 0
+            with open(file_name, 'rb') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line) if line.endswith(b'\n') else None
+                    except ValueError:
+                        record = None
+                    if record is None:
+                        # недописанная последняя строка после падения бота
+                        break
+                    valid_size += len(line)
+                    if record['seq'] > self.journal_seq:
+                        self.__apply(record)
+                        self.journal_seq = record['seq']
+                        self.journal_size += 1
+            # новые записи дописываются в конец журнала, поэтому недописанную строку нужно отрезать:
+            # иначе следующая запись склеится с ней, и при следующем запуске пропадёт вместе с ней
+            if file_name == self.journal_file_name and valid_size < os.path.getsize(file_name):
+                with open(file_name, 'r+b') as f:
+                    f.truncate(valid_size)
+
+    def __apply(self, record):
+        op = record['op']
+        user_id = record['user']
+        if op == 'put':
+            # тело вопроса пишется в журнал, только если такого вопроса ещё не было в каталоге
+            question = self.in_memory_storage.question_catalog.get(record.get('question_id'))
+            if question is None:
+                question = question_from_json(record['question'])
+            self.in_memory_storage.put_user_current_question(user_id, question)
+        elif op == 'clear':
+            if user_id in self.in_memory_storage.user_current_questions:
+                self.in_memory_storage.clear_user_current_question(user_id)
+        elif op == 'complexity':
+            self.in_memory_storage.set_user_complexity(user_id, record['complexity'])
+        elif op == 'victory':
+            self.in_memory_storage.add_user_victory(user_id)
+        elif op == 'defeat':
+            self.in_memory_storage.add_user_defeat(user_id)
+
+    def __append(self, record):
+        self.journal_seq += 1
+        self.journal_size += 1
+        record['seq'] = self.journal_seq
+        self.journal.write(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n')
+        self.journal.flush()
+
+    def __compaction_loop(self):
+        while not self.stopped.wait(self.compaction_interval):
+            if self.journal_size >= self.compaction_threshold:
+                try:
+                    self.compact()
+                except Exception as e:
+                    logging.exception(e)
+
+    def compact(self):
+        """
+        Сворачивает журнал в снимок состояния. Новые записи во время свёртки попадают в новый журнал.
+        """
+        with self.compaction_lock:
+            with self.lock:
+                json_data = self.__snapshot_json()
+                # журнал .compacting остаётся, если предыдущая свёртка не смогла записать снимок: тогда журнал
+                # не переименовывается, чтобы не подменить записи, которых ещё нет в снимке
+                if not os.path.isfile(self.compacting_file_name):
+                    self.journal.close()
+                    os.replace(self.journal_file_name, self.compacting_file_name)
+                    fsync_directory(self.journal_file_name)
+                    self.journal = open(self.journal_file_name, 'a', encoding='utf-8')
+                self.journal_size = 0
+
+            with metrics.storage_save_latency.time(type(self).__name__):
+                self.__write_snapshot(json_data)
+
+    def __snapshot_json(self):
+        json_data = state_to_json(self.in_memory_storage)
+        json_data['journal_seq'] = self.journal_seq
+        return json_data
+
+    def __write_snapshot(self, json_data):
+        # снимок пишется во временный файл и подменяет старый только целиком; журнал .compacting удаляется,
+        # только когда снимок уже на диске
+        write_json_atomically(self.snapshot_saver.file_name, json_data)
+        os.remove(self.compacting_file_name)
+        fsync_directory(self.compacting_file_name)
+
+    def close(self):
+        """
+        Останавливает фоновую свёртку журнала, сворачивает журнал в последний раз и закрывает файл.
+        """
+        self.stopped.set()
+        self.compaction_thread.join()
+        self.compact()
+        self.journal.close()
 
     def get_user_current_question(self, user_id):
         return self.in_memory_storage.get_user_current_question(user_id)
 
     def put_user_current_question(self, user_id, question):
-        self.in_memory_storage.put_user_current_question(user_id, question)
-        self.__save_to_storage()
+        with self.lock:
+            record = {'op': 'put', 'user': user_id, 'question_id': question.id}
+            if self.in_memory_storage.question_catalog.get(question.id) is None:
+                record['question'] = question_to_json(question)
+            self.in_memory_storage.put_user_current_question(user_id, question)
+            self.__append(record)
 
     def clear_user_current_question(self, user_id):
-        self.in_memory_storage.clear_user_current_question(user_id)
-        self.__save_to_storage()
+        with self.lock:
+            self.in_memory_storage.clear_user_current_question(user_id)
+            self.__append({'op': 'clear', 'user': user_id})
 
     def get_user_complexity(self, user_id):
         return self.in_memory_storage.get_user_complexity(user_id)
 
     def set_user_complexity(self, user_id, complexity):
-        self.in_memory_storage.set_user_complexity(user_id, complexity)
-        self.__save_to_storage()
+        with self.lock:
+            self.in_memory_storage.set_user_complexity(user_id, complexity)
+            self.__append({'op': 'complexity', 'user': user_id, 'complexity': complexity})
 
     def get_user_victories_count(self, user_id):
         return self.in_memory_storage.get_user_victories_count(user_id)
@@ -316,9 +1214,1403 @@ class JsonDataStorage(UserDataStorage):
         return self.in_memory_storage.get_user_defeats_count(user_id)
 
     def add_user_victory(self, user_id):
-        self.in_memory_storage.add_user_victory(user_id)
-        self.__save_to_storage()
+        with self.lock:
+            self.in_memory_storage.add_user_victory(user_id)
+            self.__append({'op': 'victory', 'user': user_id})
 
     def add_user_defeat(self, user_id):
-        self.in_memory_storage.add_user_defeat(user_id)
-        self.__save_to_storage()
+        with self.lock:
+            self.in_memory_storage.add_user_defeat(user_id)
+            self.__append({'op': 'defeat', 'user': user_id})
+
+    def expire_questions(self):
+        with self.lock:
+            user_ids = self.in_memory_storage.pop_expired_questions()
+            for user_id in user_ids:
+                self.__append({'op': 'clear', 'user': user_id})
+        return user_ids
+
+    def get_user_rank(self, user_id):
+        with self.lock:
+            return self.in_memory_storage.get_user_rank(user_id)
+
+    def get_top_users(self, count):
+        with self.lock:
+            return self.in_memory_storage.get_top_users(count)
+
+
+class SqliteUserDataStorage(UserDataStorage, UserRecordStore):
+    """
+    Реализация UserDataStorage, которая хранит состояние пользователей в базе SQLite: по строке на пользователя
+    в таблице users и по строке на каждый заданный вопрос в таблице questions. Каждый запрос читает или меняет
+    только строку нужного пользователя, а при старте ничего не загружается в память.
+
+    База работает в режиме WAL. Если задан group_commit_interval, изменения от всех обработчиков не фиксируются
+    по одному, а собираются в одну транзакцию, которую фоновый поток фиксирует раз в group_commit_interval секунд
+    (изменения за последний интервал могут потеряться, если процесс упадёт).
+    """
+
+    create_tables_sql = [
+        'CREATE TABLE IF NOT EXISTS users ('
+        'user_id INTEGER PRIMARY KEY, complexity TEXT, victories INTEGER NOT NULL DEFAULT 0, '
+        'defeats INTEGER NOT NULL DEFAULT 0, question_id TEXT)',
+        'CREATE INDEX IF NOT EXISTS users_question_id ON users (question_id)',
+        'CREATE INDEX IF NOT EXISTS users_victories ON users (victories)',
+        'CREATE TABLE IF NOT EXISTS questions (id TEXT PRIMARY KEY, body TEXT NOT NULL)',
+        # кол-во пользователей с каждым кол-вом побед: триггеры обновляют его в той же транзакции, что и users
+        'CREATE TABLE IF NOT EXISTS victory_counts (victories INTEGER PRIMARY KEY, users INTEGER NOT NULL)',
+        'CREATE TRIGGER IF NOT EXISTS users_victories_insert AFTER INSERT ON users BEGIN '
+        'INSERT INTO victory_counts (victories, users) VALUES (NEW.victories, 1) '
+        'ON CONFLICT (victories) DO UPDATE SET users = users + 1; END',
+        'CREATE TRIGGER IF NOT EXISTS users_victories_update AFTER UPDATE OF victories ON users '
+        'WHEN OLD.victories != NEW.victories BEGIN '
+        'UPDATE victory_counts SET users = users - 1 WHERE victories = OLD.victories; '
+        'DELETE FROM victory_counts WHERE victories = OLD.victories AND users = 0; '
+        'INSERT INTO victory_counts (victories, users) VALUES (NEW.victories, 1) '
+        'ON CONFLICT (victories) DO UPDATE SET users = users + 1; END',
+        'CREATE TRIGGER IF NOT EXISTS users_victories_delete AFTER DELETE ON users BEGIN '
+        'UPDATE victory_counts SET users = users - 1 WHERE victories = OLD.victories; '
+        'DELETE FROM victory_counts WHERE victories = OLD.victories AND users = 0; END'
+    ]
+    # база, созданная до появления victory_counts, заполняет таблицу один раз при первом запуске
+    has_victory_counts_sql = "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'victory_counts'"
+    fill_victory_counts_sql = 'INSERT INTO victory_counts (victories, users) ' \
+                              'SELECT victories, COUNT(*) FROM users GROUP BY victories'
+    select_user_field_sql = 'SELECT {} FROM users WHERE user_id = ?'
+    select_question_sql = 'SELECT body FROM questions WHERE id = ?'
+    insert_question_sql = 'INSERT OR IGNORE INTO questions (id, body) VALUES (?, ?)'
+    # вопрос удаляется, если он больше не задан ни одному пользователю
+    delete_unused_question_sql = \
+        'DELETE FROM questions WHERE id = ? AND NOT EXISTS (SELECT 1 FROM users WHERE question_id = ?)'
+    set_question_sql = 'INSERT INTO users (user_id, question_id) VALUES (?, ?) ' \
+                       'ON CONFLICT (user_id) DO UPDATE SET question_id = excluded.question_id'
+    clear_question_sql = 'UPDATE users SET question_id = NULL WHERE user_id = ?'
+    set_complexity_sql = 'INSERT INTO users (user_id, complexity) VALUES (?, ?) ' \
+                         'ON CONFLICT (user_id) DO UPDATE SET complexity = excluded.complexity'
+    add_victory_sql = 'INSERT INTO users (user_id, victories) VALUES (?, 1) ' \
+                      'ON CONFLICT (user_id) DO UPDATE SET victories = victories + 1'
+    add_defeat_sql = 'INSERT INTO users (user_id, defeats) VALUES (?, 1) ' \
+                     'ON CONFLICT (user_id) DO UPDATE SET defeats = defeats + 1'
+    select_user_record_sql = 'SELECT complexity, victories, defeats, question_id FROM users WHERE user_id = ?'
+    put_user_record_sql = 'INSERT INTO users (user_id, complexity, victories, defeats, question_id) ' \
+                          'VALUES (?, ?, ?, ?, ?) ON CONFLICT (user_id) DO UPDATE SET ' \
+                          'complexity = excluded.complexity, victories = excluded.victories, ' \
+                          'defeats = excluded.defeats, question_id = excluded.question_id'
+    # место в рейтинге - это сумма по различным кол-вам побед, которых больше, чем у пользователя, а не подсчёт
+    # всех пользователей выше него; лучшие пользователи выбираются по индексу users_victories
+    count_better_users_sql = 'SELECT COALESCE(SUM(users), 0) FROM victory_counts WHERE victories > ?'
+    select_top_users_sql = 'SELECT user_id, victories FROM users WHERE victories > 0 ' \
+                           'ORDER BY victories DESC, user_id LIMIT ?'
+
+    # сколько вопросов держать в памяти, чтобы не читать их из базы каждый раз (вопрос с данным id не меняется)
+    question_cache_size = 4096
+
+    def __init__(self, file_name, group_commit_interval=None):
+        """
+        В конструктор принимает имя файла базы относительно текущей директории, из которой запускается бот.
+
+        :param file_name: название файла базы (str)
+        :param group_commit_interval: как часто (в секундах) фиксировать накопленные изменения одной транзакцией;
+        None - фиксировать каждое изменение сразу (float)
+        """
+        current_dir = os.path.abspath(os.path.dirname(__file__))
+        self.file_name = os.path.join(current_dir, file_name)
+
+        # sqlite3 сам кэширует подготовленные запросы для одного соединения, поэтому соединение одно на всех
+        self.db = sqlite3.connect(self.file_name, check_same_thread=False, cached_statements=64)
+        self.db.execute('PRAGMA journal_mode = WAL')
+        self.db.execute('PRAGMA synchronous = NORMAL')
+        has_victory_counts = self.db.execute(self.has_victory_counts_sql).fetchone() is not None
+        for sql in self.create_tables_sql:
+            self.db.execute(sql)
+        if not has_victory_counts:
+            self.db.execute(self.fill_victory_counts_sql)
+        self.db.commit()
+
+        self.lock = threading.Lock()
+        self.load_question = functools.lru_cache(maxsize=self.question_cache_size)(self.__load_question)
+
+        self.group_commit_interval = group_commit_interval
+        # кол-во изменений, которые ещё не зафиксированы, и кол-во зафиксированных транзакций
+        self.pending_writes_count = 0
+        metrics.queue_size.set_function(lambda: {'sqlite_uncommitted_writes': self.pending_writes_count},
+                                        key='sqlite_uncommitted_writes')
+        self.commits_count = 0
+        if group_commit_interval is not None:
+            self.stopped = threading.Event()
+            self.commit_thread = threading.Thread(target=self.__commit_loop, daemon=True)
+            self.commit_thread.start()
+
+    def __commit_loop(self):
+        while not self.stopped.wait(self.group_commit_interval):
+            try:
+                self.commit()
+            except Exception as e:
+                logging.exception(e)
+
+    def commit(self):
+        """
+        Фиксирует все накопленные изменения одной транзакцией.
+        """
+        with self.lock:
+            if self.pending_writes_count == 0:
+                return
+            with metrics.storage_save_latency.time(type(self).__name__):
+                self.db.commit()
+            self.pending_writes_count = 0
+            self.commits_count += 1
+
+    def __write(self, statements):
+        with self.lock:
+            for sql, params in statements:
+                self.db.execute(sql, params)
+            self.pending_writes_count += 1
+            if self.group_commit_interval is None:
+                with metrics.storage_save_latency.time(type(self).__name__):
+                    self.db.commit()
+                self.pending_writes_count = 0
+                self.commits_count += 1
+
+    def __read_field(self, user_id, field):
+        with self.lock:
+            row = self.db.execute(self.select_user_field_sql.format(field), (user_id,)).fetchone()
+        return None if row is None else row[0]
+
+    def __load_question(self, question_id):
+        with self.lock:
+            row = self.db.execute(self.select_question_sql, (question_id,)).fetchone()
+        if row is None:
+            # исключение, в отличие от None, не попадает в кэш
+            raise KeyError(question_id)
+        return question_from_json(json.loads(row[0]))
+
+    def close(self):
+        """
+        Останавливает фоновую фиксацию изменений (если она включена), фиксирует оставшиеся изменения
+        и закрывает базу.
+        """
+        if self.group_commit_interval is not None:
+            self.stopped.set()
+            self.commit_thread.join()
+        self.commit()
+        self.db.close()
+
+    def get_user_current_question(self, user_id):
+        question_id = self.__read_field(user_id, 'question_id')
+        if question_id is None:
+            return None
+        try:
+            return self.load_question(question_id)
+        except KeyError:
+            return None
+
+    def put_user_current_question(self, user_id, question):
+        previous_question_id = self.__read_field(user_id, 'question_id')
+        statements = [
+            (self.insert_question_sql, (question.id, json.dumps(question_to_json(question), ensure_ascii=False))),
+            (self.set_question_sql, (user_id, question.id))
+        ]
+        if previous_question_id is not None and previous_question_id != question.id:
+            statements.append((self.delete_unused_question_sql, (previous_question_id, previous_question_id)))
+        self.__write(statements)
+
+    def clear_user_current_question(self, user_id):
+        question_id = self.__read_field(user_id, 'question_id')
+        statements = [(self.clear_question_sql, (user_id,))]
+        if question_id is not None:
+            statements.append((self.delete_unused_question_sql, (question_id, question_id)))
+        self.__write(statements)
+
+    def get_user_complexity(self, user_id):
+        return self.__read_field(user_id, 'complexity') or DEFAULT_COMPLEXITY
+
+    def set_user_complexity(self, user_id, complexity):
+        check_complexity(complexity)
+        self.__write([(self.set_complexity_sql, (user_id, complexity))])
+
+    def get_user_victories_count(self, user_id):
+        return self.__read_field(user_id, 'victories') or 0
+
+    def get_user_defeats_count(self, user_id):
+        return self.__read_field(user_id, 'defeats') or 0
+
+    def add_user_victory(self, user_id):
+        self.__write([(self.add_victory_sql, (user_id,))])
+
+    def add_user_defeat(self, user_id):
+        self.__write([(self.add_defeat_sql, (user_id,))])
+
+    def get_user_record(self, user_id):
+        with self.lock:
+            row = self.db.execute(self.select_user_record_sql, (user_id,)).fetchone()
+        if row is None:
+            return UserRecord()
+        complexity, victories, defeats, question_id = row
+        question = None
+        if question_id is not None:
+            try:
+                question = self.load_question(question_id)
+            except KeyError:
+                pass
+        return UserRecord(complexity, victories, defeats, question)
+
+    def put_user_records(self, records):
+        # все пользователи записываются одной транзакцией
+        statements = []
+        unused_question_ids = set()
+        for user_id, record in records.items():
+            previous_question_id = self.__read_field(user_id, 'question_id')
+            question_id = None if record.question is None else record.question.id
+            if record.question is not None:
+                statements.append((self.insert_question_sql, (
+                    question_id, json.dumps(question_to_json(record.question), ensure_ascii=False))))
+            statements.append((self.put_user_record_sql, (
+                user_id, record.complexity, record.victories, record.defeats, question_id)))
+            if previous_question_id is not None and previous_question_id != question_id:
+                unused_question_ids.add(previous_question_id)
+        for question_id in unused_question_ids:
+            statements.append((self.delete_unused_question_sql, (question_id, question_id)))
+        if statements:
+            self.__write(statements)
+        # файлом SQLite пользуется один экземпляр бота, поэтому конфликтов не бывает
+        return []
+
+    def count_users_with_more_victories(self, victories):
+        with self.lock:
+            return self.db.execute(self.count_better_users_sql, (victories,)).fetchone()[0]
+
+    def get_user_rank(self, user_id):
+        return 1 + self.count_users_with_more_victories(self.get_user_victories_count(user_id))
+
+    def get_top_users(self, count):
+        with self.lock:
+            return self.db.execute(self.select_top_users_sql, (count,)).fetchall()
+
+
+def acquire_redis_lock(redis_db, key, owner, timeout):
+    """
+    Захватывает блокировку в Redis (SET NX), дожидаясь, пока её отпустит другой владелец. Блокировка снимается
+    сама через timeout секунд, если владелец упал, не отпустив её.
+
+    :param redis_db: клиент Redis (redis.Redis)
+    :param key: ключ блокировки (str)
+    :param owner: ID владельца, например ID экземпляра бота (str)
+    :param timeout: через сколько секунд блокировка снимается сама (int)
+    """
+    while not redis_db.set(key, owner, nx=True, ex=timeout):
+        time.sleep(0.1)
+
+
+def release_redis_lock(redis_db, key, owner):
+    """
+    Отпускает блокировку, захваченную acquire_redis_lock, если она всё ещё принадлежит owner.
+    """
+    def release(pipe):
+        # блокировка могла истечь и достаться другому владельцу
+        if pipe.get(key) == owner.encode('utf-8'):
+            pipe.multi()
+            pipe.delete(key)
+
+    redis_db.transaction(release, key)
+
+
+class RedisUserDataLayout:
+    """
+    Формат, в котором состояние пользователей хранится в Redis: ключи, поля хэша пользователя и изменения,
+    которые добавляются в MULTI. Формат общий для RedisUserDataStorage и AsyncRedisUserDataStorage, поэтому
+    синхронный и асинхронный бот работают с одними и теми же данными, а различаются только тем, как выполняют
+    команды. Подклассу нужны атрибуты instance_id и question_ttl.
+    """
+
+    # ключи хэшей с текстами вопросов и кол-вом пользователей, которым задан каждый вопрос
+    questions_key = 'mosigobot.questions'
+    question_refs_key = 'mosigobot.question_refs'
+    leaderboard_key = 'mosigobot.leaderboard'
+    # канал, в который публикуется "<ID экземпляра бота>:<telegram-ID>" каждого изменённого пользователя
+    invalidation_channel = 'mosigobot.invalidations'
+    # sorted set: telegram-ID пользователей, которые ждут ответа на вопрос, со временем (unix), когда вопрос истекает
+    question_deadlines_key = 'mosigobot.question_deadlines'
+    # поля хэша пользователя, по которым parse_asked_question_id определяет его вопрос в каталоге
+    asked_question_fields = ('asked_question_id', 'question_id')
+
+    @staticmethod
+    def user_key(user_id):
+        return f'mosigobot.user.{user_id}'
+
+    @staticmethod
+    def parse_asked_question_id(values):
+        """
+        Возвращает id вопроса, на который ссылается пользователь: поле question_id могло истечь,
+        а asked_question_id - нет.
+
+        :param values: значения полей asked_question_fields (HMGET)
+        :return: id вопроса (str) или None
+        """
+        asked_question_id, question_id = values
+        question_id = asked_question_id or question_id
+        return None if question_id is None else question_id.decode('utf-8')
+
+    def queue_touch(self, pipe, user_id):
+        # вызывается внутри MULTI вместе с изменением пользователя
+        pipe.hincrby(self.user_key(user_id), 'version', 1)
+        pipe.publish(self.invalidation_channel, f'{self.instance_id}:{user_id}')
+
+    def queue_set_complexity(self, pipe, user_id, complexity):
+        pipe.hset(self.user_key(user_id), 'complexity', complexity)
+        self.queue_touch(pipe, user_id)
+
+    def queue_add_victory(self, pipe, user_id):
+        pipe.hincrby(self.user_key(user_id), 'victories', 1)
+        pipe.zincrby(self.leaderboard_key, 1, user_id)
+        self.queue_touch(pipe, user_id)
+
+    def queue_add_defeat(self, pipe, user_id):
+        pipe.hincrby(self.user_key(user_id), 'defeats', 1)
+        self.queue_touch(pipe, user_id)
+
+    def queue_user_question(self, pipe, user_id, question_id):
+        """
+        Добавляет в MULTI новый текущий вопрос пользователя (или его удаление, если question_id - None)
+        вместе со сроком ответа.
+        """
+        user_key = self.user_key(user_id)
+        if question_id is None:
+            pipe.hdel(user_key, 'question_id', 'question', 'asked_question_id')
+            pipe.zrem(self.question_deadlines_key, user_id)
+            return
+        pipe.hset(user_key, 'question_id', question_id)
+        pipe.hdel(user_key, 'question')
+        if self.question_ttl is None:
+            pipe.hdel(user_key, 'asked_question_id')
+            pipe.zrem(self.question_deadlines_key, user_id)
+        else:
+            pipe.hset(user_key, 'asked_question_id', question_id)
+            pipe.hpexpire(user_key, int(self.question_ttl * 1000), 'question_id')
+            pipe.zadd(self.question_deadlines_key, {user_id: time.time() + self.question_ttl})
+
+    def queue_set_user_question(self, pipe, user_id, previous_question_id, question):
+        """
+        Добавляет в MULTI смену текущего вопроса пользователя вместе со счётчиками ссылок на старый и новый вопрос.
+
+        :param previous_question_id: id вопроса, на который пользователь ссылался, прочитанный под WATCH его хэша
+        :param question: новый вопрос (Question) или None, если вопрос нужно удалить
+        :return: id освобождённых вопросов, которые после EXEC нужно передать в queue_unused_questions_removal ([str])
+        """
+        question_id = None if question is None else question.id
+        ref_changes = {}
+        if question_id != previous_question_id:
+            if question_id is not None:
+                ref_changes[question_id] = 1
+            if previous_question_id is not None:
+                ref_changes[previous_question_id] = -1
+        released_question_ids = self.queue_question_ref_changes(pipe, ref_changes, {question_id: question})
+        self.queue_user_question(pipe, user_id, question_id)
+        self.queue_touch(pipe, user_id)
+        return released_question_ids
+
+    @classmethod
+    def queue_question_ref_changes(cls, pipe, ref_changes, questions):
+        """
+        Добавляет в MULTI изменение счётчиков ссылок на вопросы (HINCRBY) и сохраняет новые вопросы, если их ещё нет.
+        Счётчики не читаются под WATCH, поэтому изменение вопроса одного пользователя не прерывает транзакции других
+        пользователей. Вопросы, счётчики которых уменьшились, после EXEC проверяются queue_unused_questions_removal.
+
+        :param ref_changes: на сколько изменяется счётчик каждого вопроса ({str: int})
+        :param questions: новые вопросы, которые нужно сохранить, если их ещё нет ({str: Question})
+        :return: id вопросов, счётчики которых уменьшились ([str])
+        """
+        released_question_ids = []
+        for question_id, change in ref_changes.items():
+            if change == 0:
+                continue
+            if question_id in questions:
+                pipe.hsetnx(cls.questions_key, question_id,
+                            json.dumps(question_to_json(questions[question_id]), ensure_ascii=False))
+            pipe.hincrby(cls.question_refs_key, question_id, change)
+            if change < 0:
+                released_question_ids.append(question_id)
+        return released_question_ids
+
+    @classmethod
+    def queue_unused_questions_removal(cls, pipe, question_ids, question_refs):
+        """
+        Добавляет в MULTI удаление вопросов, на которые больше никто не ссылается. Вызывается под WATCH ключа
+        mosigobot.question_refs: если до EXEC вопрос снова кому-то зададут, транзакция повторится и он останется.
+
+        :param question_ids: id освобождённых вопросов ([str])
+        :param question_refs: их счётчики ссылок, прочитанные под WATCH (HMGET)
+        """
+        unused_question_ids = [question_id for question_id, refs in zip(question_ids, question_refs)
+                               if int(refs or 0) <= 0]
+        pipe.multi()
+        if unused_question_ids:
+            pipe.hdel(cls.questions_key, *unused_question_ids)
+            pipe.hdel(cls.question_refs_key, *unused_question_ids)
+
+
+class RedisUserDataStorage(RedisUserDataLayout, UserDataStorage, UserRecordStore):
+    """
+    Реализация UserDataStorage, которая хранит состояние каждого пользователя в отдельном хэше Redis
+    (ключ mosigobot.user.<telegram-ID>) и при каждом изменении трогает только нужное поле этого хэша
+    (HSET/HDEL/HINCRBY). Стоимость записи не зависит от общего числа пользователей, в отличие от
+    JsonDataStorage с ToRedisJsonSaver, который перезаписывает всё состояние целиком.
+
+    У пользователя хранится только id текущего вопроса, а сам вопрос хранится один раз в хэше mosigobot.questions
+    вместе со счётчиком пользователей, которым он задан (mosigobot.question_refs); вопрос, который больше никому
+    не задан, удаляется. Рейтинг пользователей по кол-ву побед хранится в sorted set mosigobot.leaderboard
+    и обновляется вместе со счётчиком побед.
+
+    С одним Redis могут работать несколько экземпляров бота. Каждое изменение пользователя выполняется на сервере
+    атомарно: счётчики - через HINCRBY в MULTI, а изменения, которые зависят от прочитанного (текущий вопрос),
+    - оптимистичной транзакцией WATCH/MULTI только над хэшем этого пользователя, которая повторяется, если его
+    изменил кто-то другой. Счётчики ссылок на вопросы меняются в той же транзакции через HINCRBY, а вопрос,
+    который больше никому не задан, удаляется следующей короткой транзакцией. Каждое изменение увеличивает
+    версию пользователя (поле version) и публикует его telegram-ID в канал mosigobot.invalidations, чтобы другие
+    экземпляры сбросили его из своего кэша.
+
+    Если задан question_ttl, то поле question_id живёт не дольше question_ttl секунд (TTL поля хэша, HPEXPIRE,
+    нужен Redis 7.4), поэтому неотвеченный вопрос пропадает у пользователя вовремя, даже если бот не запущен.
+    Ссылку на вопрос в каталоге держит поле asked_question_id без TTL, а срок ответа хранится в sorted set
+    mosigobot.question_deadlines: expire_questions находит по нему истёкшие вопросы и освобождает их в каталоге.
+    """
+
+    # ключ, под которым ToRedisJsonSaver хранит всё состояние бота одним json-документом
+    legacy_key = 'mosigobot.data'
+    # сколько истёкших вопросов удалять за один проход expire_questions
+    expiry_batch_size = 1000
+    # сколько вопросов держать в памяти, чтобы не читать их из Redis каждый раз (вопрос с данным id не меняется)
+    question_cache_size = 4096
+    # размер пачки пользователей, которые переносятся в Redis одним pipeline при миграции
+    migration_batch_size = 1000
+    # блокировка, которую держит экземпляр бота, переносящий состояние из mosigobot.data; если экземпляр упал
+    # во время миграции, блокировка снимается сама через migration_lock_timeout секунд
+    migration_lock_key = 'mosigobot.data.migration_lock'
+    migration_lock_timeout = 600
+
+    def __init__(self, redis_url=None, redis_db=None, instance_id=None, question_ttl=None):
+        """
+        В конструктор принимает URL для коннекта в Redis или уже готовый клиент Redis.
+
+        :param redis_url: URL для коннекта в Redis (str)
+        :param redis_db: клиент Redis (redis.Redis), если он уже создан
+        :param instance_id: ID экземпляра бота, которым подписываются уведомления об изменениях (str);
+        по умолчанию случайный
+        :param question_ttl: сколько секунд пользователь может отвечать на вопрос (float); None - без ограничения
+        """
+        self.redis_db = redis_db if redis_db is not None else redis.from_url(redis_url)
+        self.instance_id = instance_id if instance_id is not None else os.urandom(8).hex()
+        self.question_ttl = question_ttl
+        self.load_question = functools.lru_cache(maxsize=self.question_cache_size)(self.__load_question)
+
+    def __load_question(self, question_id):
+        question_json = self.redis_db.hget(self.questions_key, question_id)
+        if question_json is None:
+            # исключение, в отличие от None, не попадает в кэш
+            raise KeyError(question_id)
+        return question_from_json(json.loads(question_json))
+
+    def __remove_unused_questions(self, question_ids):
+        # отдельная короткая транзакция: WATCH общего хэша счётчиков не задерживает изменения пользователей
+        if not question_ids:
+            return
+
+        def update(pipe):
+            self.queue_unused_questions_removal(pipe, question_ids, pipe.hmget(self.question_refs_key, question_ids))
+
+        self.redis_db.transaction(update, self.question_refs_key)
+
+    def __set_user_question(self, user_id, question):
+        user_key = self.user_key(user_id)
+
+        def update(pipe):
+            previous_question_id = self.parse_asked_question_id(pipe.hmget(user_key, *self.asked_question_fields))
+            pipe.multi()
+            return self.queue_set_user_question(pipe, user_id, previous_question_id, question)
+
+        self.__remove_unused_questions(self.redis_db.transaction(update, user_key, value_from_callable=True))
+
+    def migrate_from_json_blob(self):
+        """
+        Однократно переносит состояние, сохранённое ToRedisJsonSaver под ключом mosigobot.data, в хэши
+        отдельных пользователей. После переноса старый ключ переименовывается в mosigobot.data.migrated,
+        поэтому повторный вызов ничего не делает.
+
+        Миграцию выполняет только один экземпляр бота (блокировка SET NX), остальные ждут её окончания. Все значения
+        записываются целиком, а не увеличиваются, поэтому миграцию, прерванную посередине, можно просто повторить.
+
+        :return: кол-во перенесённых пользователей (int)
+        """
+        # пока миграцию выполняет другой экземпляр бота, ждём
+        acquire_redis_lock(self.redis_db, self.migration_lock_key, self.instance_id, self.migration_lock_timeout)
+        try:
+            return self.__migrate_from_json_blob()
+        finally:
+            release_redis_lock(self.redis_db, self.migration_lock_key, self.instance_id)
+
+    def __migrate_from_json_blob(self):
+        raw_data = self.redis_db.get(self.legacy_key)
+        if raw_data is None:
+            return 0
+        json_data = json.loads(raw_data)
+
+        users = {}
+        for field, key in [('complexity', 'user_complexity'),
+                           ('victories', 'user_victories'),
+                           ('defeats', 'user_defeats')]:
+            for user_id, value in json_data.get(key, {}).items():
+                users.setdefault(user_id, {})[field] = value
+
+        questions = json_data.get('questions', {})
+        question_refs = {}
+        for user_id, question_json in json_data.get('user_current_questions', {}).items():
+            if isinstance(question_json, str):
+                question_json = questions[question_json]
+            question = question_from_json(question_json)
+            questions[question.id] = question_json
+            question_refs[question.id] = question_refs.get(question.id, 0) + 1
+            users.setdefault(user_id, {})['question_id'] = question.id
+
+        pipe = self.redis_db.pipeline(transaction=False)
+        victories = {user_id: value for user_id, value in json_data.get('user_victories', {}).items() if value > 0}
+        if victories:
+            pipe.zadd(self.leaderboard_key, victories)
+        for question_id, refs in question_refs.items():
+            pipe.hset(self.questions_key, question_id, json.dumps(questions[question_id], ensure_ascii=False))
+            # HSET, а не HINCRBY: повторная миграция после сбоя не должна считать ссылки дважды
+            pipe.hset(self.question_refs_key, question_id, refs)
+        for i, (user_id, mapping) in enumerate(users.items(), start=1):
+            pipe.hset(self.user_key(user_id), mapping=mapping)
+            if i % self.migration_batch_size == 0:
+                pipe.execute()
+        pipe.rename(self.legacy_key, f'{self.legacy_key}.migrated')
+        pipe.execute()
+
+        return len(users)
+
+    def get_user_current_question(self, user_id):
+        # в поле question хранилась полная копия вопроса до того, как появился каталог вопросов
+        question_id, question_json = self.redis_db.hmget(self.user_key(user_id), 'question_id', 'question')
+        if question_id is not None:
+            try:
+                return self.load_question(question_id.decode('utf-8'))
+            except KeyError:
+                return None
+        if question_json is not None:
+            return question_from_json(json.loads(question_json))
+        return None
+
+    def put_user_current_question(self, user_id, question):
+        self.__set_user_question(user_id, question)
+
+    def clear_user_current_question(self, user_id):
+        self.__set_user_question(user_id, None)
+
+    def get_user_complexity(self, user_id):
+        complexity = self.redis_db.hget(self.user_key(user_id), 'complexity')
+        if complexity is None:
+            return DEFAULT_COMPLEXITY
+        return complexity.decode('utf-8')
+
+    def set_user_complexity(self, user_id, complexity):
+        check_complexity(complexity)
+        pipe = self.redis_db.pipeline(transaction=True)
+        self.queue_set_complexity(pipe, user_id, complexity)
+        pipe.execute()
+
+    def get_user_victories_count(self, user_id):
+        return int(self.redis_db.hget(self.user_key(user_id), 'victories') or 0)
+
+    def get_user_defeats_count(self, user_id):
+        return int(self.redis_db.hget(self.user_key(user_id), 'defeats') or 0)
+
+    def add_user_victory(self, user_id):
+        pipe = self.redis_db.pipeline(transaction=True)
+        self.queue_add_victory(pipe, user_id)
+        pipe.execute()
+
+    def add_user_defeat(self, user_id):
+        pipe = self.redis_db.pipeline(transaction=True)
+        self.queue_add_defeat(pipe, user_id)
+        pipe.execute()
+
+    def get_user_record(self, user_id):
+        # все поля читаются одной командой, поэтому соответствуют прочитанной версии
+        complexity, victories, defeats, version, question_id, question_json = self.redis_db.hmget(
+            self.user_key(user_id), 'complexity', 'victories', 'defeats', 'version', 'question_id', 'question')
+        question = None
+        if question_id is not None:
+            try:
+                question = self.load_question(question_id.decode('utf-8'))
+            except KeyError:
+                pass
+        elif question_json is not None:
+            question = question_from_json(json.loads(question_json))
+        return UserRecord(None if complexity is None else complexity.decode('utf-8'), int(victories or 0),
+                          int(defeats or 0), question, int(version or 0))
+
+    def put_user_records(self, records):
+        user_keys = [self.user_key(user_id) for user_id in records]
+
+        def update(pipe):
+            # версия и текущий вопрос каждого пользователя читаются под WATCH; если кто-то изменит пользователя
+            # до EXEC, транзакция повторится
+            conflicts = []
+            versions = {}
+            ref_changes = {}
+            questions = {}
+            previous_question_ids = {}
+            for user_id, record in records.items():
+                version = int(pipe.hget(self.user_key(user_id), 'version') or 0)
+                if record.version is not None and record.version != version:
+                    conflicts.append(user_id)
+                    continue
+                versions[user_id] = version
+                previous_question_id = previous_question_ids[user_id] = \
+                    self.parse_asked_question_id(pipe.hmget(self.user_key(user_id), *self.asked_question_fields))
+                question_id = None if record.question is None else record.question.id
+                if question_id != previous_question_id:
+                    if question_id is not None:
+                        ref_changes[question_id] = ref_changes.get(question_id, 0) + 1
+                        questions[question_id] = record.question
+                    if previous_question_id is not None:
+                        ref_changes[previous_question_id] = ref_changes.get(previous_question_id, 0) - 1
+
+            pipe.multi()
+            released_question_ids = self.queue_question_ref_changes(pipe, ref_changes, questions)
+            for user_id in versions:
+                record = records[user_id]
+                user_key = self.user_key(user_id)
+                fields = {'victories': record.victories, 'defeats': record.defeats}
+                if record.complexity is not None:
+                    fields['complexity'] = record.complexity
+                pipe.hset(user_key, mapping=fields)
+                # вопрос, который не менялся, не перезаписывается, чтобы не продлевать срок ответа на него
+                question_id = None if record.question is None else record.question.id
+                if question_id != previous_question_ids[user_id] or question_id is None:
+                    self.queue_user_question(pipe, user_id, question_id)
+                if record.victories > 0:
+                    pipe.zadd(self.leaderboard_key, {user_id: record.victories})
+                else:
+                    pipe.zrem(self.leaderboard_key, user_id)
+                self.queue_touch(pipe, user_id)
+            return conflicts, versions, released_question_ids
+
+        conflicts, versions, released_question_ids = self.redis_db.transaction(update, *user_keys,
+                                                                               value_from_callable=True)
+        for user_id, version in versions.items():
+            records[user_id].version = version + 1
+        self.__remove_unused_questions(released_question_ids)
+        return conflicts
+
+    def expire_questions(self):
+        expired_user_ids = []
+        while True:
+            now = time.time()
+            user_ids = self.redis_db.zrangebyscore(self.question_deadlines_key, '-inf', now,
+                                                   start=0, num=self.expiry_batch_size)
+            for user_id in user_ids:
+                if self.__expire_question(int(user_id), now):
+                    expired_user_ids.append(int(user_id))
+            if len(user_ids) < self.expiry_batch_size:
+                return expired_user_ids
+
+    def __expire_question(self, user_id, now):
+        user_key = self.user_key(user_id)
+
+        def update(pipe):
+            # срок ответа меняется только вместе с хэшем пользователя, поэтому достаточно WATCH этого хэша
+            deadline = pipe.zscore(self.question_deadlines_key, user_id)
+            if deadline is None or deadline > now:
+                return None
+            previous_question_id = self.parse_asked_question_id(pipe.hmget(user_key, *self.asked_question_fields))
+            pipe.multi()
+            return self.queue_set_user_question(pipe, user_id, previous_question_id, None)
+
+        released_question_ids = self.redis_db.transaction(update, user_key, value_from_callable=True)
+        if released_question_ids is None:
+            return False
+        self.__remove_unused_questions(released_question_ids)
+        return True
+
+    def subscribe_to_changes(self, callback):
+        prefix = f'{self.instance_id}:'
+
+        def handle(message):
+            data = message['data'].decode('utf-8')
+            # свои изменения экземпляр бота и так знает
+            if not data.startswith(prefix):
+                callback(int(data[data.index(':') + 1:]))
+
+        pubsub = self.redis_db.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{self.invalidation_channel: handle})
+        thread = pubsub.run_in_thread(sleep_time=1.0, daemon=True)
+        return thread.stop
+
+    def count_users_with_more_victories(self, victories):
+        """
+        :param victories: кол-во побед (int)
+        :return: кол-во пользователей, у которых побед больше (int)
+        """
+        return self.redis_db.zcount(self.leaderboard_key, f'({victories}', '+inf')
+
+    def get_user_rank(self, user_id):
+        victories = self.redis_db.zscore(self.leaderboard_key, user_id) or 0
+        return 1 + self.count_users_with_more_victories(int(victories))
+
+    def get_top_users(self, count):
+        return [(int(user_id), int(victories))
+                for user_id, victories in self.redis_db.zrevrange(self.leaderboard_key, 0, count - 1,
+                                                                  withscores=True)]
+
+
+class ConsistentHashRing:
+    """
+    Кольцо консистентного хэширования: каждый узел занимает на кольце replicas точек, а ключ принадлежит узлу,
+    чья точка первая по часовой стрелке от хэша ключа. При добавлении или удалении узла меняют владельца только
+    ключи, попавшие на участки этого узла (в среднем 1/N всех ключей).
+    """
+
+    def __init__(self, nodes=(), replicas=100):
+        """
+        :param nodes: имена узлов ([str])
+        :param replicas: кол-во точек на кольце для каждого узла (int)
+        """
+        self.replicas = replicas
+        self.points = []
+        self.point_nodes = {}
+        for node in nodes:
+            self.add_node(node)
+
+    @staticmethod
+    def __hash(key):
+        return int.from_bytes(hashlib.md5(str(key).encode('utf-8')).digest()[:8], 'big')
+
+    def add_node(self, node):
+        for i in range(self.replicas):
+            point = self.__hash(f'{node}#{i}')
+            self.point_nodes[point] = node
+            bisect.insort(self.points, point)
+
+    def remove_node(self, node):
+        for i in range(self.replicas):
+            point = self.__hash(f'{node}#{i}')
+            if self.point_nodes.pop(point, None) is not None:
+                self.points.remove(point)
+
+    def get_node(self, key):
+        """
+        :param key: ключ (например, telegram-ID пользователя)
+        :return: имя узла, которому принадлежит ключ (str)
+        """
+        if not self.points:
+            raise RuntimeError('В кольце нет ни одного узла')
+        i = bisect.bisect(self.points, self.__hash(key)) % len(self.points)
+        return self.point_nodes[self.points[i]]
+
+
+class ShardedRedisUserDataStorage(UserDataStorage, UserRecordStore):
+    """
+    Реализация UserDataStorage, которая распределяет пользователей по нескольким Redis (шардам) с помощью
+    консистентного хэширования telegram-ID. На каждом шарде данные хранятся так же, как в RedisUserDataStorage
+    (включая свой каталог вопросов), у каждого шарда свой пул соединений. Шарды можно добавлять и убирать, меняя
+    список шардов: при запуске с новым списком rebalance переносит только пользователей, которые сменили шард.
+    """
+
+    # максимальное кол-во соединений в пуле одного шарда
+    max_connections_per_shard = 50
+    # ключ, под которым на каждом шарде хранится список шардов (json), между которыми распределены пользователи
+    ring_key = 'mosigobot.shard_ring'
+    # блокировка, которую держит экземпляр бота, переносящий пользователей между шардами (на первом по имени шарде);
+    # если экземпляр упал во время переноса, блокировка снимается сама через rebalance_lock_timeout секунд
+    rebalance_lock_key = 'mosigobot.shard_ring.lock'
+    rebalance_lock_timeout = 600
+
+    def __init__(self, redis_urls=(), redis_clients=None, replicas=100, question_ttl=None):
+        """
+        Шарды задаются списком URL для коннекта в Redis или словарём уже готовых клиентов Redis (например, для тестов).
+        Имя шарда на кольце - его URL (или ключ словаря), поэтому порядок шардов не важен.
+
+        :param redis_urls: URL для коннекта к каждому шарду ([str])
+        :param redis_clients: готовые клиенты Redis по имени шарда ({str: redis.Redis})
+        :param replicas: кол-во точек на кольце для каждого шарда (int)
+        :param question_ttl: сколько секунд пользователь может отвечать на вопрос (float); None - без ограничения
+        """
+        self.ring = ConsistentHashRing(replicas=replicas)
+        self.question_ttl = question_ttl
+        self.shards = {}
+        # у хранилищ всех шардов один ID экземпляра бота, чтобы отличать свои изменения от чужих
+        self.instance_id = os.urandom(8).hex()
+        for redis_url in redis_urls:
+            self.__add_shard(redis_url, self.__connect(redis_url))
+        for name, redis_db in (redis_clients or {}).items():
+            self.__add_shard(name, redis_db)
+
+    def __connect(self, redis_url):
+        pool = redis.ConnectionPool.from_url(redis_url, max_connections=self.max_connections_per_shard)
+        return redis.Redis(connection_pool=pool)
+
+    def __add_shard(self, name, redis_db):
+        self.shards[name] = RedisUserDataStorage(redis_db=redis_db, instance_id=self.instance_id,
+                                                 question_ttl=self.question_ttl)
+        self.ring.add_node(name)
+
+    def shard_for(self, user_id):
+        """
+        :param user_id: telegram-ID пользователя (int)
+        :return: хранилище шарда, на котором хранится пользователь (RedisUserDataStorage)
+        """
+        return self.shards[self.ring.get_node(user_id)]
+
+    def __user_ids(self, shard):
+        prefix = RedisUserDataStorage.user_key('')
+        for key in shard.redis_db.scan_iter(match=f'{prefix}*', count=1000):
+            yield int(key.decode('utf-8')[len(prefix):])
+
+    @staticmethod
+    def __move_user(user_id, source, target):
+        user_key = RedisUserDataStorage.user_key(user_id)
+        fields = {k.decode('utf-8'): v for k, v in source.redis_db.hgetall(user_key).items()
+                  if k in (b'complexity', b'victories', b'defeats')}
+        question = source.get_user_current_question(user_id)
+
+        if fields:
+            target.redis_db.hset(user_key, mapping=fields)
+        victories = int(fields.get('victories', 0))
+        if victories > 0:
+            target.redis_db.zadd(RedisUserDataStorage.leaderboard_key, {user_id: victories})
+            source.redis_db.zrem(RedisUserDataStorage.leaderboard_key, user_id)
+        if question is not None:
+            target.put_user_current_question(user_id, question)
+            source.clear_user_current_question(user_id)
+        source.redis_db.delete(user_key)
+
+    def __read_ring(self):
+        names = set()
+        for shard in self.shards.values():
+            ring_json = shard.redis_db.get(self.ring_key)
+            if ring_json is not None:
+                names.update(json.loads(ring_json))
+        return names
+
+    def rebalance(self, retired_clients=None):
+        """
+        Переносит пользователей на шарды, которым они принадлежат при текущем списке шардов. Вызывается при запуске,
+        до того как бот начнёт обслуживать пользователей: если список шардов изменился с прошлого запуска, то без
+        переноса часть пользователей попала бы на пустой шард и потеряла бы свои победы и текущий вопрос.
+
+        Список шардов, между которыми распределены пользователи, хранится на самих шардах. Если он не изменился,
+        ничего не делается. Иначе пользователи убранных шардов (к ним подключаемся по имени - URL) переносятся
+        на оставшиеся, а на оставшихся шардах переносятся пользователи, которые теперь принадлежат другому шарду.
+        Перенос выполняет только один экземпляр бота, остальные ждут его окончания; прерванный перенос можно
+        просто повторить.
+
+        :param retired_clients: готовые клиенты Redis для убранных шардов по имени шарда ({str: redis.Redis}),
+        например, для тестов
+        :return: кол-во перенесённых пользователей (int)
+        """
+        lock_db = self.shards[min(self.shards)].redis_db
+        # пока перенос выполняет другой экземпляр бота, ждём
+        acquire_redis_lock(lock_db, self.rebalance_lock_key, self.instance_id, self.rebalance_lock_timeout)
+        try:
+            return self.__rebalance(retired_clients or {})
+        finally:
+            release_redis_lock(lock_db, self.rebalance_lock_key, self.instance_id)
+
+    def __rebalance(self, retired_clients):
+        previous_names = self.__read_ring()
+        if previous_names == set(self.shards):
+            return 0
+
+        moved = 0
+        for name in previous_names - set(self.shards):
+            redis_db = retired_clients[name] if name in retired_clients else self.__connect(name)
+            retired_shard = RedisUserDataStorage(redis_db=redis_db, instance_id=self.instance_id,
+                                                 question_ttl=self.question_ttl)
+            for user_id in list(self.__user_ids(retired_shard)):
+                self.__move_user(user_id, retired_shard, self.shard_for(user_id))
+                moved += 1
+            redis_db.delete(self.ring_key)
+
+        for name, shard in self.shards.items():
+            for user_id in list(self.__user_ids(shard)):
+                owner = self.ring.get_node(user_id)
+                if owner != name:
+                    self.__move_user(user_id, shard, self.shards[owner])
+                    moved += 1
+
+        ring_json = json.dumps(sorted(self.shards))
+        for shard in self.shards.values():
+            shard.redis_db.set(self.ring_key, ring_json)
+        logging.info(f'Пользователи перераспределены между шардами {sorted(self.shards)}: перенесено {moved}')
+        return moved
+
+    def get_user_current_question(self, user_id):
+        return self.shard_for(user_id).get_user_current_question(user_id)
+
+    def put_user_current_question(self, user_id, question):
+        self.shard_for(user_id).put_user_current_question(user_id, question)
+
+    def clear_user_current_question(self, user_id):
+        self.shard_for(user_id).clear_user_current_question(user_id)
+
+    def get_user_complexity(self, user_id):
+        return self.shard_for(user_id).get_user_complexity(user_id)
+
+    def set_user_complexity(self, user_id, complexity):
+        self.shard_for(user_id).set_user_complexity(user_id, complexity)
+
+    def get_user_victories_count(self, user_id):
+        return self.shard_for(user_id).get_user_victories_count(user_id)
+
+    def get_user_defeats_count(self, user_id):
+        return self.shard_for(user_id).get_user_defeats_count(user_id)
+
+    def add_user_victory(self, user_id):
+        self.shard_for(user_id).add_user_victory(user_id)
+
+    def add_user_defeat(self, user_id):
+        self.shard_for(user_id).add_user_defeat(user_id)
+
+    def get_user_record(self, user_id):
+        return self.shard_for(user_id).get_user_record(user_id)
+
+    def put_user_records(self, records):
+        records_by_shard = {}
+        for user_id, record in records.items():
+            records_by_shard.setdefault(self.ring.get_node(user_id), {})[user_id] = record
+        conflicts = []
+        for shard_name, shard_records in records_by_shard.items():
+            conflicts.extend(self.shards[shard_name].put_user_records(shard_records))
+        return conflicts
+
+    def expire_questions(self):
+        return [user_id for shard in self.shards.values() for user_id in shard.expire_questions()]
+
+    def subscribe_to_changes(self, callback):
+        unsubscribe_functions = [shard.subscribe_to_changes(callback) for shard in self.shards.values()]
+
+        def unsubscribe():
+            for unsubscribe_function in unsubscribe_functions:
+                unsubscribe_function()
+        return unsubscribe
+
+    def count_users_with_more_victories(self, victories):
+        # у каждого шарда свой рейтинг, поэтому место складывается из мест на всех шардах
+        return sum(shard.count_users_with_more_victories(victories) for shard in self.shards.values())
+
+    def get_user_rank(self, user_id):
+        return 1 + self.count_users_with_more_victories(self.get_user_victories_count(user_id))
+
+    def get_top_users(self, count):
+        return heapq.nlargest(count, itertools.chain.from_iterable(
+            shard.get_top_users(count) for shard in self.shards.values()), key=lambda item: item[1])
+
+
+class LazyUserDataStorage(UserDataStorage):
+    """
+    Реализация UserDataStorage, которая держит в памяти только активных пользователей. Состояние пользователя
+    загружается из хранилища (UserRecordStore) при первом обращении и попадает в рабочий набор ограниченного
+    размера; когда набор переполнен, из него вытесняется пользователь, к которому дольше всех не обращались (LRU).
+    При старте ничего не загружается, а память зависит от числа активных, а не всех пользователей.
+
+    Изменения по умолчанию копятся в памяти (write-back): изменённый пользователь записывается в хранилище
+    при вытеснении, при flush (раз в flush_interval секунд, если он задан) и при close. С write_through=True
+    каждое изменение записывается сразу, а рабочий набор служит только кэшем для чтения.
+
+    Если с хранилищем работают несколько экземпляров бота (например, с одним Redis), то у изменённого
+    пользователя вместе с состоянием хранятся сами изменения. Состояние записывается, только если версия
+    в хранилище не изменилась с момента чтения; иначе пользователь читается заново, изменения применяются
+    к свежему состоянию, и запись повторяется, поэтому чужие победы не теряются. Неизменённые пользователи
+    сбрасываются из памяти, как только хранилище сообщает, что их изменил другой экземпляр.
+
+    Место в рейтинге и лучших пользователей считает хранилище, а победы, которые ещё не записаны, учитываются
+    поправкой: для пользователей, у которых кол-во побед в памяти отличается от записанного, хранятся оба значения
+    (в рейтингах InMemoryLeaderboard), поэтому для ответа ничего не записывается и рабочий набор не просматривается.
+    """
+
+    def __init__(self, store, max_users=100000, write_through=False, flush_interval=None):
+        """
+        Обращения к хранилищу выполняются без общей блокировки рабочего набора, поэтому пока один пользователь
+        читается из хранилища или записывается в него, остальные обслуживаются из памяти. Если одного и того же
+        пользователя одновременно запрашивают несколько потоков, из хранилища он читается один раз.
+
+        :param store: хранилище состояния пользователей (UserRecordStore), например SqliteUserDataStorage
+        :param max_users: максимальное кол-во пользователей в памяти (int)
+        :param write_through: записывать ли каждое изменение сразу (bool)
+        :param flush_interval: как часто (в секундах) записывать все изменения; None - только при вытеснении
+        и при close (float)
+        """
+        self.store = store
+        self.max_users = max_users
+        self.write_through = write_through
+
+        # для каждого пользователя в памяти: состояние, изменения, которые ещё не записаны в хранилище,
+        # и кол-во побед, которое записано в хранилище
+        self.records = OrderedDict()
+        # вытесненные изменённые пользователи, которые ещё записываются в хранилище
+        self.evicting = {}
+        # пользователи, которые сейчас читаются из хранилища, и Future, которое завершится, когда чтение закончится
+        self.loading = {}
+        # пользователи, которых изменил кто-то другой, пока они читались: прочитанное состояние устарело
+        self.stale_loads = set()
+        self.dirty_count = 0
+        # кол-во побед в памяти и в хранилище у пользователей, победы которых ещё не записаны
+        self.unsaved_victories = InMemoryLeaderboard()
+        self.saved_victories = InMemoryLeaderboard()
+        # защищает только рабочий набор и счётчики; с хранилищем под ней не работаем
+        self.lock = threading.Lock()
+        # записи в хранилище выполняются по одной, чтобы один пользователь не записывался двумя потоками сразу
+        self.write_lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions_count = 0
+        self.write_backs_count = 0
+        self.conflicts_count = 0
+        self.invalidations_count = 0
+        metrics.queue_size.set_function(lambda: {'lazy_unsaved_users': self.dirty_count}, key='lazy_unsaved_users')
+
+        self.unsubscribe = store.subscribe_to_changes(self.invalidate)
+
+        self.flush_interval = flush_interval
+        if flush_interval is not None:
+            self.stopped = threading.Event()
+            self.flush_thread = threading.Thread(target=self.__flush_loop, daemon=True)
+            self.flush_thread.start()
+
+    def __flush_loop(self):
+        while not self.stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logging.exception(e)
+
+    def __get(self, user_id):
+        """
+        Находит пользователя в рабочем наборе, а если его там нет - читает из хранилища (без self.lock).
+
+        :return: запись пользователя в рабочем наборе ([UserRecord, [изменения], int])
+        """
+        while True:
+            with self.lock:
+                entry = self.records.get(user_id)
+                if entry is not None:
+                    self.records.move_to_end(user_id)
+                    self.hits += 1
+                    return entry
+                entry = self.evicting.pop(user_id, None)
+                if entry is not None:
+                    # пользователь ещё записывается после вытеснения: его состояние в памяти новее, чем в хранилище
+                    self.hits += 1
+                    self.records[user_id] = entry
+                    evicted = self.__evict()
+                else:
+                    future = self.loading.get(user_id)
+                    loader = future is None
+                    if loader:
+                        future = self.loading[user_id] = Future()
+                        self.misses += 1
+
+            if entry is not None:
+                self.__write_evicted(evicted)
+                return entry
+            if not loader:
+                # этого пользователя уже читает другой поток: ждём и ищем его в рабочем наборе ещё раз
+                future.result()
+                continue
+            entry = self.__load(user_id, future)
+            if entry is not None:
+                return entry
+
+    def __load(self, user_id, future):
+        """
+        Читает пользователя из хранилища и добавляет его в рабочий набор.
+
+        :return: запись пользователя ([UserRecord, [изменения], int]) или None, если пока он читался, его изменил
+            кто-то другой и прочитать его нужно заново
+        """
+        try:
+            record = self.store.get_user_record(user_id)
+        except BaseException as e:
+            with self.lock:
+                del self.loading[user_id]
+                self.stale_loads.discard(user_id)
+            future.set_exception(e)
+            raise
+
+        with self.lock:
+            del self.loading[user_id]
+            if user_id in self.stale_loads:
+                self.stale_loads.discard(user_id)
+                entry = evicted = None
+            else:
+                entry = self.records[user_id] = [record, [], record.victories]
+                evicted = self.__evict()
+        future.set_result(None)
+        self.__write_evicted(evicted)
+        return entry
+
+    def __evict(self):
+        # вызывается под self.lock; возвращает вытесненных изменённых пользователей, которых нужно записать
+        evicted = {}
+        while len(self.records) > self.max_users:
+            evicted_user_id, evicted_entry = self.records.popitem(last=False)
+            self.evictions_count += 1
+            if evicted_entry[1]:
+                self.evicting[evicted_user_id] = evicted_entry
+                evicted[evicted_user_id] = evicted_entry
+        return evicted
+
+    def __write_evicted(self, evicted):
+        if not evicted:
+            return
+        self.__write(evicted)
+        with self.lock:
+            for user_id, entry in evicted.items():
+                if self.evicting.get(user_id) is entry and not entry[1]:
+                    del self.evicting[user_id]
+
+    def __write(self, entries):
+        """
+        Записывает состояние пользователей в хранилище. Пользователей, которых с момента чтения изменил кто-то
+        другой, читает заново, применяет к ним несохранённые изменения и записывает ещё раз.
+
+        Записывается копия состояния, снятая под self.lock вместе с кол-вом учтённых в ней изменений. Изменения,
+        которые сделаны, пока пользователь записывался, попадают только в состояние в памяти и остаются
+        несохранёнными до следующей записи.
+
+        :param entries: пользователи и их записи из рабочего набора ({int: [UserRecord, [изменения], int]})
+        """
+        with self.write_lock:
+            while True:
+                with self.lock:
+                    # копия состояния каждого пользователя и сколько его изменений она содержит
+                    written = {user_id: (entry[0].copy(), len(entry[1]))
+                               for user_id, entry in entries.items() if entry[1]}
+                if not written:
+                    return
+                conflicts = self.store.put_user_records({user_id: record for user_id, (record, _) in written.items()})
+
+                with self.lock:
+                    self.write_backs_count += len(written) - len(conflicts)
+                    for user_id, (record, changes_count) in written.items():
+                        if user_id not in conflicts:
+                            entry = entries[user_id]
+                            del entry[1][:changes_count]
+                            # версию, которую хранилище присвоило записанной копии, получает и состояние в памяти
+                            entry[0].version = record.version
+                            entry[2] = record.victories
+                            self.__track_victories(user_id, entry)
+                            if not entry[1]:
+                                self.dirty_count -= 1
+                    self.conflicts_count += len(conflicts)
+                if not conflicts:
+                    return
+                metrics.storage_write_conflicts.inc(type(self.store).__name__, amount=len(conflicts))
+                for user_id in conflicts:
+                    self.__replay(user_id, entries[user_id])
+                entries = {user_id: entries[user_id] for user_id in conflicts}
+
+    def __replay(self, user_id, entry):
+        # вызывается под self.write_lock: читает свежее состояние и применяет к нему несохранённые изменения
+        record = self.store.get_user_record(user_id)
+        with self.lock:
+            entry[2] = record.victories
+            for change in entry[1]:
+                change(record)
+            entry[0] = record
+            self.__track_victories(user_id, entry)
+
+    def __read(self, user_id):
+        return self.__get(user_id)[0]
+
+    def __update(self, user_id, change):
+        while True:
+            entry = self.__get(user_id)
+            with self.lock:
+                # пока пользователь читался, его могли вытеснить или сбросить из памяти
+                if self.records.get(user_id) is not entry:
+                    continue
+                change(entry[0])
+                if not entry[1]:
+                    self.dirty_count += 1
+                entry[1].append(change)
+                self.__track_victories(user_id, entry)
+            if self.write_through:
+                self.__write({user_id: entry})
+            return
+
+    def __track_victories(self, user_id, entry):
+        # вызывается под self.lock после любого изменения состояния пользователя в памяти или в хранилище
+        if entry[0].victories != entry[2]:
+            self.unsaved_victories.set_score(user_id, entry[0].victories)
+            self.saved_victories.set_score(user_id, entry[2])
+        else:
+            self.unsaved_victories.set_score(user_id, 0)
+            self.saved_victories.set_score(user_id, 0)
+
+    def invalidate(self, user_id):
+        """
+        Сбрасывает пользователя из памяти, чтобы при следующем обращении прочитать его из хранилища.
+        Изменённый пользователь остаётся: при записи его изменения будут применены к свежему состоянию.
+
+        :param user_id: telegram-ID пользователя (int)
+        """
+        with self.lock:
+            if user_id in self.loading:
+                self.stale_loads.add(user_id)
+            entry = self.records.get(user_id)
+            if entry is not None and not entry[1]:
+                del self.records[user_id]
+                self.invalidations_count += 1
+
+    def flush(self):
+        """
+        Записывает в хранилище всех изменённых пользователей одной пачкой. Рабочий набор блокируется только
+        на время, пока выбираются изменённые пользователи, а сама запись идёт без блокировки.
+        """
+        with self.lock:
+            dirty = {user_id: entry for user_id, entry in self.records.items() if entry[1]}
+        if dirty:
+            self.__write(dirty)
+
+    def close(self):
+        """
+        Останавливает фоновую запись (если она включена), записывает все изменения и закрывает хранилище.
+        """
+        if self.flush_interval is not None:
+            self.stopped.set()
+            self.flush_thread.join()
+        self.unsubscribe()
+        self.flush()
+        close = getattr(self.store, 'close', None)
+        if close is not None:
+            close()
+
+    def get_stats(self):
+        """
+        :return: размер рабочего набора, попадания и промахи, кол-во вытеснений, записей в хранилище,
+            конфликтов записи и сброшенных из памяти пользователей (map)
+        """
+        with self.lock:
+            return {
+                'users': len(self.records),
+                'dirty': self.dirty_count,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions_count,
+                'write_backs': self.write_backs_count,
+                'conflicts': self.conflicts_count,
+                'invalidations': self.invalidations_count
+            }
+
+    def get_user_current_question(self, user_id):
+        return self.__read(user_id).question
+
+    def put_user_current_question(self, user_id, question):
+        def change(record):
+            record.question = question
+        self.__update(user_id, change)
+
+    def clear_user_current_question(self, user_id):
+        def change(record):
+            record.question = None
+        self.__update(user_id, change)
+
+    def get_user_complexity(self, user_id):
+        return self.__read(user_id).complexity or DEFAULT_COMPLEXITY
+
+    def set_user_complexity(self, user_id, complexity):
+        check_complexity(complexity)
+
+        def change(record):
+            record.complexity = complexity
+        self.__update(user_id, change)
+
+    def get_user_victories_count(self, user_id):
+        return self.__read(user_id).victories
+
+    def get_user_defeats_count(self, user_id):
+        return self.__read(user_id).defeats
+
+    def add_user_victory(self, user_id):
+        def change(record):
+            record.victories += 1
+        self.__update(user_id, change)
+
+    def add_user_defeat(self, user_id):
+        def change(record):
+            record.defeats += 1
+        self.__update(user_id, change)
+
+    def expire_questions(self):
+        user_ids = self.store.expire_questions()
+        # о своих изменениях хранилище этому экземпляру не сообщает (subscribe_to_changes), поэтому пользователи
+        # с удалёнными вопросами обновляются в памяти здесь
+        for user_id in user_ids:
+            self.__reload(user_id)
+        return user_ids
+
+    def __reload(self, user_id):
+        with self.lock:
+            if user_id in self.loading:
+                self.stale_loads.add(user_id)
+            entry = self.records.get(user_id)
+            if entry is None:
+                return
+            if not entry[1]:
+                del self.records[user_id]
+                return
+        # несохранённые изменения применяются к свежему состоянию, как при конфликте записи
+        with self.write_lock:
+            self.__replay(user_id, entry)
+
+    def get_user_rank(self, user_id):
+        victories = self.get_user_victories_count(user_id)
+        better_count = self.store.count_users_with_more_victories(victories)
+        # пользователи с незаписанными победами посчитаны хранилищем по записанному кол-ву побед
+        with self.lock:
+            better_count += self.unsaved_victories.count_better(victories) - \
+                self.saved_victories.count_better(victories)
+        return 1 + better_count
+
+    def get_top_users(self, count):
+        with self.lock:
+            unsaved_top = self.unsaved_victories.get_top(count)
+        # лучшие из остальных пользователей - это лучшие по хранилищу, если пропустить тех, чьи победы ещё
+        # не записаны; если таких оказалось много, у хранилища запрашивается больше пользователей
+        fetch_count = count
+        while True:
+            stored_top = self.store.get_top_users(fetch_count)
+            with self.lock:
+                saved_top = [(user_id, victories) for user_id, victories in stored_top
+                             if user_id not in self.unsaved_victories.players]
+            if len(saved_top) >= count or len(stored_top) < fetch_count:
+                break
+            fetch_count += count - len(saved_top)
+        return sorted(saved_top + unsaved_top, key=lambda item: (-item[1], item[0]))[:count]
+
+
+def start_question_expiry(storage, interval=60.0):
+    """
+    Запускает фоновый поток, который раз в interval секунд удаляет вопросы, на которые не ответили вовремя
+    (storage.expire_questions), и считает их в метрике mosigobot_questions_expired_total.
+
+    :param storage: хранилище состояния пользователей (UserDataStorage)
+    :param interval: период в секундах (float)
+    :return: событие, установка которого останавливает поток (threading.Event)
+    """
+    stopped = threading.Event()
+
+    def expiry_loop():
+        while not stopped.wait(interval):
+            try:
+                expired_count = len(storage.expire_questions())
+            except Exception as e:
+                logging.exception(e)
+                continue
+            if expired_count:
+                metrics.questions_expired.inc(type(storage).__name__, amount=expired_count)
+
+    threading.Thread(target=expiry_loop, daemon=True, name='question-expiry').start()
+    return stopped
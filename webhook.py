@@ -0,0 +1,166 @@
+import json
+import logging
+import queue
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telebot.types import Update
+
+import metrics
+
+from message_processor import get_chat_id_to_reply
+
+
+def get_update_user_id(update):
+    """
+    Возвращает telegram-ID пользователя, от которого пришло обновление. Если пользователя определить нельзя,
+    возвращается ID самого обновления.
+
+    :param update: обновление от Telegram (telebot.types.Update)
+    :return: ключ, по которому обновление распределяется по обработчикам (int)
+    """
+    for obj in [update.message, update.edited_message, update.callback_query]:
+        if obj is not None and obj.from_user is not None:
+            return get_chat_id_to_reply(obj)
+    return update.update_id
+
+
+class ShardedUpdateProcessor:
+    """
+    Пул обработчиков обновлений от Telegram. Каждый обработчик работает в своём потоке и разбирает свою очередь;
+    очередь выбирается по telegram-ID пользователя, поэтому обновления одного пользователя обрабатываются строго
+    по порядку, а обновления разных пользователей - параллельно. Очереди ограничены по размеру: если очередь
+    переполнена, новое обновление не принимается, и вызывающий код должен попросить Telegram повторить его позже.
+    """
+
+    def __init__(self, process_update, shards=8, queue_size=100):
+        """
+        :param process_update: функция, которая обрабатывает одно обновление (telebot.types.Update -> None)
+        :param shards: кол-во обработчиков (int)
+        :param queue_size: максимальное кол-во необработанных обновлений в очереди одного обработчика (int)
+        """
+        self.process_update = process_update
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(shards)]
+        self.threads = [threading.Thread(target=self.__work, args=(q,), daemon=True) for q in self.queues]
+        for thread in self.threads:
+            thread.start()
+        metrics.queue_size.set_function(
+            lambda: {f'webhook_shard_{i}': size for i, size in enumerate(self.get_queue_sizes())}, key='webhook')
+
+    def __work(self, updates):
+        while True:
+            update = updates.get()
+            if update is None:
+                return
+            try:
+                self.process_update(update)
+            except Exception as e:
+                logging.exception(e)
+
+    def submit(self, update):
+        """
+        Ставит обновление в очередь обработчика, который отвечает за пользователя.
+
+        :param update: обновление от Telegram (telebot.types.Update)
+        :return: True, если обновление принято, и False, если очередь переполнена (bool)
+        """
+        shard = get_update_user_id(update) % len(self.queues)
+        try:
+            self.queues[shard].put_nowait(update)
+            return True
+        except queue.Full:
+            return False
+
+    def get_queue_sizes(self):
+        """
+        :return: кол-во необработанных обновлений в очереди каждого обработчика ([int])
+        """
+        return [q.qsize() for q in self.queues]
+
+    def close(self):
+        """
+        Дожидается обработки всех принятых обновлений и останавливает обработчики.
+        """
+        for q in self.queues:
+            q.put(None)
+        for thread in self.threads:
+            thread.join()
+
+
+class WebhookServer(ThreadingHTTPServer):
+    """
+    HTTP-сервер, который принимает обновления от Telegram по webhook и передаёт их в ShardedUpdateProcessor.
+    Если очередь обработчика переполнена, сервер отвечает 503, и Telegram повторяет доставку обновления позже.
+    """
+
+    daemon_threads = True
+    # Telegram доставляет обновления в несколько параллельных соединений (до 40 по умолчанию): с очередью
+    # соединений по умолчанию (5) при всплеске нагрузки лишние соединения сбрасываются
+    request_queue_size = 128
+
+    def __init__(self, address, processor, path='/', secret_token=None):
+        """
+        :param address: адрес, на котором сервер принимает запросы ((str, int))
+        :param processor: пул обработчиков обновлений (ShardedUpdateProcessor)
+        :param path: путь, на который Telegram присылает обновления (str)
+        :param secret_token: секрет, который Telegram передаёт в заголовке X-Telegram-Bot-Api-Secret-Token (str)
+        """
+        super().__init__(address, WebhookRequestHandler)
+        self.processor = processor
+        self.webhook_path = path
+        self.secret_token = secret_token
+
+
+class WebhookRequestHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        if self.path != self.server.webhook_path:
+            self.send_response(404)
+            self.end_headers()
+            return
+        if self.server.secret_token is not None and \
+                self.headers.get('X-Telegram-Bot-Api-Secret-Token') != self.server.secret_token:
+            self.send_response(403)
+            self.end_headers()
+            return
+
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            update = Update.de_json(json.loads(body))
+        except ValueError:
+            self.send_response(400)
+            self.end_headers()
+            return
+
+        self.send_response(200 if self.server.processor.submit(update) else 503)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logging.debug(format, *args)
+
+
+def run_webhook(bot, webhook_url, host='0.0.0.0', port=8443, path='/', secret_token=None, shards=8, queue_size=100):
+    """
+    Регистрирует webhook в Telegram и запускает HTTP-сервер, который принимает обновления. Функция не возвращает
+    управление, пока сервер не будет остановлен.
+
+    :param bot: объект бота (TeleBot), созданный с threaded=False, чтобы обновления не перемешивались
+    :param webhook_url: публичный URL, по которому Telegram будет присылать обновления (str)
+    :param host: адрес, на котором сервер принимает запросы (str)
+    :param port: порт, на котором сервер принимает запросы (int)
+    :param path: путь, на который Telegram присылает обновления (str)
+    :param secret_token: секрет для проверки, что запрос пришёл от Telegram (str)
+    :param shards: кол-во параллельных обработчиков обновлений (int)
+    :param queue_size: максимальное кол-во необработанных обновлений в очереди одного обработчика (int)
+    """
+    processor = ShardedUpdateProcessor(lambda update: bot.process_new_updates([update]), shards, queue_size)
+    server = WebhookServer((host, port), processor, path, secret_token)
+
+    bot.remove_webhook()
+    bot.set_webhook(url=webhook_url, secret_token=secret_token)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        processor.close()